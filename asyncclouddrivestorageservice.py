@@ -0,0 +1,200 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+from mimetypes import guess_type
+
+import aiohttp
+import requests
+
+from asyncstorageservice import AsyncStorageService, HashMismatch
+from clouddrivestorageservice import CloudDriveStorageService
+
+
+class AsyncCloudDriveStorageService(AsyncStorageService):
+
+    service_name = "clouddrive"
+    sync_service_class = CloudDriveStorageService
+    hash_type = 'md5'
+
+    # Folder paths are resolved once per folder and cached, so the
+    # synchronous lookups are used for them
+    async def get_folder(self, folder_path, create=False):
+        if folder_path is None or folder_path.strip('/') == "":
+            return self.service.root_folder
+        return await self.run_sync(self.service.get_folder,
+                                   self.service.root_folder, folder_path,
+                                   create)
+
+    async def get_file(self, folder_id, file_name):
+        cached_file = self.service.get_cached("file",
+                                              folder_id + "/" + file_name)
+        if cached_file is not None:
+            return cached_file
+
+        params = {'filters': 'name:' + file_name.replace(" ", "\\ ")}
+        url = self.service.metadata_url + '/nodes/' + folder_id + '/children'
+        response = await self.http_request(url, "GET",
+                                           status_codes=(requests.codes.ok,),
+                                           use_access_token=True,
+                                           params=params,
+                                           action_string='Get File')
+
+        data = json.loads(await response.text())
+        if 'data' not in data:
+            raise RuntimeError("Error getting file " + file_name)
+        if len(data['data']) == 0:
+            return None
+        elif len(data['data']) > 1:
+            raise RuntimeError("Error: Multiple items with name: " +
+                               file_name)
+        if data['data'][0]['kind'] != "FILE":
+            raise RuntimeError("Error: {} exists, but is not a file."
+                               .format(file_name))
+
+        self.service.set_cached("file", folder_id + "/" + file_name,
+                                data['data'][0])
+        return data['data'][0]
+
+    async def get_file_by_path(self, file_path):
+        (folder, file_name) = os.path.split(file_path)
+        folder_id = await self.get_folder(folder)
+        cur_file = await self.get_file(folder_id, file_name)
+        if cur_file is None:
+            raise RuntimeError("File {} does not exist".format(file_path))
+        return cur_file
+
+    async def is_folder(self, folder_path):
+        return await self.run_sync(self.service.is_folder, folder_path)
+
+    async def create_folder(self, folder_path):
+        return await self.run_sync(self.service.create_folder, folder_path)
+
+    async def get_listing_root(self, folder_path):
+        print("Getting listing for {}".format(folder_path))
+        return await self.get_folder(folder_path)
+
+    async def get_folder_children(self, cur_folder):
+        url = self.service.metadata_url + '/nodes/' + cur_folder + '/children'
+        status_codes = (requests.codes.ok,
+                        requests.codes.not_found)
+        params = {}
+        data = []
+        while True:
+            response = await self.http_request(url, "GET",
+                                               status_codes=status_codes,
+                                               use_access_token=True,
+                                               params=params,
+                                               action_string='Get Folder '
+                                               'Listing')
+            if response.status == requests.codes.not_found:
+                raise RuntimeError("Item not found. Possible bad path: "
+                                   + cur_folder)
+
+            cur_response = json.loads(await response.text())
+            if 'data' not in cur_response:
+                raise RuntimeError("Error getting folder " + cur_folder)
+            data.extend(cur_response['data'])
+            if len(data) >= cur_response['count']:
+                break
+            params['startToken'] = cur_response['nextToken']
+
+        data.sort(key=lambda cur_file: cur_file['name'])
+        return data
+
+    async def open_content(self, cur_file):
+        url = self.service.content_url+"/nodes/"+cur_file['id']+"/content"
+        return await self.http_request(url, "GET",
+                                       status_codes=(requests.codes.ok,),
+                                       use_access_token=True,
+                                       action_string='Download Item',
+                                       stream=True)
+
+    async def upload_file(self, file_path, destination=None,
+                          modified_time=None, create_folder=False,
+                          overwrite=False, progress=None):
+        logger = logging.getLogger("multidrive")
+        logger.debug("Upload {} Cloud Drive Storage Service".format(file_path))
+
+        file_name = os.path.basename(file_path)
+        destination_id = await self.get_folder(destination, create_folder)
+        cur_file = await self.get_file(destination_id, file_name)
+        if (cur_file is not None and self.service.skip_identical is True and
+                await self.run_sync(self.service.is_identical, file_path,
+                                    cur_file)):
+            print("{} is unchanged, skipping".format(file_name))
+            return cur_file
+        # The cached metadata of the file is stale once it's replaced
+        self.service.invalidate_cached("file",
+                                       destination_id + "/" + file_name)
+        if cur_file is not None and overwrite is False:
+            raise RuntimeError("File: {} exists, but overwrite is not set"
+                               .format(file_name))
+
+        mime_type = guess_type(file_name)[0]
+        if not mime_type:
+            mime_type = 'application/octet-stream'
+        metadata = {'name': file_name, 'kind': "FILE",
+                    'parents': [destination_id]}
+
+        # The body is rebuilt for every try, hashing what is actually sent
+        file_hashes = []
+
+        def get_body():
+            file_hash = hashlib.md5()
+            file_hashes.append(file_hash)
+            form = aiohttp.FormData()
+            if cur_file is None:
+                form.add_field('metadata', json.dumps(metadata))
+            form.add_field('content', self.read_file(file_path, file_hash,
+                                                     progress),
+                           filename=file_name, content_type=mime_type)
+            return form
+
+        cur_attempt = 1
+        while True:
+            if cur_file is None:
+                url = (self.service.content_url +
+                       "/nodes?suppress=deduplication")
+                response = await self.http_request(
+                    url, "POST", status_codes=(requests.codes.created,),
+                    data=get_body, use_access_token=True,
+                    action_string="Upload File", max_tries=10)
+            else:
+                url = (self.service.content_url + "/nodes/" +
+                       cur_file['id'] + "/content")
+                response = await self.http_request(
+                    url, "PUT", status_codes=(requests.codes.ok,),
+                    data=get_body, use_access_token=True,
+                    action_string="Upload File Overwrite", max_tries=10)
+
+            new_file = json.loads(await response.text())
+            server_hash = new_file['contentProperties']['md5'].lower()
+            if file_hashes[-1].hexdigest() == server_hash:
+                print("{} successfully uploaded".format(file_name))
+                return new_file
+            if cur_attempt >= self.NUM_ATTEMPTS:
+                raise HashMismatch("Hash of uploaded file does "
+                                   "not match server.")
+            cur_attempt += 1
+            logger.warning("Hash of uploaded file does "
+                           "not match server.  Attempting again")
+            # The bad copy is replaced on the next attempt
+            cur_file = new_file
@@ -0,0 +1,264 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+import urllib.parse
+
+import requests
+
+from asyncstorageservice import AsyncStorageService, HashMismatch
+from onedrivestorageservice import OneDriveStorageService
+
+
+class AsyncOneDriveStorageService(AsyncStorageService):
+
+    service_name = "onedrive"
+    sync_service_class = OneDriveStorageService
+    hash_type = 'sha1'
+
+    # Item URL for a path, with suffix (e.g. ":/children") appended
+    def get_path_url(self, item_path, suffix=""):
+        url_root = self.service.onedrive_url_root
+        if self.service.__app_folder__:
+            if item_path == "":
+                return url_root + "/drive/special/approot" + suffix[1:]
+            return (url_root + "/drive/special/approot:/" +
+                    urllib.parse.quote(item_path) + suffix)
+        if item_path == "":
+            return url_root + "/drive/root" + suffix[1:]
+        return url_root + "/drive/root:/" + urllib.parse.quote(item_path) + \
+            suffix
+
+    async def get_item(self, item_path=None, item_id=None):
+        logger = logging.getLogger("multidrive")
+
+        if item_path is not None:
+            item_path = item_path.strip('/')
+            cached_item = self.service.get_cached("item", item_path)
+            if cached_item is not None:
+                return cached_item
+            url = self.get_path_url(item_path)
+        else:
+            url = self.service.onedrive_url_root+"/drive/items/" + item_id
+
+        status_codes = (requests.codes.ok,
+                        requests.codes.not_found)
+        response = await self.http_request(url, "GET",
+                                           status_codes=status_codes,
+                                           use_access_token=True,
+                                           action_string="Get Item",
+                                           max_tries=8)
+        if response.status == requests.codes.not_found:
+            logger.info("Item not found: " + str(item_path))
+            return None
+
+        item = json.loads(await response.text())
+        if item_path is not None:
+            self.service.set_cached("item", item_path, item)
+        return item
+
+    async def get_file_by_path(self, file_path):
+        cur_file = await self.get_item(item_path=file_path)
+        if cur_file is None:
+            raise RuntimeError("File {} does not exist".format(file_path))
+        if 'folder' in cur_file:
+            raise RuntimeError("Remote destination is a folder")
+        return cur_file
+
+    async def is_folder(self, folder_path):
+        result = await self.get_item(item_path=folder_path)
+        if result is None:
+            return False
+        return "folder" in result
+
+    # Only needed once per folder, so the synchronous version is used
+    async def create_folder(self, folder_path):
+        return await self.run_sync(self.service.create_folder, folder_path)
+
+    async def get_listing_root(self, folder_path):
+        if folder_path is None:
+            folder_path = ""
+        folder_path = folder_path.strip('/')
+        base_folder = await self.get_item(item_path=folder_path)
+        if base_folder is None or "folder" not in base_folder:
+            raise RuntimeError("Invalid folder: "+folder_path)
+        return folder_path
+
+    async def get_folder_children(self, current_path):
+        print("Getting listing for {}".format(current_path))
+        url = self.get_path_url(current_path.strip('/'), ":/children")
+
+        status_codes = (requests.codes.ok,
+                        requests.codes.not_found)
+
+        children = []
+        while url is not None:
+            response = await self.http_request(url, "GET",
+                                               status_codes=status_codes,
+                                               use_access_token=True,
+                                               action_string="Get Folder "
+                                               "Listing",
+                                               max_tries=8)
+            if response.status == requests.codes.not_found:
+                raise RuntimeError("Item not found. Possible bad path: " +
+                                   current_path)
+
+            data = json.loads(await response.text())
+            children.extend(data['value'])
+            url = data.get('@odata.nextLink')
+        return children
+
+    async def open_content(self, cur_file):
+        url = (self.service.onedrive_url_root+"/drive/items/" +
+               cur_file['id']+"/content")
+        severe_status_codes = (requests.codes.bandwidth_limit_exceeded,
+                               requests.codes.service_unavailable)
+        return await self.http_request(url, "GET",
+                                       status_codes=(requests.codes.ok,),
+                                       severe_status_codes=severe_status_codes,
+                                       use_access_token=True,
+                                       action_string="Download file",
+                                       max_tries=10, stream=True)
+
+    async def get_file_hash(self, file):
+        # API documentation states that hashes may not be available until
+        # after Item is downloaded
+        if 'sha1Hash' not in file['file'].get('hashes', {}):
+            file = await self.get_item(item_id=file['id'])
+        return ('sha1', file['file']['hashes']['sha1Hash'].lower())
+
+    async def upload_file(self, file_path, destination=None,
+                          modified_time=None, create_folder=False,
+                          overwrite=False, progress=None):
+        logger = logging.getLogger("multidrive")
+        logger.info("Upload {} OneDrive Storage Service".format(file_path))
+
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        full_remote_path = file_name
+        if destination is not None:
+            destination = destination.strip('/')
+            if await self.is_folder(destination) is False:
+                if create_folder is False:
+                    raise RuntimeError("Destination folder not valid")
+                await self.create_folder(destination)
+            full_remote_path = destination+"/"+file_name
+
+        if self.service.skip_identical is True:
+            existing_file = await self.get_item(item_path=full_remote_path)
+            if existing_file is not None and await self.run_sync(
+                    self.service.is_identical, file_path, existing_file):
+                print("{} is unchanged, skipping".format(file_name))
+                return existing_file
+
+        # The cached metadata of the file is stale once it's replaced
+        self.service.invalidate_cached("item", full_remote_path)
+
+        payload = {"@name.conflictBehavior": "fail"}
+        if overwrite is True:
+            payload["@name.conflictBehavior"] = "replace"
+
+        # Special case for empty file
+        if file_size == 0:
+            response = await self.http_request(
+                self.get_path_url(full_remote_path, ":/content"), "PUT",
+                status_codes=(requests.codes.ok, requests.codes.created,
+                              requests.codes.accepted,
+                              requests.codes.conflict),
+                data=b"", params=payload,
+                use_access_token=True, action_string="Upload")
+            if response.status == requests.codes.conflict:
+                raise RuntimeError("File already exists")
+            return json.loads(await response.text())
+
+        cur_attempt = 1
+        while True:
+            response = await self.http_request(
+                self.get_path_url(full_remote_path, ":/upload.createSession"),
+                "POST", status_codes=(requests.codes.ok,),
+                headers={'Content-Type': "application/json"},
+                data=json.dumps(payload), use_access_token=True,
+                action_string="Upload")
+            url = json.loads(await response.text())['uploadUrl']
+
+            file_hash = hashlib.sha1()
+            chunk_size = self.service.INITIAL_CHUNK_SIZE
+            chunk_start = 0
+            if progress is not None:
+                progress.reset()
+            with open(file_path, "rb") as f:
+                while chunk_start < file_size:
+                    chunk_data = await self.run_sync(f.read, chunk_size)
+                    file_hash.update(chunk_data)
+                    response = await self.upload_chunk(url, chunk_data,
+                                                       chunk_start, file_size)
+                    chunk_start += len(chunk_data)
+                    if progress is not None:
+                        progress.update(chunk_start)
+
+            data = json.loads(await response.text())
+            server_hash = data.get('file', {}).get('hashes', {}).get(
+                'sha1Hash', "None")
+            if file_hash.hexdigest() == server_hash.lower():
+                print("Upload of file {} complete".format(file_name))
+                return data
+            if cur_attempt >= self.NUM_ATTEMPTS:
+                raise HashMismatch("Hash of uploaded file does "
+                                   "not match server.")
+            cur_attempt += 1
+            logger.warning("Hash of uploaded file does "
+                           "not match server.  Attempting again")
+            # If it doesn't match, we need to replace the existing file now
+            payload["@name.conflictBehavior"] = "replace"
+
+    # Sends one fragment.  If the server already has part of it, only the
+    # rest is sent.
+    async def upload_chunk(self, url, chunk_data, chunk_start, file_size):
+        status_codes = (requests.codes.ok,
+                        requests.codes.created,
+                        requests.codes.accepted,
+                        requests.codes.conflict,
+                        requests.codes.range_not_satisfiable)
+        chunk_data = memoryview(chunk_data)
+        while True:
+            chunk_end = chunk_start + len(chunk_data) - 1
+            headers = {'Content-Range': 'bytes {}-{}/{}'.format(
+                chunk_start, chunk_end, file_size)}
+            response = await self.http_request(
+                url, "PUT", status_codes=status_codes,
+                headers=headers, data=chunk_data,
+                use_access_token=True, action_string="Upload Chunk")
+            if response.status == requests.codes.conflict:
+                raise RuntimeError("File Already Exists")
+            if response.status != requests.codes.range_not_satisfiable:
+                return response
+
+            status_response = await self.http_request(
+                url, "GET", status_codes=(requests.codes.ok,),
+                use_access_token=True,
+                action_string="Get upload status", max_tries=10)
+            upload_status = json.loads(await status_response.text())
+            new_start = int(upload_status['nextExpectedRanges'][0]
+                            .split("-")[0])
+            if not chunk_start < new_start <= chunk_end:
+                raise RuntimeError("Unexpected upload status: " +
+                                   str(upload_status))
+            chunk_data = chunk_data[new_start - chunk_start:]
+            chunk_start = new_start
@@ -0,0 +1,369 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+from abc import ABCMeta, abstractmethod
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import time
+
+import aiohttp
+from dateutil.parser import parse
+
+from durability import preallocate
+from folderlister import AsyncFolderLister
+from ratelimiter import get_rate_limiter
+from requestmetrics import get_body_size
+
+
+class RemoteConnectionError(RuntimeError):
+    pass
+
+
+class HashMismatch(RuntimeError):
+    pass
+
+
+# asyncio version of StorageService.  Requests are made with aiohttp on the
+# running event loop, so any number of listings and transfers can be in
+# flight without a thread for each.
+#
+# Each async service wraps the synchronous service of the same kind
+# (sync_service_class), which is still used for authorization and the
+# metadata cache, and for the few operations only needed once per folder
+# or per run.  Those run in the loop's default executor.  Configure the
+# wrapped service (e.g. with multidrive.configure_service) before calling
+# authorize().
+class AsyncStorageService(object):
+    __metaclass__ = ABCMeta
+
+    service_name = None
+    sync_service_class = None
+    # hashlib name of the hash the service reports for files
+    hash_type = None
+
+    CHUNK_SIZE = 1024*1024
+    NUM_ATTEMPTS = 5
+
+    def __init__(self):
+        self.service = self.sync_service_class()
+        self.client_session = None
+
+    def run_sync(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, functools.partial(func, *args,
+                                                            **kwargs))
+
+    async def authorize(self):
+        await self.run_sync(self.service.authorize)
+
+    # The token is only refreshed about once an hour, so this is called
+    # directly rather than in a thread.  It also means concurrent requests
+    # don't all refresh an expired token at once.
+    def get_access_token(self):
+        return self.service.get_access_token()
+
+    async def refresh_access_token(self):
+        await self.run_sync(self.service.refresh_access_token)
+
+    # Shared keep-alive connection pool, sized like the wrapped service's
+    def get_client_session(self):
+        if self.client_session is None:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.service.http_pool_size)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=60,
+                                            sock_read=120)
+            self.client_session = aiohttp.ClientSession(connector=connector,
+                                                        timeout=timeout)
+        return self.client_session
+
+    async def close(self):
+        if self.client_session is not None:
+            await self.client_session.close()
+            self.client_session = None
+
+    # Same retry behaviour as the synchronous services' http_request.  data
+    # may be a function returning the request body, which is called again
+    # for every attempt.  Unless stream is set, the body of the response is
+    # read before it's returned.
+    async def http_request(self, url, method, status_codes=(), headers=None,
+                           data=None, params=None, severe_status_codes=(),
+                           use_access_token=False, action_string="HTTP",
+                           max_tries=6, stream=False):
+        logger = logging.getLogger("multidrive")
+        session = self.get_client_session()
+        # Shared with the synchronous requests to the service
+        limiter = self.service.get_request_limiter()
+        started = time.monotonic()
+        bytes_sent = 0
+        bytes_received = 0
+
+        tries = 0
+        while True:
+            request_headers = {} if headers is None else dict(headers)
+            if use_access_token is True:
+                request_headers['Authorization'] = ("Bearer " +
+                                                    self.get_access_token())
+            body = data() if callable(data) else data
+            await limiter.acquire_async()
+            attempt_started = time.monotonic()
+            first_byte = None
+            try:
+                response = await session.request(method, url,
+                                                 headers=request_headers,
+                                                 data=body, params=params)
+                first_byte = time.monotonic() - attempt_started
+                # Only attempts that got a response count as sent
+                bytes_sent += get_body_size(body)
+                if stream is False or response.status not in status_codes:
+                    bytes_received += len(await response.read())
+                    response.release()
+                else:
+                    # Read by the caller
+                    bytes_received += response.content_length or 0
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                logger.warning("{}: {}".format(action_string, err))
+                response = None
+
+            if response is not None and response.status in status_codes:
+                limiter.succeeded()
+                self.service.record_request(action_string, response.status,
+                                            True, tries, bytes_sent,
+                                            bytes_received, first_byte,
+                                            started)
+                return response
+            if tries >= max_tries:
+                break
+
+            tries += 1
+            logger.warning("Retry " + str(tries))
+            sleep_length = float(1 << tries) / 2
+            if response is not None:
+                logger.warning("{}: Connection failed Code: {}"
+                               .format(action_string, str(response.status)))
+                logger.warning("Error: {}".format(await response.text()))
+                # The limiter holds every request to the service while
+                # it's throttled, including the next attempt
+                if self.service.check_throttled(response.status,
+                                                response.headers,
+                                                sleep_length):
+                    sleep_length = 0
+                elif response.status in severe_status_codes:
+                    logger.warning("Server Error, increasing wait time")
+                    sleep_length *= 20
+
+            if sleep_length > 0:
+                logger.warning("Waiting {} second(s) for next attempt"
+                               .format(str(sleep_length)))
+                await asyncio.sleep(sleep_length)
+            # Force refresh of token once in case it's expired
+            if tries == 1 and use_access_token is True:
+                await self.refresh_access_token()
+
+        self.service.record_request(action_string,
+                                    None if response is None
+                                    else response.status, False, tries,
+                                    bytes_sent, bytes_received, first_byte,
+                                    started)
+        if response is None:
+            raise RemoteConnectionError("{}: Unable to complete request."
+                                        .format(action_string))
+        logger.warning("{}: Connection failed Code: {}"
+                       .format(action_string, str(response.status)))
+        logger.warning("Error: {}".format(await response.text()))
+        raise RemoteConnectionError("{}: Unable to complete request."
+                                    .format(action_string))
+
+    # Asynchronous generator of (item, path_list), like
+    # StorageService.list_folder
+    async def list_folder(self, folder_path):
+        root_handle = await self.get_listing_root(folder_path)
+        rate_limiter = get_rate_limiter(self.service_name + "/listing",
+                                        self.service.listing_rate)
+        lister = AsyncFolderLister(self.get_folder_children,
+                                   self.service.get_child_folder,
+                                   self.get_file_name,
+                                   jobs=self.service.listing_jobs,
+                                   rate_limiter=rate_limiter)
+        async for result in lister.list(root_handle):
+            yield result
+
+    async def download(self, file_path, destination=None, overwrite=False):
+        cur_file = await self.get_file_by_path(file_path)
+        return await self.download_item(cur_file, destination, overwrite)
+
+    async def download_item(self, cur_file, destination=None,
+                            overwrite=False, create_folder=False):
+        logger = logging.getLogger("multidrive")
+        local_path = self.get_file_name(cur_file)
+        if destination is not None:
+            local_path = os.path.join(destination, local_path)
+        last_modified = self.get_modified_time(cur_file)
+
+        if self.is_folder_from_file_type(cur_file):
+            if not os.path.exists(local_path):
+                os.mkdir(local_path)
+            return (local_path, last_modified)
+        if os.path.isdir(local_path):
+            raise RuntimeError("Local destination is a folder")
+        if overwrite is False and os.path.isfile(local_path):
+            raise RuntimeError("Local file {} exists.  Enable overwrite "
+                               "option to continue.".format(local_path))
+
+        with self.service.track_progress(self.get_file_name(cur_file),
+                                         self.get_file_size(cur_file),
+                                         'download') as progress:
+            cur_attempt = 1
+            while True:
+                try:
+                    local_hash = await self.download_content(cur_file,
+                                                             local_path,
+                                                             progress)
+                    (hash_type,
+                     remote_hash) = await self.get_file_hash(cur_file)
+                    if local_hash == remote_hash:
+                        break
+                    if cur_attempt >= self.NUM_ATTEMPTS:
+                        raise HashMismatch("Hash of downloaded file does "
+                                           "not match server.")
+                    logger.warning("Hash of downloaded file does "
+                                   "not match server.  Attempting again")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    if cur_attempt >= self.NUM_ATTEMPTS:
+                        raise
+                    logger.warning("Download of {} failed: {}.  Attempting "
+                                   "again".format(local_path, err))
+                    await asyncio.sleep(float(1 << cur_attempt) / 2)
+                cur_attempt += 1
+
+        modified_date = parse(last_modified)
+        os.utime(local_path, (time.mktime(modified_date.timetuple()),
+                              time.mktime(modified_date.timetuple())))
+
+        print(local_path + " has been saved to disk")
+        return (local_path, last_modified)
+
+    # Streams the file to local_path + ".part", renamed once complete, and
+    # returns its hash_type hash.  Writes are done in the executor so a slow
+    # disk doesn't hold up the other transfers on the loop.  The file is
+    # synced according to the service's durability policy.  progress is
+    # the FileProgress of the download, or None.
+    async def download_content(self, cur_file, local_path, progress=None):
+        part_path = local_path + ".part"
+        # Ranges recorded by an interrupted synchronous download don't
+        # apply once the part is rewritten
+        if os.path.exists(part_path + ".json"):
+            os.remove(part_path + ".json")
+
+        file_hash = hashlib.new(self.hash_type)
+        if progress is not None:
+            progress.reset()
+        response = await self.open_content(cur_file)
+        try:
+            with open(part_path, "wb") as f:
+                if self.service.preallocate is True:
+                    await self.run_sync(preallocate, f.fileno(),
+                                        self.get_file_size(cur_file))
+                async for chunk in response.content.iter_chunked(
+                        self.CHUNK_SIZE):
+                    file_hash.update(chunk)
+                    await self.run_sync(f.write, chunk)
+                    if progress is not None:
+                        progress.add(len(chunk))
+                await self.run_sync(f.flush)
+                await self.run_sync(self.service.durability.file_written,
+                                    f.fileno())
+        finally:
+            response.release()
+        os.replace(part_path, local_path)
+        self.service.durability.file_complete(local_path)
+        return file_hash.hexdigest()
+
+    # Reads a local file in the executor, updating file_hash with what's
+    # read, for use as a streaming request body.  progress, a FileProgress,
+    # is updated with each chunk.
+    async def read_file(self, file_path, file_hash, progress=None):
+        if progress is not None:
+            progress.reset()
+        with open(file_path, "rb") as f:
+            while True:
+                chunk = await self.run_sync(f.read, self.CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                file_hash.update(chunk)
+                if progress is not None:
+                    progress.add(len(chunk))
+                yield chunk
+
+    async def get_file_hash(self, file):
+        return self.service.get_file_hash(file)
+
+    def get_file_name(self, file):
+        return self.service.get_file_name(file)
+
+    def get_file_size(self, file):
+        return self.service.get_file_size(file)
+
+    def get_modified_time(self, file):
+        return self.service.get_modified_time(file)
+
+    def is_folder_from_file_type(self, file):
+        return self.service.is_folder_from_file_type(file)
+
+    # Handle of folder_path passed to get_folder_children
+    @abstractmethod
+    async def get_listing_root(self, folder_path):
+        pass
+
+    @abstractmethod
+    async def get_folder_children(self, handle):
+        pass
+
+    # Streaming aiohttp response for the content of cur_file
+    @abstractmethod
+    async def open_content(self, cur_file):
+        pass
+
+    async def upload(self, file_path, destination=None, modified_time=None,
+                     create_folder=False, overwrite=False):
+        with self.service.track_progress(os.path.basename(file_path),
+                                         os.path.getsize(file_path),
+                                         'upload') as progress:
+            return await self.upload_file(file_path, destination,
+                                          modified_time, create_folder,
+                                          overwrite, progress)
+
+    # Does the upload, updating progress (a FileProgress or None)
+    @abstractmethod
+    async def upload_file(self, file_path, destination=None,
+                          modified_time=None, create_folder=False,
+                          overwrite=False, progress=None):
+        pass
+
+    @abstractmethod
+    async def get_file_by_path(self, file_path):
+        pass
+
+    @abstractmethod
+    async def is_folder(self, folder_path):
+        pass
+
+    @abstractmethod
+    async def create_folder(self, folder_path):
+        pass
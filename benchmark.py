@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from fakecloud import FakeOneDriveServer, FakeCloudDriveServer, \
+    FakeGoogleDriveServer
+from transferscheduler import TransferScheduler
+
+FAKE_SERVERS = {'onedrive': FakeOneDriveServer,
+                'clouddrive': FakeCloudDriveServer,
+                'googledrive': FakeGoogleDriveServer}
+OPERATIONS = ('upload', 'list', 'download', 'copy')
+# Remote folder the files are uploaded to and copied to
+BENCH_FOLDER = "bench"
+COPY_FOLDER = "copy"
+
+
+# The services are imported here so a service whose libraries aren't
+# installed can be skipped
+def get_storage_service(service_name):
+    if service_name == 'onedrive':
+        from onedrivestorageservice import OneDriveStorageService
+        return OneDriveStorageService()
+    elif service_name == 'clouddrive':
+        from clouddrivestorageservice import CloudDriveStorageService
+        return CloudDriveStorageService()
+    elif service_name == 'googledrive':
+        from googledrivestorageservice import GoogleDriveStorageService
+        return GoogleDriveStorageService()
+    return None
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+# Results of one operation against one or two fake servers.  Each call
+# (usually one file) is timed, and the requests the servers answered
+# while the operation ran are counted by route.
+class OperationResult(object):
+
+    def __init__(self, service_name, operation, servers):
+        self.service_name = service_name
+        self.operation = operation
+        self.servers = servers
+        self.log_start = [len(server.log) for server in servers]
+        self.latencies = []
+        self.files = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.log_end = None
+        self.started = time.monotonic()
+        self.seconds = None
+
+    def add(self, seconds, num_bytes, files=1):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.bytes += num_bytes
+            self.files += files
+
+    def finish(self):
+        self.seconds = time.monotonic() - self.started
+        self.log_end = [len(server.log) for server in self.servers]
+
+    def get_requests(self):
+        requests = []
+        for (server, start, end) in zip(self.servers, self.log_start,
+                                        self.log_end):
+            requests.extend(server.log[start:end])
+        return requests
+
+    def to_dict(self):
+        requests = self.get_requests()
+        routes = {}
+        for (route, status, seconds, received, sent) in requests:
+            routes[route] = routes.get(route, 0) + 1
+        return {'service': self.service_name,
+                'operation': self.operation,
+                'files': self.files, 'bytes': self.bytes,
+                'seconds': self.seconds,
+                'throughput': self.bytes / self.seconds
+                if self.seconds > 0 else 0.0,
+                'requests': len(requests),
+                'throttled': sum(1 for request in requests
+                                 if request[1] == 429),
+                'routes': routes,
+                'latency': {'p50': percentile(self.latencies, 0.5),
+                            'p90': percentile(self.latencies, 0.9),
+                            'p99': percentile(self.latencies, 0.99),
+                            'max': max(self.latencies or [0.0])}}
+
+
+def timed(result, call, num_bytes, files=1):
+    started = time.monotonic()
+    value = call()
+    result.add(time.monotonic() - started, num_bytes, files)
+    return value
+
+
+def create_local_files(local_path, num_files, size, seed):
+    generator = random.Random(seed)
+    folder = os.path.join(local_path, BENCH_FOLDER)
+    os.mkdir(folder)
+    file_paths = []
+    for index in range(num_files):
+        file_path = os.path.join(folder, "file{:05d}.bin".format(index))
+        with open(file_path, "wb") as f:
+            f.write(generator.getrandbits(8 * size).to_bytes(size, 'little'))
+        file_paths.append(file_path)
+    return file_paths
+
+
+def configure_service(args, service):
+    service.download_connections = args.connections[0]
+    service.http_pool_size = max(10, args.jobs[0] *
+                                 (args.connections[0] + 1) + 4)
+    if args.listrate is not None:
+        service.listing_rate = args.listrate[0]
+    if args.requestrate is not None:
+        service.max_request_rate = args.requestrate[0]
+
+
+def list_files(service):
+    return [cur_file for (cur_file, path)
+            in service.list_folder(BENCH_FOLDER)
+            if not service.is_folder_from_file_type(cur_file)]
+
+
+def run_upload(service_name, service, server, file_paths):
+    result = OperationResult(service_name, 'upload', [server])
+    for file_path in file_paths:
+        timed(result, lambda: service.upload(file_path,
+                                             destination=BENCH_FOLDER,
+                                             create_folder=True,
+                                             overwrite=True),
+              os.path.getsize(file_path))
+    result.finish()
+    return result
+
+
+def run_list(service_name, service, server, runs):
+    result = OperationResult(service_name, 'list', [server])
+    for _ in range(runs):
+        started = time.monotonic()
+        num_files = len(list_files(service))
+        result.add(time.monotonic() - started, 0, num_files)
+    result.finish()
+    return result
+
+
+def run_download(service_name, service, server, local_path):
+    remote_files = list_files(service)
+    result = OperationResult(service_name, 'download', [server])
+    for cur_file in remote_files:
+        timed(result, lambda: service.download_item(cur_file,
+                                                    destination=local_path,
+                                                    overwrite=True),
+              service.get_file_size(cur_file))
+    result.finish()
+    return result
+
+
+def run_copy(source_name, source, source_server, destination_name,
+             destination, destination_server, jobs):
+    remote_files = list_files(source)
+    destination.create_folder(COPY_FOLDER)
+    result = OperationResult(source_name + ">" + destination_name, 'copy',
+                             [source_server, destination_server])
+    scheduler = TransferScheduler(source, destination, jobs=jobs,
+                                  overwrite=True, create_folder=True)
+    try:
+        for cur_file in remote_files:
+            started = time.monotonic()
+            size = source.get_file_size(cur_file)
+            scheduler.submit(cur_file, COPY_FOLDER,
+                             on_complete=lambda item, started=started,
+                             size=size: result.add(time.monotonic() -
+                                                   started, size))
+        scheduler.join()
+    finally:
+        scheduler.close()
+    result.finish()
+    return result
+
+
+def print_results(results):
+    print("{:<24} {:<9} {:>6} {:>9} {:>8} {:>8} {:>8} {:>5} {:>8} {:>8} "
+          "{:>8}".format("Service", "Operation", "Files", "MB", "Seconds",
+                         "MB/s", "Requests", "429s", "p50 ms", "p90 ms",
+                         "p99 ms"))
+    for result in results:
+        print("{:<24} {:<9} {:>6} {:>9.2f} {:>8.2f} {:>8.2f} {:>8} {:>5} "
+              "{:>8.1f} {:>8.1f} {:>8.1f}"
+              .format(result['service'], result['operation'],
+                      result['files'], result['bytes'] / 1048576.0,
+                      result['seconds'],
+                      result['throughput'] / 1048576.0,
+                      result['requests'], result['throttled'],
+                      result['latency']['p50'] * 1000,
+                      result['latency']['p90'] * 1000,
+                      result['latency']['p99'] * 1000))
+    print("")
+    print("Requests by route:")
+    for result in results:
+        print("  {} {}: {}".format(
+            result['service'], result['operation'],
+            ", ".join("{} {}".format(route, count) for (route, count)
+                      in sorted(result['routes'].items()))))
+
+
+# Runs the operations against a fake server for each service, then copies
+# from each service to the next.  Service output is hidden unless verbose.
+def run_benchmark(args):
+    logger = logging.getLogger("multidrive")
+    operations = [operation.lower() for operation in args.operations]
+    local_path = tempfile.mkdtemp()
+    servers = {}
+    services = {}
+    results = []
+    quiet = (contextlib.redirect_stdout(io.StringIO())
+             if args.verbose is False else contextlib.nullcontext())
+    try:
+        file_paths = create_local_files(local_path, args.files[0],
+                                        args.size[0], args.seed[0])
+        download_path = os.path.join(local_path, "downloads")
+        os.mkdir(download_path)
+        for service_name in args.services:
+            service_name = service_name.lower()
+            try:
+                service = get_storage_service(service_name)
+            except ImportError as err:
+                logger.warning("Skipping {}: {}".format(service_name, err))
+                continue
+            if service is None:
+                raise ValueError("Unknown service: " + service_name)
+            server = FAKE_SERVERS[service_name](
+                latency=args.latency[0] / 1000.0,
+                bandwidth=(args.bandwidth[0] * 1048576
+                           if args.bandwidth[0] > 0 else None),
+                throttle_rate=args.throttle[0],
+                retry_after=args.retryafter[0], seed=args.seed[0])
+            server.start()
+            servers[service_name] = server
+            print("Benchmarking {} on {}".format(service_name, server.url))
+
+            # A service that fails is left out of the rest of the report
+            try:
+                configure_service(args, service)
+                server.connect(service)
+                with quiet:
+                    if 'upload' in operations:
+                        results.append(run_upload(service_name, service,
+                                                  server, file_paths))
+                    else:
+                        for file_path in file_paths:
+                            with open(file_path, "rb") as f:
+                                server.store.add_file(
+                                    BENCH_FOLDER + "/" +
+                                    os.path.basename(file_path), f.read())
+                    if 'list' in operations:
+                        results.append(run_list(service_name, service,
+                                                server, args.listruns[0]))
+                    if 'download' in operations:
+                        cur_path = os.path.join(download_path, service_name)
+                        os.mkdir(cur_path)
+                        results.append(run_download(service_name, service,
+                                                    server, cur_path))
+            except Exception:
+                logger.exception("Benchmark of {} failed"
+                                 .format(service_name))
+                continue
+            services[service_name] = service
+
+        names = list(services.keys())
+        if 'copy' in operations:
+            for (source_name, destination_name) in zip(names, names[1:]):
+                print("Benchmarking copy from {} to {}"
+                      .format(source_name, destination_name))
+                try:
+                    with quiet:
+                        results.append(run_copy(
+                            source_name, services[source_name],
+                            servers[source_name], destination_name,
+                            services[destination_name],
+                            servers[destination_name], args.jobs[0]))
+                except Exception:
+                    logger.exception("Benchmark of copy from {} to {} "
+                                     "failed".format(source_name,
+                                                     destination_name))
+    finally:
+        for server in servers.values():
+            server.stop()
+        shutil.rmtree(local_path)
+    return [result.to_dict() for result in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure transfers to '
+                                     'local stand-ins for the cloud '
+                                     'storage services')
+    parser.add_argument('-s', '--services', nargs='+',
+                        default=list(FAKE_SERVERS.keys()),
+                        choices=list(FAKE_SERVERS.keys()),
+                        help='services to benchmark (default all).  Files '
+                        'are copied from each service to the next')
+    parser.add_argument('-a', '--operations', nargs='+',
+                        default=list(OPERATIONS), choices=OPERATIONS,
+                        help='operations to run (default all)')
+    parser.add_argument('-f', '--files', nargs=1, type=int, default=[20],
+                        help='number of files (default 20)')
+    parser.add_argument('-z', '--size', nargs=1, type=int,
+                        default=[1048576],
+                        help='size of each file in bytes (default 1MiB)')
+    parser.add_argument('--latency', nargs=1, type=float, default=[20.0],
+                        help='milliseconds the servers wait before '
+                        'answering each request (default 20)')
+    parser.add_argument('--bandwidth', nargs=1, type=float, default=[0.0],
+                        help='MiB per second sent and received on each '
+                        'connection (default unlimited)')
+    parser.add_argument('--throttle', nargs=1, type=float, default=[0.0],
+                        help='fraction of requests answered with 429 Too '
+                        'Many Requests (default 0)')
+    parser.add_argument('--retryafter', nargs=1, type=int, default=[0],
+                        help='Retry-After seconds of throttled requests '
+                        '(default 0)')
+    parser.add_argument('--listruns', nargs=1, type=int, default=[5],
+                        help='number of times the folder is listed '
+                        '(default 5)')
+    parser.add_argument('-n', '--connections', nargs=1, type=int,
+                        default=[4],
+                        help='number of connections each file is '
+                        'downloaded over (default 4)')
+    parser.add_argument('-j', '--jobs', nargs=1, type=int, default=[4],
+                        help='number of files copied in parallel '
+                        '(default 4)')
+    parser.add_argument('--listrate', nargs=1, type=float,
+                        help='maximum number of folder listings per second '
+                        'for each service')
+    parser.add_argument('--requestrate', nargs=1, type=float,
+                        help='maximum number of requests per second to '
+                        'each service')
+    parser.add_argument('--seed', nargs=1, type=int, default=[0],
+                        help='seed for the file contents and throttled '
+                        'requests (default 0)')
+    parser.add_argument('-o', '--output', nargs=1,
+                        help='also write the results to this JSON file')
+    parser.add_argument('-v', '--verbose',
+                        help='show the output of the services',
+                        action='store_true')
+    parser.add_argument('-b', '--debug', help="enable debug logging",
+                        action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    if args.debug is True:
+        logging.getLogger("multidrive").setLevel(logging.DEBUG)
+
+    results = run_benchmark(args)
+    print("")
+    print_results(results)
+    if args.output is not None:
+        with open(args.output[0], "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+
+
+# Local state for incremental listings.  For every listed remote folder
+# (feed_key) it keeps the change feed cursor returned by the service, and
+# an index of the folders below it (id -> (parent id, name)) since change
+# feeds report parent ids rather than paths.
+#
+# scope identifies what the listing is used for (e.g. the download
+# destination), so listing a folder for one purpose doesn't hide its
+# changes from another.
+class ChangeFeedState(object):
+
+    def __init__(self, path, scope=""):
+        self.scope = scope
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS feed_cursors "
+                        "(feed_key TEXT PRIMARY KEY, cursor TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS feed_folders "
+                        "(feed_key TEXT, id TEXT, parent_id TEXT, "
+                        "name TEXT, PRIMARY KEY (feed_key, id))")
+        self.db.commit()
+
+    def get_cursor(self, feed_key):
+        feed_key = self.scope + "|" + feed_key
+        with self.lock:
+            row = self.db.execute("SELECT cursor FROM feed_cursors WHERE "
+                                  "feed_key = ?", (feed_key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def load_folders(self, feed_key):
+        feed_key = self.scope + "|" + feed_key
+        with self.lock:
+            rows = self.db.execute("SELECT id, parent_id, name FROM "
+                                   "feed_folders WHERE feed_key = ?",
+                                   (feed_key,)).fetchall()
+        return dict((row[0], (row[1], row[2])) for row in rows)
+
+    # Records the new cursor and folder index once the listing has been
+    # consumed.  They are only written by commit(), which is called once
+    # the action using the listing succeeded, so an interrupted run sees
+    # the same changes again next time.
+    def save(self, feed_key, cursor, folders):
+        feed_key = self.scope + "|" + feed_key
+        with self.lock:
+            self.pending[feed_key] = (cursor, dict(folders))
+
+    def commit(self):
+        with self.lock:
+            for (feed_key, (cursor, folders)) in self.pending.items():
+                self.db.execute("DELETE FROM feed_folders WHERE "
+                                "feed_key = ?", (feed_key,))
+                self.db.executemany("INSERT INTO feed_folders VALUES "
+                                    "(?, ?, ?, ?)",
+                                    [(feed_key, folder_id, parent_id, name)
+                                     for (folder_id, (parent_id, name))
+                                     in folders.items()])
+                self.db.execute("INSERT OR REPLACE INTO feed_cursors "
+                                "VALUES (?, ?)", (feed_key, cursor))
+            self.db.commit()
+            self.pending = {}
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+def get_path_list(folders, parent_id, base_id):
+    path_list = []
+    seen = set()
+    while parent_id != base_id:
+        if parent_id not in folders or parent_id in seen:
+            return None
+        seen.add(parent_id)
+        (parent_id, name) = folders[parent_id]
+        path_list.append(name)
+    path_list.reverse()
+    return path_list
+
+
+# Applies a batch of changes to the folder index and returns the changed
+# items below base_id as sorted (item, path_list) tuples, so folders come
+# before their contents.
+#
+# changes is a list of (item_id, parent_ids, name, is_folder, is_deleted,
+# item).  Deleted items are dropped from the index but not returned.
+def apply_changes(folders, base_id, changes):
+    for (item_id, parent_ids, name, is_folder,
+         is_deleted, item) in changes:
+        if item_id == base_id:
+            continue
+        if is_deleted is True or is_folder is False:
+            folders.pop(item_id, None)
+        elif len(parent_ids) > 0:
+            folders[item_id] = (parent_ids[0], name)
+            # Prefer a parent that is below base_id
+            for parent_id in parent_ids:
+                if (parent_id == base_id or
+                        get_path_list(folders, parent_id,
+                                      base_id) is not None):
+                    folders[item_id] = (parent_id, name)
+                    break
+
+    result_list = []
+    for (item_id, parent_ids, name, is_folder,
+         is_deleted, item) in changes:
+        if item_id == base_id or is_deleted is True:
+            continue
+        for parent_id in parent_ids:
+            path_list = get_path_list(folders, parent_id, base_id)
+            if path_list is not None:
+                result_list.append((item, path_list, name))
+                break
+
+    result_list.sort(key=lambda result: result[1] + [result[2]])
+    return [(item, path_list) for (item, path_list, name) in result_list]
@@ -26,23 +26,22 @@ import os
 import logging
 from mimetypes import guess_type
 
-from requests_toolbelt import MultipartEncoder
 import time
 
-from storageservice import StorageService
+from storageservice import StorageService, ItemDoesNotExistError
+from multipartbody import MultipartBody
 from enum import Enum
-import hashlib
 
 
-class ItemDoesNotExistError(RuntimeError):
+class WrongTypeError(RuntimeError):
     pass
 
 
-class WrongTypeError(RuntimeError):
+class RemoteConnectionError(RuntimeError):
     pass
 
 
-class RemoteConnectionError(RuntimeError):
+class HashMismatch(RuntimeError):
     pass
 
 
@@ -52,29 +51,6 @@ class RequestType(Enum):
     POST = 2
 
 
-class HashFile(object):
-    def set_file(self, cur_file):
-        self.file = cur_file
-        self.cur_file_hash = hashlib.md5()
-        self.calculate_len()
-
-    def calculate_len(self):
-        pos = self.file.tell()
-        self.file.seek(0, os.SEEK_END)
-        self.len = self.file.tell()-pos
-        self.file.seek(pos, os.SEEK_SET)
-
-    def read(self, *args):
-        chunk = self.file.read(*args)
-        if len(chunk) > 0:
-            self.cur_file_hash.update(chunk)
-        self.calculate_len()
-        return chunk
-
-    def get_md5(self):
-        return self.cur_file_hash.hexdigest()
-
-
 class UTC(datetime.tzinfo):
     """UTC"""
 
@@ -90,12 +66,17 @@ class UTC(datetime.tzinfo):
 
 class CloudDriveStorageService(StorageService):
 
+    service_name = "clouddrive"
+
     cloud_drive_url_root = "https://drive.amazonaws.com"
     cloud_drive_end_point = None
     content_url = None
     metadata_url = None
     root_folder = None
 
+    # Hash uploads on a separate thread while they're being sent
+    upload_hash_thread = True
+
     def authorize(self):
         logger = logging.getLogger("multidrive")
         logger.debug("Authorize Cloud Drive Storage Service")
@@ -112,48 +93,37 @@ class CloudDriveStorageService(StorageService):
         self.load_end_points()
         self.load_root_folder()
 
-    def http_request(self, url, request_type, status_codes=(), headers={},
-                     stream=False, data="", params=None,
+    def http_request(self, url, request_type, status_codes=(),
+                     headers=None, stream=False, data="", params=None,
                      severe_status_codes=(),
                      use_access_token=False, action_string="OneDrive HTTP",
-                     max_tries=6,
-                     use_multipart_encoder=False,
-                     multipart_encoder_fields=None,
-                     multipart_encoder_content=None,
-                     multipart_hash_file=None):
+                     max_tries=6):
         logger = logging.getLogger("multidrive")
+        session = self.get_session()
+        limiter = self.get_request_limiter()
+        started = time.monotonic()
 
+        # Copy the headers, requests may be made from several threads
+        headers = {} if headers is None else dict(headers)
         if use_access_token is True:
             headers['Authorization'] = "Bearer " + self.get_access_token()
 
-        if use_multipart_encoder is True:
-            cur_multipart_file = open(multipart_encoder_content[1], 'rb')
-            multipart_hash_file.set_file(cur_multipart_file)
-            cur_multipart_content = ('content', (multipart_encoder_content[0],
-                                                 multipart_hash_file,
-                                                 multipart_encoder_content[2]))
-            multipart_encoder_fields.append(cur_multipart_content)
-            data = MultipartEncoder(fields=multipart_encoder_fields)
-            headers["Content-Type"] = data.content_type
-
+        limiter.acquire()
         try:
             if request_type == RequestType.GET:
-                response = requests.get(url, headers=headers, params=params,
-                                        stream=stream)
+                response = session.get(url, headers=headers, params=params,
+                                       stream=stream)
             elif request_type == RequestType.PUT:
-                response = requests.put(url, headers=headers, data=data,
-                                        params=params)
+                response = session.put(url, headers=headers, data=data,
+                                       params=params)
             elif request_type == RequestType.POST:
-                response = requests.post(url, headers=headers, data=data)
-            if use_multipart_encoder is True:
-                logger.info("Current hash: "+multipart_hash_file.get_md5())
+                response = session.post(url, headers=headers, data=data)
         except requests.exceptions.ConnectionError as err:
             logger.warning("ConnectionError: {}".format(err))
             response = None
-        finally:
-            if use_multipart_encoder is True:
-                cur_multipart_file.close()
 
+        # Attempts that got a response, and so sent the body
+        responses = 0 if response is None else 1
         tries = 0
         while response is None or (response.status_code not in status_codes
                                    and tries < max_tries):
@@ -168,18 +138,19 @@ class CloudDriveStorageService(StorageService):
                 logger.warning("Error: {}".format(response.text))
                 logger.warning("Headers: {}".format(str(response.headers)))
 
-                if 'Retry-After' in response.headers:
-                    logger.warning("Server requested wait of {} seconds".
-                                   format(response.headers['Retry-After']))
-                    sleep_length = int(response.headers['Retry-After'])
+                # The limiter holds every request to the service while
+                # it's throttled, including the next attempt
+                if self.check_throttled(response.status_code,
+                                        response.headers, sleep_length):
+                    sleep_length = 0
                 elif response.status_code in severe_status_codes:
                     logger.warning("Server Error, increasing wait time")
                     sleep_length *= 20
 
-            logger.warning("Waiting {} second(s) for next attempt"
-                           .format(str(sleep_length)))
-
-            time.sleep(sleep_length)
+            if sleep_length > 0:
+                logger.warning("Waiting {} second(s) for next attempt"
+                               .format(str(sleep_length)))
+                time.sleep(sleep_length)
             # Force refresh of token once in case it's expired
             if (tries == 1):
                 self.refresh_access_token()
@@ -187,33 +158,25 @@ class CloudDriveStorageService(StorageService):
             if use_access_token is True:
                 headers['Authorization'] = "Bearer " + self.get_access_token()
 
-            if use_multipart_encoder is True:
-                cur_multipart_file = open(multipart_encoder_content[1], 'rb')
-                multipart_hash_file.set_file(cur_multipart_file)
-                cur_multipart_content = ('content',
-                                         (multipart_encoder_content[0],
-                                          multipart_hash_file,
-                                          multipart_encoder_content[2]))
-                multipart_encoder_fields.append(cur_multipart_content)
-                data = MultipartEncoder(fields=multipart_encoder_fields)
-
+            limiter.acquire()
             try:
                 if request_type == RequestType.GET:
-                    response = requests.get(url, headers=headers,
-                                            params=params, stream=stream)
+                    response = session.get(url, headers=headers,
+                                           params=params, stream=stream)
                 elif request_type == RequestType.PUT:
-                    response = requests.put(url, headers=headers, data=data,
-                                            params=params)
+                    response = session.put(url, headers=headers, data=data,
+                                           params=params)
                 elif request_type == RequestType.POST:
-                    response = requests.post(url, headers=headers, data=data)
+                    response = session.post(url, headers=headers, data=data)
             except requests.exceptions.ConnectionError as err:
                 logger.warning("ConnectionError: {}".format(err))
                 response = None
-            finally:
-                if use_multipart_encoder is True:
-                    cur_multipart_file.close()
+            if response is not None:
+                responses += 1
 
         if response is None:
+            self.record_response(action_string, None, False, tries, data,
+                                 responses, started)
             raise RemoteConnectionError("{}: Unable to complete request."
                                         .format(action_string))
         if response.status_code not in status_codes:
@@ -222,9 +185,14 @@ class CloudDriveStorageService(StorageService):
             logger.warning("Error: {}".format(response.text))
             logger.warning("Headers: {}".format(str(response.headers)))
             logger.warning("Retry " + str(tries))
+            self.record_response(action_string, response, False, tries, data,
+                                 responses, started, stream)
             raise RemoteConnectionError("{}: Unable to complete request."
                                         .format(action_string))
 
+        limiter.succeeded()
+        self.record_response(action_string, response, True, tries, data,
+                             responses, started, stream)
         return response
 
     def get_tokens_from_code(self, code):
@@ -349,19 +317,64 @@ class CloudDriveStorageService(StorageService):
         logger = logging.getLogger("multidrive")
         logger.debug("Upload {} Cloud Drive Storage Service".format(file_path))
 
+        file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        with self.track_progress(file_name, file_size, 'upload') as progress:
+            return self.upload_fileobj(lambda: open(file_path, 'rb'),
+                                       file_name, file_size,
+                                       destination=destination,
+                                       create_folder=create_folder,
+                                       overwrite=overwrite,
+                                       local_path=file_path,
+                                       progress=progress)
+
+    def upload_stream(self, stream, file_name, file_size, destination=None,
+                      modified_time=None, create_folder=False,
+                      overwrite=False):
+        logger = logging.getLogger("multidrive")
+        logger.debug("Upload stream {} Cloud Drive Storage Service"
+                     .format(file_name))
+
+        # A stream can only be read once, so the caller retries with a new
+        # stream on failure.
+        with self.track_progress(file_name, file_size, 'upload') as progress:
+            return self.upload_fileobj(stream.open, file_name, file_size,
+                                       destination=destination,
+                                       create_folder=create_folder,
+                                       overwrite=overwrite, num_attempts=1,
+                                       max_tries=0, progress=progress)
+
+    # open_file is called for every attempt and should return a new file
+    # object positioned at the start of the file_size bytes of data.
+    # local_path is the path of the local file, if any, for skip_identical.
+    # progress is the FileProgress of the upload, or None.
+    def upload_fileobj(self, open_file, file_name, file_size,
+                       destination=None, create_folder=False,
+                       overwrite=False, num_attempts=5, max_tries=10,
+                       local_path=None, progress=None):
+        logger = logging.getLogger("multidrive")
+
         destination_id = self.root_folder
         if destination is not None and destination != "":
             destination_id = self.get_folder(self.root_folder,
                                              destination,
                                              create_folder)
 
-        file_name = os.path.basename(file_path)
         cur_file = self.get_file(destination_id, file_name)
-        cur_hash_file = HashFile()
+        if (cur_file is not None and local_path is not None and
+                self.skip_identical is True and
+                self.is_identical(local_path, cur_file)):
+            print("{} is unchanged, skipping".format(file_name))
+            return cur_file
+        # The cached metadata of the file is stale once it's replaced
+        self.invalidate_cached("file", destination_id + "/" + file_name)
+
+        mime_type = guess_type(file_name)[0]
+        if not mime_type:
+            mime_type = 'application/octet-stream'
 
-        NUM_ATTEMPTS = 5
         cur_attempt = 1
-        while cur_attempt <= NUM_ATTEMPTS:
+        while cur_attempt <= num_attempts:
 
             if cur_file is None:
                 url = self.content_url + "/nodes?suppress=deduplication"
@@ -371,24 +384,21 @@ class CloudDriveStorageService(StorageService):
                 metadata['kind'] = "FILE"
                 metadata['parents'] = [destination_id]
 
-                mime_type = guess_type(file_path)[0]
-                if not mime_type:
-                    mime_type = 'application/octet-stream'
-
-                fields = [('metadata', ("", json.dumps(metadata)))]
-                content = (file_name, file_path, mime_type)
-
+                body = MultipartBody([('metadata', json.dumps(metadata))],
+                                     'content', file_name, open_file,
+                                     file_size, mime_type,
+                                     hash_in_thread=self.upload_hash_thread,
+                                     progress=progress)
                 response = self.http_request(url=url,
                                              request_type=RequestType.POST,
                                              status_codes=(requests.codes.
                                                            created,),
+                                             headers={'Content-Type':
+                                                      body.content_type},
+                                             data=body,
                                              use_access_token=True,
                                              action_string="Upload File",
-                                             max_tries=10,
-                                             use_multipart_encoder=True,
-                                             multipart_encoder_fields=fields,
-                                             multipart_encoder_content=content,
-                                             multipart_hash_file=cur_hash_file)
+                                             max_tries=max_tries)
             else:
                 if overwrite is False:
                     raise RuntimeError("File: {} exists, but "
@@ -396,50 +406,56 @@ class CloudDriveStorageService(StorageService):
                                        .format(file_name))
                 url = self.content_url + "/nodes/"+cur_file['id']+"/content"
 
-                mime_type = guess_type(file_path)[0]
-                if not mime_type:
-                    mime_type = 'application/octet-stream'
-
-                content = (file_name, file_path, mime_type)
-                cur_hash_file = HashFile()
+                body = MultipartBody([], 'content', file_name, open_file,
+                                     file_size, mime_type,
+                                     hash_in_thread=self.upload_hash_thread,
+                                     progress=progress)
                 response = self.http_request(url=url,
                                              request_type=RequestType.PUT,
                                              status_codes=(requests.codes.ok,),
+                                             headers={'Content-Type':
+                                                      body.content_type},
+                                             data=body,
                                              use_access_token=True,
                                              action_string="Upload File "
                                                            "Overwrite",
-                                             max_tries=10,
-                                             use_multipart_encoder=True,
-                                             multipart_encoder_fields=[],
-                                             multipart_encoder_content=content,
-                                             multipart_hash_file=cur_hash_file)
+                                             max_tries=max_tries)
+            logger.info("Current hash: " + body.get_md5())
 
-            server_hash = json.loads(response.text)['contentProperties']['md5']
+            new_file = json.loads(response.text)
+            server_hash = new_file['contentProperties']['md5']
 
             cur_attempt += 1
-            if (cur_hash_file.get_md5() == server_hash.lower()):
+            if (body.get_md5() == server_hash.lower()):
                 break
             logger.warning("Hash of uploaded file does "
                            "not match server.  Attempting again")
 
-        if (cur_hash_file.get_md5() != server_hash.lower()):
-            raise RuntimeError("Hash of uploaded file does "
+        if (body.get_md5() != server_hash.lower()):
+            raise HashMismatch("Hash of uploaded file does "
                                "not match server.")
 
         print("{} successfully uploaded".format(file_name))
+        return new_file
 
     def get_folder(self, cur_folder, folder_path, create=False):
         if folder_path.endswith('/'):
             folder_path = folder_path[:-1]
 
         split_path = folder_path.split('/')
-        # cur_path = cur_folder
-        # print "Path: "+ str(split_path)
+        # Cache keys are relative to the folder the lookup starts from
+        cur_path = cur_folder + ":"
         create_rest = False
         while len(split_path) > 0:
             cur_item = split_path.pop(0)
+            cur_path += "/" + cur_item
             data = None
             if create_rest is False:
+                cached_id = self.get_cached("folder", cur_path)
+                if cached_id is not None:
+                    cur_folder = cached_id
+                    continue
+
                 params = urllib.parse.urlencode({'filters': 'name:'
                                                 + cur_item.replace(" ", "\ ")})
                 url = self.metadata_url + '/nodes/' + cur_folder + '/children'
@@ -465,25 +481,9 @@ class CloudDriveStorageService(StorageService):
                                                 "exist and createfolder is "
                                                 "not set.".format(cur_item))
                 create_rest = True
-                url = self.metadata_url + "/nodes"
-
-                metadata = {}
-                metadata['name'] = cur_item
-                metadata['kind'] = "FOLDER"
-                metadata['parents'] = [cur_folder]
-
-                data = json.dumps(metadata)
-
-                response = self.http_request(url=url,
-                                             request_type=RequestType.POST,
-                                             status_codes=(requests.codes.
-                                                           created,),
-                                             use_access_token=True,
-                                             data=data,
-                                             action_string='Create Folder')
-
-                data = json.loads(response.text)
-                cur_folder = data['id']
+                cur_folder = self.create_child_folder(cur_folder,
+                                                      cur_item)['id']
+                self.set_cached("folder", cur_path, cur_folder)
             elif len(data['data']) > 1:
                 raise RuntimeError("Error: Multiple items with name: " +
                                    cur_item)
@@ -492,10 +492,55 @@ class CloudDriveStorageService(StorageService):
                     raise WrongTypeError("Error: {} is not a folder."
                                          .format(cur_item))
                 cur_folder = data['data'][0]['id']
+                self.set_cached("folder", cur_path, cur_folder)
 
         return cur_folder
 
+    def create_child_folder(self, parent_id, name):
+        url = self.metadata_url + "/nodes"
+
+        metadata = {}
+        metadata['name'] = name
+        metadata['kind'] = "FOLDER"
+        metadata['parents'] = [parent_id]
+
+        response = self.http_request(url=url,
+                                     request_type=RequestType.POST,
+                                     status_codes=(requests.codes.created,),
+                                     use_access_token=True,
+                                     data=json.dumps(metadata),
+                                     action_string='Create Folder')
+        return json.loads(response.text)
+
+    def get_folder_id(self, folder_path):
+        if len(folder_path.strip('/')) == 0:
+            return self.root_folder
+        return self.get_folder(self.root_folder, folder_path, create=False)
+
+    def cache_folder(self, folder_path, item):
+        self.set_cached("folder", self.root_folder + ":/" +
+                        folder_path.strip('/'), item['id'])
+
+    # Cloud Drive has no batch requests, so folders are created one at a
+    # time
+    def create_folders(self, folders):
+        return [self.create_child_folder(parent_id, name)
+                for (parent_id, name) in folders]
+
     def get_file(self, folder_id, file_name):
+        cached_file = self.get_cached("file", folder_id + "/" + file_name)
+        if cached_file is not None:
+            return cached_file
+
+        prefetched = self.take_prefetched_file(folder_id, file_name)
+        if prefetched is None:
+            return None
+        if prefetched is not False:
+            if prefetched['kind'] != "FILE":
+                raise RuntimeError("Error: {} exists, but is not a file."
+                                   .format(file_name))
+            return prefetched
+
         params = urllib.parse.urlencode({'filters': 'name:' +
                                         file_name.replace(" ", "\ ")})
 
@@ -520,10 +565,16 @@ class CloudDriveStorageService(StorageService):
             raise RuntimeError("Error: {} exists, but is not a file."
                                .format(file_name))
 
+        self.set_cached("file", folder_id + "/" + file_name, data['data'][0])
         return data['data'][0]
 
     def download(self, file_path, destination=None, overwrite=False):
         print("Download {} Cloud Drive Storage Service".format(file_path))
+        cur_file = self.get_file_by_path(file_path)
+        return self.download_item(cur_file, destination, overwrite=overwrite,
+                                  create_folder=False)
+
+    def get_file_by_path(self, file_path):
         (folder, file_name) = os.path.split(file_path)
 
         if folder is None or folder == "":
@@ -534,9 +585,9 @@ class CloudDriveStorageService(StorageService):
         cur_file = self.get_file(folder, file_name)
 
         if cur_file is None:
-            raise RuntimeError("File {} does not exist".format(file_path))
-        return self.download_item(cur_file, destination, overwrite=overwrite,
-                                  create_folder=False)
+            raise ItemDoesNotExistError("File {} does not exist"
+                                        .format(file_path))
+        return cur_file
 
     def download_item(self, cur_file, destination=None, overwrite=False,
                       create_folder=False):
@@ -563,39 +614,17 @@ class CloudDriveStorageService(StorageService):
         NUM_ATTEMPTS = 5
         cur_attempt = 1
         while cur_attempt <= NUM_ATTEMPTS:
-            f = open(local_path, "wb")
-
-            url = self.content_url+"/nodes/"+cur_file['id']+"/content"
-            logger.info("URL to save file is: "+url)
-
-            response = self.http_request(url=url,
-                                         request_type=RequestType.GET,
-                                         status_codes=(requests.codes.ok,),
-                                         use_access_token=True,
-                                         stream=True,
-                                         action_string='Download Item')
-
-            size = 0
-            cur_file_hash = hashlib.md5()
-            for chunk in response.iter_content(chunk_size=4*1024*1024):
-                if chunk:  # filter out keep-alive new chunks
-                    cur_file_hash.update(chunk)
-                    f.write(chunk)
-                    f.flush()
-                    size += 1
-                    if size % 100 == 0:
-                        logger.info(str(size*4) + "MB written")
-            os.fsync(f.fileno())
-            f.close()
+            cur_file_hash = self.download_content(cur_file, local_path,
+                                                  'md5')
 
             cur_attempt += 1
-            if (remote_hash == (cur_file_hash.hexdigest())):
+            if (remote_hash == cur_file_hash):
                 break
             logger.warning("Hash of downloaded file does "
                            "not match server.  Attempting again")
 
-        if (remote_hash != (cur_file_hash.hexdigest())):
-            raise RuntimeError("Hash of downloaded file does "
+        if (remote_hash != cur_file_hash):
+            raise HashMismatch("Hash of downloaded file does "
                                "not match server.")
 
         lastModifiedDateTimeString = cur_file['modifiedDate']
@@ -609,7 +638,27 @@ class CloudDriveStorageService(StorageService):
         # TODO: deal with return values.
         return (local_path, lastModifiedDateTimeString)
 
+    def open_content(self, cur_file, byte_range=None):
+        logger = logging.getLogger("multidrive")
+        url = self.content_url+"/nodes/"+cur_file['id']+"/content"
+        logger.info("URL to save file is: "+url)
+
+        status_codes = (requests.codes.ok,)
+        headers = None
+        if byte_range is not None:
+            status_codes = (requests.codes.ok, requests.codes.partial_content)
+            headers = {'Range': "bytes={}-{}".format(*byte_range)}
+        return self.http_request(url=url,
+                                 request_type=RequestType.GET,
+                                 status_codes=status_codes,
+                                 headers=headers,
+                                 use_access_token=True,
+                                 stream=True,
+                                 action_string='Download Item')
+
     def create_folder(self, folder_path):
+        self.invalidate_cached("folder", self.root_folder + ":/" +
+                               folder_path.strip('/'), descendants=True)
         self.get_folder(self.root_folder, folder_path, create=True)
 
     def is_folder(self, folder_path):
@@ -633,12 +682,21 @@ class CloudDriveStorageService(StorageService):
                                           folder_path,
                                           create=False)
         print("Getting listing for {}".format(folder_path))
-        folder_list = self.get_folder_listing(base_folder, [])
+        folder_list = self.get_folder_listing(base_folder)
         return folder_list
 
-    def get_folder_listing(self, cur_folder, path_list):
+    def get_folder_listing(self, cur_folder):
+        lister = self.get_folder_lister(self.get_folder_children,
+                                        self.get_child_folder)
+        return lister.list(cur_folder)
+
+    def get_child_folder(self, current_item, parent):
+        if current_item['kind'] == "FOLDER":
+            return current_item['id']
+        return None
+
+    def get_folder_children(self, cur_folder):
         logger = logging.getLogger("multidrive")
-        result_list = []
 
         url = self.metadata_url + '/nodes/' + cur_folder + '/children'
         params = {}
@@ -669,20 +727,20 @@ class CloudDriveStorageService(StorageService):
             params['startToken'] = cur_response['nextToken']
 
         data.sort(key=lambda cur_file: cur_file['name'])
-
-        for current_item in data:
-            result_list.append((current_item, path_list))
-            if current_item['kind'] == "FOLDER":
-                new_list = list(path_list)
-                new_list.append(current_item['name'])
-                result_list.extend(self.get_folder_listing(
-                    current_item['id'], new_list))
-
-        return result_list
+        return data
 
     def get_file_name(self, file):
         return file['name']
 
+    def get_file_size(self, file):
+        return int(file['contentProperties']['size'])
+
+    def get_file_hash(self, file):
+        return ('md5', file['contentProperties']['md5'].lower())
+
+    def get_modified_time(self, file):
+        return file['modifiedDate']
+
     def is_folder_from_file_type(self, file):
         return file['kind'] == "FOLDER"
 
@@ -0,0 +1,134 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+
+DURABILITY_MODES = ('none', 'file', 'batch')
+
+
+# When downloaded files are flushed to disk with fsync.
+#
+# none:  never, the operating system writes them back in its own time.
+# file:  each file before it's renamed into place, so a file that exists
+#        under its final name is complete even after a crash.
+# batch: files are synced batch_files at a time by a background thread,
+#        and the rest when the policy is closed at the end of the run.
+#        Downloads don't wait for the disk, and by the time a batch is
+#        synced most of it has usually been written back already, which
+#        matters on network storage where each fsync is a round trip.
+#
+# With none and batch, files renamed into place shortly before a crash
+# may be incomplete.  Partial downloads that will be resumed are synced
+# whenever their progress is recorded, whatever the mode.
+class DurabilityPolicy(object):
+
+    def __init__(self, mode='file', batch_files=100):
+        if mode not in DURABILITY_MODES:
+            raise ValueError("Unknown durability mode: " + str(mode))
+        self.mode = mode
+        self.batch_files = batch_files
+        self.lock = threading.Lock()
+        self.pending = []
+        self.syncer = None
+
+    # Called with the open file once all of it has been written
+    def file_written(self, fd):
+        if self.mode == 'file':
+            os.fsync(fd)
+
+    # Called once the file has been renamed to path
+    def file_complete(self, path):
+        if self.mode != 'batch':
+            return
+        with self.lock:
+            self.pending.append(path)
+            if len(self.pending) < self.batch_files:
+                return
+            batch = self.pending
+            self.pending = []
+            previous = self.syncer
+            self.syncer = threading.Thread(target=sync_batch,
+                                           args=(previous, batch))
+            self.syncer.daemon = True
+            self.syncer.start()
+
+    # Syncs the files not synced yet and waits for them
+    def close(self):
+        with self.lock:
+            batch = self.pending
+            self.pending = []
+            syncer = self.syncer
+            self.syncer = None
+        sync_batch(syncer, batch)
+
+
+# At most one batch is synced at a time, so each batch's thread waits for
+# the previous one rather than the download that filled it
+def sync_batch(previous, paths):
+    if previous is not None:
+        previous.join()
+    sync_files(paths)
+
+
+# fsyncs each of the files, then the folders they're in so their names are
+# durable too
+def sync_files(paths):
+    logger = logging.getLogger("multidrive")
+    if len(paths) == 0:
+        return
+    logger.debug("Syncing {} downloaded file(s)".format(len(paths)))
+    folders = set()
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as err:
+            logger.warning("Unable to sync {}: {}".format(path, err))
+        folders.add(os.path.dirname(os.path.abspath(path)))
+    for folder in folders:
+        try:
+            fd = os.open(folder, os.O_RDONLY)
+        except OSError:
+            # Folders can't be opened on Windows
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+# Reserves size bytes of disk for the open file fd, so it's allocated in as
+# few pieces as possible and a full disk is noticed before downloading.
+# Returns whether space was reserved; where posix_fallocate isn't supported
+# the file is just extended to size.
+def preallocate(fd, size):
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return True
+        except OSError as err:
+            logging.getLogger("multidrive").debug(
+                "Unable to preallocate: {}".format(err))
+    os.ftruncate(fd, size)
+    return False
@@ -0,0 +1,1163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+from abc import ABCMeta, abstractmethod
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# HTTP server on a local port, run on its own thread by start() or with
+# the server as a context manager.  Requests are handled by handler_class,
+# whose server_state is set to the LocalServer.
+class LocalServer(object):
+
+    def __init__(self, handler_class, host="127.0.0.1", port=0):
+        self.thread = None
+
+        local_server = self
+
+        class Handler(handler_class):
+            server_state = local_server
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = "http://{}:{}".format(*self.server.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+# Local HTTP server replaying recorded responses, so listings and change
+# feeds can be exercised without a real account.  Point a service at it
+# with onedrive_url_root (OneDrive) or discovery_url and drive_url_root
+# (Google Drive).
+#
+# A recording is a list of exchanges:
+#
+#   {"method": "GET", "path": "/drive/root:/Docs:/view.delta",
+#    "query": {"token": "abc"}, "status": 200, "headers": {},
+#    "body": {...}}
+#
+# A request matches an exchange if the method and path are equal and every
+# recorded query parameter has the same value.  Matching exchanges are
+# served in order, and the last one keeps being served once the others are
+# used up.  "{root}" in a body is replaced with the server's URL, so
+# recorded next page links point back at the server.
+class ReplayServer(LocalServer):
+
+    def __init__(self, exchanges, host="127.0.0.1", port=0):
+        self.exchanges = list(exchanges)
+        self.used = [False] * len(self.exchanges)
+        self.requests = []
+        self.lock = threading.Lock()
+        LocalServer.__init__(self, ReplayRequestHandler, host=host,
+                             port=port)
+
+    @classmethod
+    def load(cls, recording_path, host="127.0.0.1", port=0):
+        with open(recording_path) as recording_file:
+            return cls(json.load(recording_file), host=host, port=port)
+
+    def find_exchange(self, method, path, query):
+        with self.lock:
+            self.requests.append((method, path, query))
+            last_match = None
+            for (index, exchange) in enumerate(self.exchanges):
+                if exchange.get('method', 'GET') != method:
+                    continue
+                if urllib.parse.unquote(exchange['path']) != path:
+                    continue
+                if any(query.get(key) != str(value) for (key, value)
+                       in exchange.get('query', {}).items()):
+                    continue
+                if not self.used[index]:
+                    self.used[index] = True
+                    return exchange
+                last_match = exchange
+            return last_match
+
+    def get_body(self, exchange):
+        body = exchange.get('body', "")
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        return body.replace("{root}", self.url).encode('utf-8')
+
+
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+
+    server_state = None
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            self.rfile.read(length)
+
+        split_url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(split_url.path)
+        query = dict(urllib.parse.parse_qsl(split_url.query,
+                                            keep_blank_values=True))
+        exchange = self.server_state.find_exchange(self.command, path,
+                                                   query)
+        if exchange is None:
+            body = json.dumps({'error': "No recorded response for {} {}"
+                               .format(self.command, self.path)})
+            self.send_response(404)
+            self.send_header('Content-Type', "application/json")
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+            return
+
+        body = self.server_state.get_body(exchange)
+        self.send_response(exchange.get('status', 200))
+        headers = exchange.get('headers', {})
+        for (key, value) in headers.items():
+            self.send_header(key, value)
+        if 'Content-Type' not in headers:
+            self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = handle_request
+    do_PUT = handle_request
+    do_POST = handle_request
+    do_PATCH = handle_request
+    do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        logging.getLogger("multidrive").debug("Replay server: " +
+                                              format % args)
+
+
+# A request to a FakeCloudServer.  path is unquoted, query is a dict and
+# headers is the request's headers (case insensitive).
+class FakeRequest(object):
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        if len(self.body) == 0:
+            return {}
+        return json.loads(self.body.decode('utf-8'))
+
+
+# Files and folders held by a FakeCloudServer.  Items are dicts with an id,
+# parent id, name, whether it's a folder, its data and its modified time.
+class FakeStore(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = {}
+        self.next_id = 1
+        self.root = self.add(None, "", True)
+
+    def add(self, parent_id, name, folder, data=b""):
+        with self.lock:
+            item = {'id': "item{}".format(self.next_id),
+                    'parent': parent_id, 'name': name, 'folder': folder}
+            self.next_id += 1
+            self.items[item['id']] = item
+            self.set_data(item, data)
+            return item
+
+    def set_data(self, item, data):
+        with self.lock:
+            item['data'] = bytes(data)
+            item['md5'] = hashlib.md5(item['data']).hexdigest()
+            item['sha1'] = hashlib.sha1(item['data']).hexdigest()
+            item['modified'] = datetime.datetime.utcnow()
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    def children(self, parent_id):
+        with self.lock:
+            return sorted((item for item in self.items.values()
+                           if item['parent'] == parent_id),
+                          key=lambda item: item['name'])
+
+    def find_child(self, parent_id, name):
+        with self.lock:
+            for item in self.items.values():
+                if item['parent'] == parent_id and item['name'] == name:
+                    return item
+        return None
+
+    # The item at the "/" separated path, or None
+    def find_path(self, path):
+        item = self.root
+        for name in path.strip('/').split('/'):
+            if name == "":
+                continue
+            item = self.find_child(item['id'], name)
+            if item is None or item['folder'] is False:
+                return item
+        return item
+
+    # Adds a file at path, creating the folders above it
+    def add_file(self, path, data):
+        with self.lock:
+            names = path.strip('/').split('/')
+            parent = self.root
+            for name in names[:-1]:
+                folder = self.find_child(parent['id'], name)
+                if folder is None:
+                    folder = self.add(parent['id'], name, True)
+                parent = folder
+            return self.add(parent['id'], names[-1], False, data)
+
+
+# Response for a download of data, honouring a Range header
+def content_response(request, data):
+    byte_range = request.headers.get('Range')
+    headers = {'Content-Type': "application/octet-stream"}
+    match = None
+    if byte_range is not None:
+        match = re.match(r"bytes=(\d+)-(\d*)$", byte_range)
+    if match is None:
+        return (200, headers, data)
+    start = int(match.group(1))
+    end = len(data) - 1
+    if match.group(2) != "":
+        end = min(int(match.group(2)), end)
+    if start > end:
+        headers['Content-Range'] = "bytes */{}".format(len(data))
+        return (416, headers, b"")
+    headers['Content-Range'] = "bytes {}-{}/{}".format(start, end, len(data))
+    return (206, headers, data[start:end + 1])
+
+
+# (start, end, total) from a "bytes start-end/total" Content-Range header.
+# start and end are None for "bytes */total", total for ".../*".
+def parse_content_range(value):
+    match = re.match(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)$", value or "")
+    if match is None:
+        return None
+    (start, end, total) = match.groups()
+    return (None if start is None else int(start),
+            None if end is None else int(end),
+            None if total == "*" else int(total))
+
+
+# Splits a multipart body into a list of (headers, content), with header
+# names in lower case.  Lines may end with CRLF or LF alone.
+def split_multipart(body, boundary):
+    parts = []
+    for part in body.split(b"--" + boundary.encode('utf-8'))[1:]:
+        if part.startswith(b"--"):
+            break
+        part = re.sub(br"^\r?\n", b"", part)
+        part = re.sub(br"\r?\n$", b"", part)
+        (head, content) = re.split(br"\r?\n\r?\n", part, 1)
+        headers = {}
+        for line in re.split(br"\r?\n", head):
+            (name, value) = line.decode('utf-8').split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        parts.append((headers, content))
+    return parts
+
+
+def get_boundary(content_type):
+    match = re.search(r'boundary="?([^";]+)"?', content_type or "")
+    if match is None:
+        return None
+    return match.group(1)
+
+
+# Stand-in for a cloud storage service's API on a local port, holding its
+# files in memory (store), for measuring the services' transfers without
+# an account.  Every request waits latency seconds before it's answered,
+# and request and response bodies are sent at up to bandwidth bytes per
+# second on each connection (None for no limit).  A throttle_rate fraction
+# of requests, picked at random, are answered with 429 Too Many Requests
+# and a Retry-After of retry_after seconds.
+#
+# Each request answered is recorded in log as (route, status, seconds,
+# bytes received, bytes to send), where route names the API call and
+# seconds is the time until the response was ready to send.
+#
+# Subclasses implement get_route(request), returning (route, handler) or
+# None for an unknown request, where handler(request) returns (status,
+# headers, body).  A body that isn't bytes is sent as JSON.
+# connect(service) sets up a storage service instance to use the server,
+# in place of authorize().
+class FakeCloudServer(LocalServer, metaclass=ABCMeta):
+
+    # Routes that are never throttled
+    UNTHROTTLED = ()
+
+    def __init__(self, latency=0.0, bandwidth=None, throttle_rate=0.0,
+                 retry_after=0, seed=None, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.store = FakeStore()
+        self.lock = threading.Lock()
+        self.log = []
+        LocalServer.__init__(self, FakeCloudRequestHandler, host=host,
+                             port=port)
+
+    @abstractmethod
+    def get_route(self, request):
+        pass
+
+    @abstractmethod
+    def connect(self, service):
+        pass
+
+    def should_throttle(self, route):
+        if self.throttle_rate <= 0 or route in self.UNTHROTTLED:
+            return False
+        with self.lock:
+            return self.random.random() < self.throttle_rate
+
+    # Returns (route, status, headers, body bytes) for the request
+    def respond(self, request):
+        logger = logging.getLogger("multidrive")
+        route = self.get_route(request)
+        if route is None:
+            (route, status, headers, body) = (
+                "unknown", 404, {},
+                {'error': "Unknown request {} {}".format(request.method,
+                                                         request.path)})
+        elif self.should_throttle(route[0]):
+            (route, status, headers, body) = (
+                route[0], 429, {'Retry-After': str(self.retry_after)},
+                {'error': {'code': "throttledRequest",
+                           'message': "Too many requests"}})
+        else:
+            try:
+                (status, headers, body) = route[1](request)
+            except Exception as err:
+                logger.exception("Fake server error")
+                (status, headers, body) = (500, {}, {'error': str(err)})
+            route = route[0]
+        headers = dict(headers)
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+            headers.setdefault('Content-Type', "application/json")
+        return (route, status, headers, body)
+
+    def record(self, route, status, seconds, received, sent):
+        with self.lock:
+            self.log.append((route, status, seconds, received, sent))
+
+
+class FakeCloudRequestHandler(BaseHTTPRequestHandler):
+
+    # Connections are kept open between requests, like the real services
+    protocol_version = "HTTP/1.1"
+    server_state = None
+    BLOCK_SIZE = 64*1024
+
+    def handle_request(self):
+        state = self.server_state
+        started = time.monotonic()
+        if state.latency > 0:
+            time.sleep(state.latency)
+        body = self.read_body()
+
+        split_url = urllib.parse.urlsplit(self.path)
+        request = FakeRequest(self.command,
+                              urllib.parse.unquote(split_url.path),
+                              dict(urllib.parse.parse_qsl(
+                                  split_url.query, keep_blank_values=True)),
+                              self.headers, body)
+        (route, status, headers, content) = state.respond(request)
+        # Recorded before the client can see the response, so the request
+        # is counted before any request that follows it
+        state.record(route, status, time.monotonic() - started, len(body),
+                     len(content))
+
+        self.send_response(status)
+        for (key, value) in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.write_body(content)
+
+    do_GET = handle_request
+    do_PUT = handle_request
+    do_POST = handle_request
+    do_PATCH = handle_request
+    do_DELETE = handle_request
+
+    # Sleeps while more than bandwidth bytes per second have been
+    # transferred since started
+    def pace(self, transferred, started):
+        bandwidth = self.server_state.bandwidth
+        if bandwidth is None or bandwidth <= 0:
+            return
+        wait = float(transferred) / bandwidth - (time.monotonic() - started)
+        if wait > 0:
+            time.sleep(wait)
+
+    def read_body(self):
+        started = time.monotonic()
+        if self.headers.get('Transfer-Encoding', "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                self.pace(len(body), started)
+        length = int(self.headers.get('Content-Length', 0))
+        blocks = []
+        received = 0
+        while received < length:
+            block = self.rfile.read(min(self.BLOCK_SIZE, length - received))
+            if len(block) == 0:
+                break
+            blocks.append(block)
+            received += len(block)
+            self.pace(received, started)
+        return b"".join(blocks)
+
+    def write_body(self, content):
+        started = time.monotonic()
+        view = memoryview(content)
+        for start in range(0, len(content), self.BLOCK_SIZE):
+            self.wfile.write(view[start:start + self.BLOCK_SIZE])
+            self.pace(start + self.BLOCK_SIZE, started)
+
+    def log_message(self, format, *args):
+        logging.getLogger("multidrive").debug("Fake server: " +
+                                              format % args)
+
+
+# Token given to services connected to a fake server, which accepts any
+FAKE_TOKEN = "fake-access-token"
+
+
+# Sets a service's access token to FAKE_TOKEN, and has refreshing it do the
+# same instead of asking the real service
+def set_fake_token(service):
+    service.set_access_token(FAKE_TOKEN, 3600)
+    service.refresh_access_token = (
+        lambda: service.set_access_token(FAKE_TOKEN, 3600))
+
+
+# OneDrive API under /v1.0: items by path and id, children (a page of
+# PAGE_SIZE at a time), content, folder creation, $batch, and upload
+# sessions.
+class FakeOneDriveServer(FakeCloudServer):
+
+    API_ROOT = "/v1.0"
+    PAGE_SIZE = 200
+
+    def __init__(self, **kwargs):
+        FakeCloudServer.__init__(self, **kwargs)
+        self.sessions = {}
+
+    def connect(self, service):
+        service.onedrive_url_root = self.url + self.API_ROOT
+        service.__app_folder__ = False
+        set_fake_token(service)
+
+    def item_json(self, item):
+        data = {'id': item['id'], 'name': item['name'],
+                'size': len(item['data']),
+                'lastModifiedDateTime':
+                item['modified'].strftime("%Y-%m-%dT%H:%M:%SZ")}
+        if item['parent'] is not None:
+            data['parentReference'] = {'id': item['parent']}
+        if item['folder'] is True:
+            data['folder'] = {'childCount':
+                              len(self.store.children(item['id']))}
+        else:
+            data['file'] = {'hashes': {'sha1Hash': item['sha1'].upper()}}
+        return data
+
+    def error(self, status, code):
+        return (status, {}, {'error': {'code': code, 'message': code}})
+
+    def get_route(self, request):
+        if request.path.startswith("/upload/"):
+            session_id = request.path[len("/upload/"):]
+            if request.method == "PUT":
+                return ("uploadFragment",
+                        lambda request: self.upload_fragment(request,
+                                                             session_id))
+            return ("uploadStatus",
+                    lambda request: self.upload_status(session_id))
+        if not request.path.startswith(self.API_ROOT):
+            return None
+        path = request.path[len(self.API_ROOT):]
+
+        if path == "/$batch" and request.method == "POST":
+            return ("batch", self.batch)
+        if path == "/drive":
+            return ("drive", lambda request: (200, {}, {'quota': {
+                'total': 1 << 40, 'used': 0, 'remaining': 1 << 40,
+                'deleted': 0}}))
+
+        match = re.match(r"/drive/items/([^/:]+)(.*)$", path)
+        if match is not None:
+            item = self.store.get(match.group(1))
+            action = match.group(2)
+            if action.startswith(":/"):
+                item = (self.store.find_child(item['id'], action[2:])
+                        if item is not None else None)
+                action = ""
+            else:
+                action = action.strip('/')
+        elif path == "/drive/root/children":
+            item = self.store.root
+            action = "children"
+        elif path.startswith("/drive/root:"):
+            item_path = path[len("/drive/root:"):]
+            action = ""
+            if ":/" in item_path:
+                (item_path, action) = item_path.rsplit(":/", 1)
+            if action in ("upload.createSession", "content") and \
+                    request.method != "GET":
+                return self.get_upload_route(item_path, action)
+            item = self.store.find_path(item_path)
+        else:
+            return None
+
+        if action == "" and request.method == "GET":
+            return ("item", lambda request: self.get_item(item))
+        elif action == "children" and request.method == "GET":
+            return ("children", lambda request: self.get_children(request,
+                                                                  item))
+        elif action == "children" and request.method == "POST":
+            return ("createFolder",
+                    lambda request: self.create_folder(request, item))
+        elif action == "content" and request.method == "GET":
+            return ("content", lambda request: self.get_content(request,
+                                                                item))
+        return None
+
+    def get_item(self, item):
+        if item is None:
+            return self.error(404, "itemNotFound")
+        return (200, {}, self.item_json(item))
+
+    def get_children(self, request, item):
+        if item is None or item['folder'] is False:
+            return self.error(404, "itemNotFound")
+        children = self.store.children(item['id'])
+        start = int(request.query.get('$skiptoken', 0))
+        data = {'value': [self.item_json(child) for child
+                          in children[start:start + self.PAGE_SIZE]]}
+        if start + self.PAGE_SIZE < len(children):
+            data['@odata.nextLink'] = (
+                self.url + request.path + "?" + urllib.parse.urlencode(
+                    {'$skiptoken': start + self.PAGE_SIZE}))
+        return (200, {}, data)
+
+    def get_content(self, request, item):
+        if item is None or item['folder'] is True:
+            return self.error(404, "itemNotFound")
+        return content_response(request, item['data'])
+
+    def create_folder(self, request, parent):
+        if parent is None or parent['folder'] is False:
+            return self.error(404, "itemNotFound")
+        payload = request.json()
+        with self.store.lock:
+            existing = self.store.find_child(parent['id'], payload['name'])
+            if existing is not None:
+                if payload.get('@name.conflictBehavior', "fail") == "fail":
+                    return self.error(409, "nameAlreadyExists")
+                return (200, {}, self.item_json(existing))
+            item = self.store.add(parent['id'], payload['name'], True)
+        return (201, {}, self.item_json(item))
+
+    def get_upload_route(self, item_path, action):
+        (parent_path, _, name) = item_path.strip('/').rpartition('/')
+        parent = self.store.find_path(parent_path)
+        if action == "content":
+            return ("upload",
+                    lambda request: self.put_content(request, parent, name))
+        return ("createSession",
+                lambda request: self.create_session(request, parent, name))
+
+    # Creates or replaces the file name in parent with data
+    def save_file(self, parent, name, data, replace):
+        with self.store.lock:
+            existing = self.store.find_child(parent['id'], name)
+            if existing is None:
+                item = self.store.add(parent['id'], name, False, data)
+                return (201, {}, self.item_json(item))
+            if replace is False or existing['folder'] is True:
+                return self.error(409, "nameAlreadyExists")
+            self.store.set_data(existing, data)
+            return (200, {}, self.item_json(existing))
+
+    def put_content(self, request, parent, name):
+        if parent is None:
+            return self.error(404, "itemNotFound")
+        behavior = request.query.get('@name.conflictBehavior', "fail")
+        return self.save_file(parent, name, request.body,
+                              behavior == "replace")
+
+    def create_session(self, request, parent, name):
+        if parent is None:
+            return self.error(404, "itemNotFound")
+        replace = (request.json().get('@name.conflictBehavior', "fail") ==
+                   "replace")
+        if replace is False and \
+                self.store.find_child(parent['id'], name) is not None:
+            return self.error(409, "nameAlreadyExists")
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = {'parent': parent, 'name': name,
+                                         'replace': replace,
+                                         'data': bytearray()}
+        return (200, {}, {'uploadUrl': self.url + "/upload/" + session_id})
+
+    def session_status(self, session):
+        return {'nextExpectedRanges': ["{}-".format(len(session['data']))]}
+
+    def upload_status(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return self.error(404, "itemNotFound")
+        return (200, {}, self.session_status(session))
+
+    def upload_fragment(self, request, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return self.error(404, "itemNotFound")
+        content_range = parse_content_range(
+            request.headers.get('Content-Range'))
+        if (content_range is None or content_range[0] is None or
+                content_range[0] != len(session['data']) or
+                content_range[1] - content_range[0] + 1 !=
+                len(request.body)):
+            return self.error(416, "invalidRange")
+        session['data'] += request.body
+        if len(session['data']) < content_range[2]:
+            return (202, {}, self.session_status(session))
+        with self.lock:
+            self.sessions.pop(session_id, None)
+        return self.save_file(session['parent'], session['name'],
+                              session['data'], session['replace'])
+
+    # Runs each request in the batch as if it was sent on its own
+    def batch(self, request):
+        responses = []
+        for sub_request in request.json()['requests']:
+            split_url = urllib.parse.urlsplit(sub_request['url'])
+            body = b""
+            if 'body' in sub_request:
+                body = json.dumps(sub_request['body']).encode('utf-8')
+            (route, status, headers, content) = self.respond(FakeRequest(
+                sub_request['method'],
+                self.API_ROOT + urllib.parse.unquote(split_url.path),
+                dict(urllib.parse.parse_qsl(split_url.query)),
+                sub_request.get('headers', {}), body))
+            responses.append({'id': sub_request['id'], 'status': status,
+                              'headers': headers,
+                              'body': json.loads(content.decode('utf-8'))})
+        return (200, {}, {'responses': responses})
+
+
+# Cloud Drive API: the account endpoint, nodes under /metadata (a page of
+# PAGE_SIZE children at a time, filtered by name) and node content and
+# multipart uploads under /content.
+class FakeCloudDriveServer(FakeCloudServer):
+
+    UNTHROTTLED = ("endpoint",)
+    PAGE_SIZE = 200
+
+    def connect(self, service):
+        service.cloud_drive_url_root = self.url
+        set_fake_token(service)
+        service.load_end_points()
+        service.load_root_folder()
+
+    def node_json(self, item):
+        modified = item['modified'].strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        data = {'id': item['id'], 'name': item['name'],
+                'kind': "FOLDER" if item['folder'] else "FILE",
+                'parents': [] if item['parent'] is None else [item['parent']],
+                'isRoot': item['parent'] is None, 'status': "AVAILABLE",
+                'createdDate': modified, 'modifiedDate': modified}
+        if item['folder'] is False:
+            data['contentProperties'] = {'size': len(item['data']),
+                                         'md5': item['md5']}
+        return data
+
+    def error(self, status, message):
+        return (status, {}, {'message': message})
+
+    def get_route(self, request):
+        path = request.path
+        if path == "/drive/v1/account/endpoint":
+            return ("endpoint", lambda request: (200, {}, {
+                'customerExists': True,
+                'contentUrl': self.url + "/content",
+                'metadataUrl': self.url + "/metadata"}))
+        if path == "/metadata/nodes" and request.method == "GET":
+            return ("nodes", self.get_nodes)
+        if path == "/metadata/nodes" and request.method == "POST":
+            return ("createFolder", self.create_folder)
+        if path == "/content/nodes" and request.method == "POST":
+            return ("upload", self.upload)
+
+        match = re.match(r"/(metadata|content)/nodes/([^/]+)/"
+                         r"(children|content)$", path)
+        if match is None:
+            return None
+        item = self.store.get(match.group(2))
+        if match.group(3) == "children" and request.method == "GET":
+            return ("children", lambda request: self.get_children(request,
+                                                                  item))
+        if match.group(3) == "content" and request.method == "GET":
+            return ("content", lambda request: self.get_content(request,
+                                                                item))
+        if match.group(3) == "content" and request.method == "PUT":
+            return ("overwrite", lambda request: self.overwrite(request,
+                                                                item))
+        return None
+
+    def get_nodes(self, request):
+        if request.query.get('filters') != "isRoot:true":
+            return self.error(400, "Only the root can be looked up")
+        return (200, {}, {'count': 1,
+                          'data': [self.node_json(self.store.root)]})
+
+    def get_children(self, request, item):
+        if item is None or item['folder'] is False:
+            return self.error(404, "Node not found")
+        children = self.store.children(item['id'])
+        filters = request.query.get('filters', "")
+        if filters.startswith("name:"):
+            name = filters[len("name:"):].replace("\\ ", " ")
+            children = [child for child in children if child['name'] == name]
+        start = int(request.query.get('startToken', 0))
+        data = {'count': len(children),
+                'data': [self.node_json(child) for child
+                         in children[start:start + self.PAGE_SIZE]]}
+        if start + self.PAGE_SIZE < len(children):
+            data['nextToken'] = str(start + self.PAGE_SIZE)
+        return (200, {}, data)
+
+    def get_content(self, request, item):
+        if item is None or item['folder'] is True:
+            return self.error(404, "Node not found")
+        return content_response(request, item['data'])
+
+    def create_folder(self, request):
+        metadata = request.json()
+        parent = self.store.get(metadata['parents'][0])
+        if parent is None:
+            return self.error(400, "Parent not found")
+        with self.store.lock:
+            if self.store.find_child(parent['id'],
+                                     metadata['name']) is not None:
+                return self.error(409, "Node already exists")
+            item = self.store.add(parent['id'], metadata['name'], True)
+        return (201, {}, self.node_json(item))
+
+    # The metadata and content fields of a multipart upload
+    def get_upload_fields(self, request):
+        fields = {}
+        boundary = get_boundary(request.headers.get('Content-Type'))
+        for (headers, content) in split_multipart(request.body, boundary):
+            match = re.search(r'name="([^"]*)"',
+                              headers.get('content-disposition', ""))
+            if match is not None:
+                fields[match.group(1)] = content
+        return fields
+
+    def upload(self, request):
+        fields = self.get_upload_fields(request)
+        metadata = json.loads(fields['metadata'].decode('utf-8'))
+        parent = self.store.get(metadata['parents'][0])
+        if parent is None:
+            return self.error(400, "Parent not found")
+        with self.store.lock:
+            if self.store.find_child(parent['id'],
+                                     metadata['name']) is not None:
+                return self.error(409, "Node already exists")
+            item = self.store.add(parent['id'], metadata['name'], False,
+                                  fields['content'])
+        return (201, {}, self.node_json(item))
+
+    def overwrite(self, request, item):
+        if item is None or item['folder'] is True:
+            return self.error(404, "Node not found")
+        self.store.set_data(item, self.get_upload_fields(request)['content'])
+        return (200, {}, self.node_json(item))
+
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+# Drive v2 API as used through google-api-python-client: a discovery
+# document for the methods the service calls, files list (a page of
+# PAGE_SIZE at a time, filtered by parent, title and mimeType), get,
+# insert and update, content downloads, resumable uploads and batch
+# requests.
+class FakeGoogleDriveServer(FakeCloudServer):
+
+    UNTHROTTLED = ("discovery",)
+    PAGE_SIZE = 100
+
+    def __init__(self, **kwargs):
+        FakeCloudServer.__init__(self, **kwargs)
+        self.sessions = {}
+
+    # Needs google-api-python-client, oauth2client and httplib2, like the
+    # service itself
+    def connect(self, service):
+        from apiclient.discovery import build
+        from oauth2client import client
+        from googledrivestorageservice import new_http
+
+        credentials = client.OAuth2Credentials(
+            FAKE_TOKEN, "fake-client", "fake-secret", "fake-refresh",
+            datetime.datetime.utcnow() + datetime.timedelta(days=1),
+            self.url + "/token", "multidrive")
+        service.discovery_url = (self.url +
+                                 "/discovery/v1/apis/{api}/{apiVersion}/rest")
+        service.drive_url_root = self.url + "/drive/v2"
+        service.__credentials__ = credentials
+        service.__service__ = build('drive', 'v2',
+                                    http=credentials.authorize(new_http()),
+                                    discoveryServiceUrl=service.discovery_url,
+                                    cache_discovery=False)
+        service.__local__ = threading.local()
+        service.acknowledged_abuse = set()
+
+    def file_json(self, item):
+        modified = item['modified'].strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        data = {'kind': "drive#file", 'id': item['id'],
+                'title': item['name'], 'labels': {'trashed': False},
+                'createdDate': modified, 'modifiedDate': modified,
+                'parents': [] if item['parent'] is None else
+                [{'id': item['parent'],
+                  'isRoot': item['parent'] == self.store.root['id']}]}
+        if item['folder'] is True:
+            data['mimeType'] = FOLDER_MIME_TYPE
+        else:
+            data['mimeType'] = item.get('mime_type',
+                                        "application/octet-stream")
+            data['fileSize'] = str(len(item['data']))
+            data['md5Checksum'] = item['md5']
+        return data
+
+    def error(self, status, reason):
+        return (status, {}, {'error': {'code': status, 'message': reason,
+                                       'errors': [{'reason': reason,
+                                                   'message': reason}]}})
+
+    def get_item(self, item_id):
+        if item_id == "root":
+            return self.store.root
+        return self.store.get(item_id)
+
+    def get_route(self, request):
+        path = request.path
+        if path == "/discovery/v1/apis/drive/v2/rest":
+            return ("discovery",
+                    lambda request: (200, {}, self.get_discovery()))
+        if path == "/batch/drive/v2" and request.method == "POST":
+            return ("batch", self.batch)
+        if path == "/drive/v2/about" and request.method == "GET":
+            return ("about", lambda request: (200, {}, {
+                'rootFolderId': self.store.root['id'],
+                'quotaType': "LIMITED", 'quotaBytesTotal': str(1 << 40),
+                'quotaBytesUsedAggregate': "0",
+                'quotaBytesUsedInTrash': "0"}))
+        if path == "/drive/v2/files":
+            if request.method == "GET":
+                return ("list", self.list_files)
+            if request.method == "POST":
+                return ("insert", self.insert)
+        if path.startswith("/upload/drive/v2/files"):
+            if 'upload_id' in request.query and request.method == "PUT":
+                return ("uploadChunk", self.upload_chunk)
+            if request.query.get('uploadType') == "resumable":
+                return ("createSession", self.create_session)
+            return None
+        match = re.match(r"/drive/v2/files/([^/]+)$", path)
+        if match is None:
+            return None
+        item = self.get_item(match.group(1))
+        if request.method == "GET" and request.query.get('alt') == "media":
+            return ("content", lambda request: self.get_content(request,
+                                                                item))
+        if request.method == "GET":
+            return ("get", lambda request: self.get_file(item))
+        if request.method in ("PUT", "PATCH"):
+            return ("update", lambda request: self.update(request, item))
+        return None
+
+    def get_file(self, item):
+        if item is None:
+            return self.error(404, "notFound")
+        return (200, {}, self.file_json(item))
+
+    def get_content(self, request, item):
+        if item is None or item['folder'] is True:
+            return self.error(404, "notFound")
+        return content_response(request, item['data'])
+
+    def list_files(self, request):
+        query = request.query.get('q', "")
+        match = re.search(r"'([^']*)' in parents", query)
+        parent = self.get_item(match.group(1)) if match else None
+        if parent is None:
+            return self.error(404, "notFound")
+        children = self.store.children(parent['id'])
+        match = re.search(r"title='((?:[^'\\]|\\.)*)'", query)
+        if match is not None:
+            title = re.sub(r"\\(.)", r"\1", match.group(1))
+            children = [child for child in children
+                        if child['name'] == title]
+        if "mimeType='{}'".format(FOLDER_MIME_TYPE) in query:
+            children = [child for child in children if child['folder']]
+
+        start = int(request.query.get('pageToken', 0))
+        page_size = int(request.query.get('maxResults', self.PAGE_SIZE))
+        data = {'kind': "drive#fileList",
+                'items': [self.file_json(child) for child
+                          in children[start:start + page_size]]}
+        if start + page_size < len(children):
+            data['nextPageToken'] = str(start + page_size)
+        return (200, {}, data)
+
+    # Creates a file or folder from the metadata body, with data
+    def add_file(self, body, data=b""):
+        parent = self.store.root
+        if len(body.get('parents', [])) > 0:
+            parent = self.get_item(body['parents'][0]['id'])
+            if parent is None:
+                return self.error(404, "notFound")
+        item = self.store.add(parent['id'], body['title'],
+                              body.get('mimeType') == FOLDER_MIME_TYPE, data)
+        if 'mimeType' in body and item['folder'] is False:
+            item['mime_type'] = body['mimeType']
+        return (200, {}, self.file_json(item))
+
+    def insert(self, request):
+        return self.add_file(request.json())
+
+    def update(self, request, item):
+        if item is None:
+            return self.error(404, "notFound")
+        body = request.json()
+        if 'title' in body:
+            item['name'] = body['title']
+        return (200, {}, self.file_json(item))
+
+    def create_session(self, request):
+        match = re.match(r"/upload/drive/v2/files/([^/]+)$", request.path)
+        item = None
+        if match is not None:
+            item = self.get_item(match.group(1))
+            if item is None:
+                return self.error(404, "notFound")
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[upload_id] = {'body': request.json(),
+                                        'item': item, 'data': bytearray()}
+        location = (self.url + "/upload/drive/v2/files?" +
+                    urllib.parse.urlencode({'uploadType': "resumable",
+                                            'upload_id': upload_id}))
+        return (200, {'Location': location}, b"")
+
+    # Data received so far, as a 308 Resume Incomplete
+    def session_progress(self, session):
+        headers = {}
+        if len(session['data']) > 0:
+            headers['Range'] = "bytes=0-{}".format(len(session['data']) - 1)
+        return (308, headers, b"")
+
+    def upload_chunk(self, request):
+        session = self.sessions.get(request.query['upload_id'])
+        if session is None:
+            return self.error(404, "notFound")
+        content_range = parse_content_range(
+            request.headers.get('Content-Range'))
+        if content_range is None:
+            return self.error(400, "badContentRange")
+        (start, end, total) = content_range
+        if start is not None:
+            if start != len(session['data']):
+                return self.session_progress(session)
+            session['data'] += request.body
+        if total is None or len(session['data']) < total:
+            return self.session_progress(session)
+        with self.lock:
+            self.sessions.pop(request.query['upload_id'], None)
+        if session['item'] is None:
+            return self.add_file(session['body'], session['data'])
+        self.store.set_data(session['item'], session['data'])
+        return self.update(FakeRequest("PUT", "", {}, {}, json.dumps(
+            session['body']).encode('utf-8')), session['item'])
+
+    # Runs each HTTP request in the multipart/mixed body as if it was sent
+    # on its own, answering with a multipart/mixed body of the responses
+    def batch(self, request):
+        boundary = get_boundary(request.headers.get('Content-Type'))
+        response_boundary = "batch_" + uuid.uuid4().hex
+        body = b""
+        for (headers, content) in split_multipart(request.body, boundary):
+            (head, sub_body) = re.split(br"\r?\n\r?\n", content, 1) \
+                if re.search(br"\r?\n\r?\n", content) else (content, b"")
+            lines = re.split(r"\r?\n", head.decode('utf-8'))
+            (method, url) = lines[0].split(" ")[:2]
+            sub_headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    (name, value) = line.split(":", 1)
+                    sub_headers[name.strip()] = value.strip()
+            split_url = urllib.parse.urlsplit(url)
+            (route, status, response_headers, response_body) = \
+                self.respond(FakeRequest(
+                    method, urllib.parse.unquote(split_url.path),
+                    dict(urllib.parse.parse_qsl(split_url.query)),
+                    sub_headers, sub_body))
+            content_id = headers.get('content-id', "<+>")[1:-1]
+            body += ("--{}\r\nContent-Type: application/http\r\n"
+                     "Content-ID: <response-{}>\r\n\r\nHTTP/1.1 {} {}\r\n"
+                     .format(response_boundary, content_id, status,
+                             "OK" if status < 300 else "Error")
+                     ).encode('utf-8')
+            for (name, value) in response_headers.items():
+                body += "{}: {}\r\n".format(name, value).encode('utf-8')
+            body += b"\r\n" + response_body + b"\r\n"
+        body += "--{}--\r\n".format(response_boundary).encode('utf-8')
+        return (200, {'Content-Type': "multipart/mixed; boundary=" +
+                      response_boundary}, body)
+
+    def get_discovery(self):
+        file_id = {'fileId': {'type': "string", 'required': True,
+                              'location': "path"}}
+        media_upload = {'accept': ["*/*"], 'maxSize': "5120GB",
+                        'protocols': {
+                            'simple': {'multipart': True,
+                                       'path': "/upload/drive/v2/files"},
+                            'resumable': {'multipart': True,
+                                          'path': "/upload/drive/v2/files"}}}
+        update_upload = json.loads(json.dumps(media_upload))
+        for protocol in update_upload['protocols'].values():
+            protocol['path'] += "/{fileId}"
+        schema = {'type': "object", 'properties': {
+            'id': {'type': "string"}, 'title': {'type': "string"}}}
+        return {
+            'kind': "discovery#restDescription", 'id': "drive:v2",
+            'name': "drive", 'version': "v2", 'protocol': "rest",
+            'rootUrl': self.url + "/", 'servicePath': "drive/v2/",
+            'baseUrl': self.url + "/drive/v2/", 'basePath': "/drive/v2/",
+            'batchPath': "batch/drive/v2",
+            'parameters': {'alt': {'type': "string", 'default': "json",
+                                   'location': "query"}},
+            'schemas': {'File': dict(schema, id="File"),
+                        'FileList': dict(schema, id="FileList"),
+                        'About': dict(schema, id="About")},
+            'resources': {
+                'about': {'methods': {'get': {
+                    'id': "drive.about.get", 'path': "about",
+                    'httpMethod': "GET", 'response': {'$ref': "About"}}}},
+                'files': {'methods': {
+                    'list': {'id': "drive.files.list", 'path': "files",
+                             'httpMethod': "GET",
+                             'parameters': {
+                                 'q': {'type': "string",
+                                       'location': "query"},
+                                 'pageToken': {'type': "string",
+                                               'location': "query"},
+                                 'maxResults': {'type': "integer",
+                                                'location': "query"}},
+                             'response': {'$ref': "FileList"}},
+                    'get': {'id': "drive.files.get", 'path': "files/{fileId}",
+                            'httpMethod': "GET", 'parameters': file_id,
+                            'parameterOrder': ["fileId"],
+                            'response': {'$ref': "File"}},
+                    'insert': {'id': "drive.files.insert", 'path': "files",
+                               'httpMethod': "POST",
+                               'request': {'$ref': "File"},
+                               'response': {'$ref': "File"},
+                               'supportsMediaUpload': True,
+                               'mediaUpload': media_upload},
+                    'update': {'id': "drive.files.update",
+                               'path': "files/{fileId}",
+                               'httpMethod': "PUT", 'parameters': file_id,
+                               'parameterOrder': ["fileId"],
+                               'request': {'$ref': "File"},
+                               'response': {'$ref': "File"},
+                               'supportsMediaUpload': True,
+                               'mediaUpload': update_upload}}}}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve recorded cloud '
+                                     'storage responses')
+    parser.add_argument('recording', help='JSON file of recorded exchanges')
+    parser.add_argument('-p', '--port', type=int, default=8080,
+                        help='port to listen on (default 8080)')
+    args = parser.parse_args()
+
+    server = ReplayServer.load(args.recording, port=args.port)
+    print("Replaying {} on {}".format(args.recording, server.url))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Lists a folder tree with up to jobs folder listings in flight at once.
+#
+# get_children(handle) returns the items in one folder, in the order they
+# should be listed.  get_child_folder(item, handle) returns the handle used
+# to list item if it's a folder, or None otherwise.  get_name(item) is the
+# name added to path_list for the contents of a folder.
+#
+# list() is a generator yielding the same (item, path_list) tuples in the
+# same order as a recursive walk, as soon as they are known.  A folder's
+# subfolders are queued as soon as its own listing arrives, so the tree is
+# fetched breadth first ahead of the consumer.  At most max_prefetch
+# listings are held ahead of the consumer, beyond that subfolders are only
+# queued once the consumer reaches them, so memory stays flat for huge
+# trees.
+class FolderLister(object):
+
+    def __init__(self, get_children, get_child_folder, get_name, jobs=4,
+                 rate_limiter=None, max_prefetch=1000):
+        self.get_children = get_children
+        self.get_child_folder = get_child_folder
+        self.get_name = get_name
+        self.jobs = max(1, jobs)
+        self.rate_limiter = rate_limiter
+        self.max_prefetch = max_prefetch
+
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.outstanding = 0
+
+    def list(self, root_handle):
+        self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            root = self.submit(root_handle)
+            for result in self.collect(root, []):
+                yield result
+        finally:
+            # Also reached if the consumer stops early.  Queued listings
+            # are skipped rather than fetched.
+            with self.lock:
+                self.stopped = True
+            self.pool.shutdown(wait=True)
+
+    def submit(self, handle, prefetch=False):
+        with self.lock:
+            if self.stopped:
+                return None
+            if prefetch is True and self.outstanding >= self.max_prefetch:
+                return None
+            self.outstanding += 1
+            return self.pool.submit(self.fetch, handle)
+
+    def fetch(self, handle):
+        if self.stopped:
+            return []
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        children = self.get_children(handle)
+        entries = []
+        for item in children:
+            child_handle = self.get_child_folder(item, handle)
+            child_future = None
+            if child_handle is not None:
+                child_future = self.submit(child_handle, prefetch=True)
+            entries.append((item, child_handle, child_future))
+        return entries
+
+    def collect(self, future, path_list):
+        entries = future.result()
+        with self.lock:
+            self.outstanding -= 1
+        for (item, child_handle, child_future) in entries:
+            yield (item, path_list)
+            if child_handle is not None:
+                if child_future is None:
+                    child_future = self.submit(child_handle)
+                new_list = list(path_list)
+                new_list.append(self.get_name(item))
+                for result in self.collect(child_future, new_list):
+                    yield result
+
+
+# FolderLister for services with coroutine listings.  get_children is a
+# coroutine function, and list() an asynchronous generator yielding the
+# same results in the same order.  Listings run as tasks on the event loop
+# instead of in a thread pool.
+class AsyncFolderLister(object):
+
+    def __init__(self, get_children, get_child_folder, get_name, jobs=4,
+                 rate_limiter=None, max_prefetch=1000):
+        self.get_children = get_children
+        self.get_child_folder = get_child_folder
+        self.get_name = get_name
+        self.jobs = max(1, jobs)
+        self.rate_limiter = rate_limiter
+        self.max_prefetch = max_prefetch
+
+        self.outstanding = 0
+        self.tasks = set()
+
+    async def list(self, root_handle):
+        self.semaphore = asyncio.Semaphore(self.jobs)
+        try:
+            root = self.submit(root_handle)
+            async for result in self.collect(root, []):
+                yield result
+        finally:
+            # Also reached if the consumer stops early
+            for task in list(self.tasks):
+                task.cancel()
+
+    def submit(self, handle, prefetch=False):
+        if prefetch is True and self.outstanding >= self.max_prefetch:
+            return None
+        self.outstanding += 1
+        task = asyncio.ensure_future(self.fetch(handle))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def fetch(self, handle):
+        async with self.semaphore:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+            children = await self.get_children(handle)
+        entries = []
+        for item in children:
+            child_handle = self.get_child_folder(item, handle)
+            child_task = None
+            if child_handle is not None:
+                child_task = self.submit(child_handle, prefetch=True)
+            entries.append((item, child_handle, child_task))
+        return entries
+
+    async def collect(self, task, path_list):
+        entries = await task
+        self.outstanding -= 1
+        for (item, child_handle, child_task) in entries:
+            yield (item, path_list)
+            if child_handle is not None:
+                if child_task is None:
+                    child_task = self.submit(child_handle)
+                new_list = list(path_list)
+                new_list.append(self.get_name(item))
+                async for result in self.collect(child_task, new_list):
+                    yield result
@@ -0,0 +1,96 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+
+
+# Paths of the folders below local_path, relative to it and separated by
+# "/", parents before their children.
+def get_local_folders(local_path):
+    folders = []
+    for (root, dirs, files) in os.walk(local_path):
+        dirs.sort()
+        rel_root = os.path.relpath(root, local_path)
+        for cur_dir in dirs:
+            rel_path = cur_dir
+            if rel_root != os.curdir:
+                rel_path = os.path.join(rel_root, cur_dir)
+            folders.append(rel_path.replace(os.sep, "/"))
+    return folders
+
+
+# Makes sure the folders at rel_paths below the existing remote folder
+# folder_path exist, for uploading a folder tree.
+#
+# Instead of looking up every folder and each of its parents on its own,
+# the remote tree is listed once and only the missing folders are created,
+# a level at a time so parents exist before their children.  Services
+# create each level with as few batch requests as they can.  Every folder
+# is added to the service's metadata cache, so the uploads that follow
+# don't look them up again.
+#
+# Returns a map of every folder's relative path ("" for folder_path) to
+# its id, and a map of each folder's relative path to the items in it from
+# the listing, for service.prefetch_files.
+def create_folder_tree(service, folder_path, rel_paths, create=True):
+    logger = logging.getLogger("multidrive")
+    folder_path = folder_path.strip('/')
+
+    folder_ids = {"": service.get_folder_id(folder_path)}
+    folder_children = {"": []}
+    for (item, path_list) in service.list_folder(folder_path):
+        folder_children.setdefault("/".join(path_list), []).append(item)
+        if service.is_folder_from_file_type(item):
+            rel_path = "/".join(list(path_list) +
+                                [service.get_file_name(item)])
+            folder_ids[rel_path] = service.get_file_id(item)
+            folder_children.setdefault(rel_path, [])
+            service.cache_folder(join_path(folder_path, rel_path), item)
+
+    missing = set()
+    for rel_path in rel_paths:
+        # Parents are created too, even if they weren't asked for
+        while rel_path not in folder_ids and rel_path != "":
+            missing.add(rel_path)
+            rel_path = rel_path.rpartition('/')[0]
+    if len(missing) == 0:
+        return (folder_ids, folder_children)
+    if create is False:
+        raise ValueError("Non-existant folder necessary but create folder "
+                         "not set.")
+
+    logger.info("Creating {} folder(s) in {}".format(len(missing),
+                                                     folder_path))
+    levels = {}
+    for rel_path in missing:
+        levels.setdefault(rel_path.count('/'), []).append(rel_path)
+    for depth in sorted(levels):
+        level = sorted(levels[depth])
+        new_folders = service.create_folders(
+            [(folder_ids[rel_path.rpartition('/')[0]],
+              rel_path.rpartition('/')[2]) for rel_path in level])
+        for (rel_path, item) in zip(level, new_folders):
+            folder_ids[rel_path] = service.get_file_id(item)
+            folder_children[rel_path] = []
+            service.cache_folder(join_path(folder_path, rel_path), item)
+    return (folder_ids, folder_children)
+
+
+def join_path(folder_path, rel_path):
+    return "/".join([part for part in (folder_path, rel_path)
+                     if len(part) > 0])
@@ -30,12 +30,16 @@ from apiclient.http import MediaIoBaseUpload
 
 from oauth2client import client
 from oauth2client.file import Storage
-from apiclient.discovery import build
+from apiclient.discovery import build, DISCOVERY_URI
 import httplib2
 
 import time
+import threading
 
-from storageservice import StorageService
+from requestmetrics import get_body_size
+from storageservice import StorageService, ItemDoesNotExistError
+from changefeed import apply_changes
+from uploadjournal import get_source_id
 
 
 class HashMismatch(RuntimeError):
@@ -46,6 +50,9 @@ class HashFile(object):
     def set_file(self, cur_file):
         self.file = cur_file
         self.cur_file_hash = hashlib.md5()
+        # MD5 of the whole file when it's already known, so a resumed upload
+        # doesn't read the part already sent to hash it
+        self.known_md5 = None
         self.begin = False
         self.last_hash_pos = 0
         if self.file.tell() == 0:
@@ -68,6 +75,10 @@ class HashFile(object):
         return self.file.tell()
 
     def read(self, *args):
+        if self.known_md5 is not None:
+            return self.file.read(*args)
+        if self.begin is True and self.file.tell() > self.last_hash_pos:
+            self.hash_to(self.file.tell())
         chunk = self.file.read(*args)
         if len(chunk) > 0 and self.begin is True:
             if self.file.tell()-len(chunk) == self.last_hash_pos:
@@ -75,16 +86,28 @@ class HashFile(object):
                 self.last_hash_pos += len(chunk)
         return chunk
 
+    # Hashes the data skipped over up to offset, which happens when a
+    # resumed upload starts part way through the file.
+    def hash_to(self, offset):
+        pos = self.file.tell()
+        self.file.seek(self.last_hash_pos)
+        while self.last_hash_pos < offset:
+            chunk = self.file.read(min(1024*1024,
+                                       offset - self.last_hash_pos))
+            if len(chunk) == 0:
+                break
+            self.cur_file_hash.update(chunk)
+            self.last_hash_pos += len(chunk)
+        self.file.seek(pos)
+
     def get_md5(self):
+        if self.known_md5 is not None:
+            return self.known_md5
         if self.last_hash_pos == self.length:
             return self.cur_file_hash.hexdigest()
         raise RuntimeError("Did not complete hash of file.")
 
 
-class ItemDoesNotExistError(RuntimeError):
-    pass
-
-
 class UTC(datetime.tzinfo):
     """UTC"""
 
@@ -100,6 +123,11 @@ class UTC(datetime.tzinfo):
 
 class GoogleDriveStorageService(StorageService):
 
+    service_name = "googledrive"
+    # Can be pointed at a local server replaying recorded responses
+    discovery_url = DISCOVERY_URI
+    drive_url_root = "https://www.googleapis.com/drive/v2"
+
     def authorize(self):
         logger = logging.getLogger("multidrive")
         logger.info("Authorize Google Drive Storage Service")
@@ -117,18 +145,113 @@ class GoogleDriveStorageService(StorageService):
             response = input("Enter the Token you received: ")
             credentials = flow.step2_exchange(response)
             storage.put(credentials)
-        http_auth = credentials.authorize(httplib2.Http())
+        http_auth = meter_http(credentials.authorize(new_http()))
         self.__credentials__ = credentials
         credentials.set_store(storage)
-        self.__service__ = build('drive', 'v2', http=http_auth)
+        self.__service__ = build('drive', 'v2', http=http_auth,
+                                 discoveryServiceUrl=self.discovery_url)
+        self.__local__ = threading.local()
+        self.__local__.http = http_auth
+        # Ids of files flagged as abuse that the user chose to download
+        self.acknowledged_abuse = set()
+
+    def get_http(self):
+        # httplib2.Http objects are not thread safe, so each thread making
+        # requests gets its own authorized Http object.
+        http = getattr(self.__local__, 'http', None)
+        if http is None:
+            http = meter_http(self.__credentials__.authorize(new_http()))
+            self.__local__.http = http
+        return http
+
+    # Drive reports rate limiting as 403 errors with one of these reasons,
+    # as well as 429
+    RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+    def is_rate_limited(self, error):
+        if error.resp.status == requests.codes.too_many_requests:
+            return True
+        if error.resp.status != requests.codes.forbidden:
+            return False
+        try:
+            message = json.loads(error.content.decode('utf-8'))
+        except ValueError:
+            return False
+        return any(cur_error.get('reason') in self.RATE_LIMIT_REASONS
+                   for cur_error in message.get('error', {}).get('errors',
+                                                                 []))
+
+    # Runs call() through the service's request limiter, retrying it while
+    # Drive rate limits it.  call() makes its requests with get_http(),
+    # and they're recorded as one call for action.  The API client reads
+    # whole responses, so their time to first byte isn't known.
+    def call_limited(self, call, max_tries=6, action="Drive API"):
+        limiter = self.get_request_limiter()
+        http = self.get_http()
+        http.last_status = None
+        bytes_sent = http.bytes_sent
+        bytes_received = http.bytes_received
+        started = time.monotonic()
+        ok = False
+        tries = 0
+        try:
+            while True:
+                limiter.acquire()
+                try:
+                    result = call()
+                except apiclient.errors.HttpError as error:
+                    if tries >= max_tries or not self.is_rate_limited(error):
+                        raise
+                    tries += 1
+                    # Without Retry-After, all requests wait like a retry
+                    # would
+                    self.check_throttled(requests.codes.too_many_requests,
+                                         error.resp, float(1 << tries) / 2)
+                    continue
+                limiter.succeeded()
+                ok = True
+                return result
+        finally:
+            self.record_request(action, http.last_status, ok, tries,
+                                http.bytes_sent - bytes_sent,
+                                http.bytes_received - bytes_received, None,
+                                started)
+
+    def execute(self, request):
+        return self.call_limited(
+            lambda: request.execute(http=self.get_http()),
+            action=getattr(request, 'methodId', "Drive API"))
 
     def upload(self, file_path, destination=None, modified_time=None,
                create_folder=False, overwrite=False):
         print("Uploading {} to Google Drive".format(file_path))
-        self.upload_file(file_path, folder=destination,
-                         modified_time=modified_time,
-                         create_folder=create_folder, overwrite=overwrite)
+        with self.track_progress(os.path.basename(file_path),
+                                 os.path.getsize(file_path),
+                                 'upload') as progress:
+            new_file = self.upload_file(file_path, folder=destination,
+                                        modified_time=modified_time,
+                                        create_folder=create_folder,
+                                        overwrite=overwrite,
+                                        progress=progress)
         print("Upload complete")
+        return new_file
+
+    def upload_stream(self, stream, file_name, file_size, destination=None,
+                      modified_time=None, create_folder=False,
+                      overwrite=False):
+        print("Uploading stream {} to Google Drive".format(file_name))
+        # A stream can only be read once, so the caller retries with a new
+        # stream on a hash mismatch.
+        with self.track_progress(file_name, file_size, 'upload') as progress:
+            new_file = self.upload_fileobj(stream.open, file_name,
+                                           file_size, folder=destination,
+                                           modified_time=modified_time,
+                                           create_folder=create_folder,
+                                           overwrite=overwrite,
+                                           num_attempts=1,
+                                           progress=progress)
+        print("Upload complete")
+        return new_file
 
     def download(self, file_path, destination=None, overwrite=False):
         print("Downloading {} from Google Drive".format(file_path))
@@ -154,12 +277,20 @@ class GoogleDriveStorageService(StorageService):
         else:
             base_folder = self.get_folder(folder_path)
 
-        folder_list = self.get_folder_listing(base_folder, [])
+        folder_list = self.get_folder_listing(base_folder)
         return folder_list
 
-    def get_folder_listing(self, cur_folder, path_list):
+    def get_folder_listing(self, cur_folder):
+        lister = self.get_folder_lister(self.get_folder_children,
+                                        self.get_child_folder)
+        return lister.list(cur_folder)
+
+    def get_child_folder(self, cur_file, parent):
+        if cur_file['mimeType'] == 'application/vnd.google-apps.folder':
+            return cur_file['id']
+        return None
 
-        result_list = []
+    def get_folder_children(self, cur_folder):
         query = "'{}' in parents and trashed=false ".format(cur_folder)
 
         file_list = []
@@ -167,10 +298,10 @@ class GoogleDriveStorageService(StorageService):
         while True:
             files = None
             if page_token:
-                files = (self.__service__.files().
-                         list(q=query, pageToken=page_token).execute())
+                files = self.execute(self.__service__.files().
+                                     list(q=query, pageToken=page_token))
             else:
-                files = self.__service__.files().list(q=query).execute()
+                files = self.execute(self.__service__.files().list(q=query))
 
             file_list.extend(files['items'])
             page_token = files.get('nextPageToken')
@@ -178,18 +309,78 @@ class GoogleDriveStorageService(StorageService):
                 break
 
         file_list.sort(key=lambda cur_file: cur_file['title'])
-        for cur_file in file_list:
-            result_list.append((cur_file, path_list))
-            if cur_file['mimeType'] == 'application/vnd.google-apps.folder':
-                new_list = list(path_list)
-                new_list.append(cur_file['title'])
-                result_list.extend(self.get_folder_listing(cur_file['id'],
-                                   new_list))
+        return file_list
+
+    def list_folder_changes(self, folder_path, feed_state):
+        if folder_path is None or folder_path == "":
+            folder_path = ""
+            # Changes report the real id of the root folder, not 'root'
+            base_folder = self.execute(self.__service__.about().
+                                       get())['rootFolderId']
+        else:
+            base_folder = self.get_folder(folder_path)
+
+        return self.get_folder_changes(base_folder, folder_path, feed_state)
+
+    def get_folder_changes(self, base_folder, folder_path, feed_state):
+        feed_key = self.get_feed_key(folder_path)
+        page_token = feed_state.get_cursor(feed_key)
+
+        if page_token is None:
+            # First run, so list everything.  The start token is fetched
+            # first so changes made during the listing are seen next time.
+            start_token = self.execute(self.__service__.changes().
+                                       getStartPageToken())['startPageToken']
+            folders = {}
+            for (cur_file, path_list) in self.get_folder_listing(base_folder):
+                if self.get_child_folder(cur_file, None) is not None:
+                    for parent in cur_file['parents']:
+                        if (parent['id'] == base_folder or
+                                parent['id'] in folders):
+                            folders[cur_file['id']] = (parent['id'],
+                                                       cur_file['title'])
+                            break
+                yield (cur_file, path_list)
+            feed_state.save(feed_key, start_token, folders)
+            return
+
+        folders = feed_state.load_folders(feed_key)
+        changes = []
+        while True:
+            print("Getting changes for {}".format(folder_path))
+            response = self.execute(self.__service__.changes().
+                                    list(pageToken=page_token,
+                                         includeDeleted=True,
+                                         maxResults=1000))
+            for change in response['items']:
+                cur_file = change.get('file')
+                if change.get('deleted') is True or cur_file is None:
+                    changes.append((change['fileId'], [], None, False, True,
+                                    None))
+                    continue
+                changes.append((cur_file['id'],
+                                [parent['id'] for parent
+                                 in cur_file.get('parents', [])],
+                                cur_file['title'],
+                                self.get_child_folder(cur_file,
+                                                      None) is not None,
+                                cur_file['labels']['trashed'] is True,
+                                cur_file))
+
+            if 'newStartPageToken' in response:
+                page_token = response['newStartPageToken']
+                break
+            page_token = response['nextPageToken']
+
+        for result in apply_changes(folders, base_folder, changes):
+            yield result
+        feed_state.save(feed_key, page_token, folders)
 
-        return result_list
+    def get_file_by_path(self, file_path):
+        return self.get_file(file_path)
 
     def download_file(self, file_path, destination=None, overwrite=False):
-        cur_file = self.get_file(file_path)
+        cur_file = self.get_file_by_path(file_path)
         return self.download_item(cur_file, destination=destination,
                                   overwrite=overwrite, create_folder=False)
 
@@ -217,17 +408,14 @@ class GoogleDriveStorageService(StorageService):
         NUM_ATTEMPTS = 5
         cur_attempt = 1
         while cur_attempt <= NUM_ATTEMPTS:
-            fd = open(local_path, 'wb')
             try:
-                self.download_helper(cur_file['id'], fd, cur_file['title'],
+                self.download_helper(cur_file, local_path,
                                      cur_file['md5Checksum'])
             except HashMismatch:
                 logger.warning("Hash of downloaded file does "
                                "not match server.  Attempting again")
                 cur_attempt += 1
                 continue
-            finally:
-                fd.close()
             break
         if cur_attempt > NUM_ATTEMPTS:
             raise RuntimeError("Hash of downloaded file does "
@@ -238,7 +426,11 @@ class GoogleDriveStorageService(StorageService):
                  time.mktime(modified_date.timetuple())))
         return (local_path, cur_file['modifiedDate'])
 
-    def download_helper(self, file_id, local_fd, file_name, remote_hash):
+    def open_content(self, cur_file, byte_range=None):
+        return self.get_content_response(cur_file['id'], cur_file['title'],
+                                         byte_range)
+
+    def get_content_response(self, file_id, file_name, byte_range=None):
         now = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
         expiry = self.__credentials__.token_expiry
         if now > expiry:
@@ -246,14 +438,33 @@ class GoogleDriveStorageService(StorageService):
 
         headers = {}
         self.__credentials__.apply(headers)
-        url = "https://www.googleapis.com/drive/v2/files/"+file_id
+        url = self.drive_url_root+"/files/"+file_id
         parameters = {'alt': 'media'}
-
-        response = requests.get(url, headers=headers, stream=True,
-                                params=parameters)
+        status_codes = (requests.codes.ok,)
+        if byte_range is not None:
+            headers['Range'] = "bytes={}-{}".format(*byte_range)
+            status_codes = (requests.codes.ok, requests.codes.partial_content)
+        # Files are downloaded in several parts, only ask once
+        if file_id in self.acknowledged_abuse:
+            parameters['acknowledgeAbuse'] = 'true'
+        session = self.get_session()
+        limiter = self.get_request_limiter()
+        started = time.monotonic()
+
+        limiter.acquire()
+        response = session.get(url, headers=headers, stream=True,
+                               params=parameters)
 
         tries = 0
-        while response.status_code != requests.codes.ok and tries < 6:
+        while response.status_code not in status_codes and tries < 6:
+            sleep_length = float(1 << (tries + 1)) / 2
+            if self.check_throttled(response.status_code, response.headers,
+                                    sleep_length):
+                tries += 1
+                limiter.acquire()
+                response = session.get(url, headers=headers, stream=True,
+                                       params=parameters)
+                continue
             if (response.status_code == requests.codes.forbidden):
                 message = json.loads(response.text)
                 if 'error' in message and 'errors' in message['error']:
@@ -273,9 +484,11 @@ class GoogleDriveStorageService(StorageService):
                                        "'yes' if you wish to do so. ")
                         if (answer.lower() == 'y' or answer.lower() == 'yes'):
                             parameters['acknowledgeAbuse'] = 'true'
-                            response = requests.get(url, headers=headers,
-                                                    stream=True,
-                                                    params=parameters)
+                            self.acknowledged_abuse.add(file_id)
+                            limiter.acquire()
+                            response = session.get(url, headers=headers,
+                                                   stream=True,
+                                                   params=parameters)
                             continue
                         raise RuntimeError("Abusive or malware file detected "
                                            "and not downloaded. Aborting.")
@@ -291,38 +504,64 @@ class GoogleDriveStorageService(StorageService):
             print("Retry " + str(tries))
             sleep_length = float(1 << tries) / 2
             time.sleep(sleep_length)
-            response = requests.get(url, headers=headers, stream=True,
-                                    params=parameters)
+            limiter.acquire()
+            response = session.get(url, headers=headers, stream=True,
+                                   params=parameters)
 
-        if response.status_code != requests.codes.ok:
+        if response.status_code not in status_codes:
+            self.record_response("Download file", response, False, tries,
+                                 None, tries + 1, started, True)
             raise RuntimeError("Unable to access Google Drive file")
-
-        size = 0
-        cur_file_hash = hashlib.md5()
-        for chunk in response.iter_content(chunk_size=5*1024*1024):
-            if chunk:  # filter out keep-alive new chunks
-                cur_file_hash.update(chunk)
-                local_fd.write(chunk)
-                local_fd.flush()
-                size = size + 1
-                if size % 100 == 0:
-                    logging.info(str(size*5) + "MB written")
-        os.fsync(local_fd.fileno())
-
-        if remote_hash.lower() != cur_file_hash.hexdigest():
+        limiter.succeeded()
+        self.record_response("Download file", response, True, tries, None,
+                             tries + 1, started, True)
+        return response
+
+    def download_helper(self, cur_file, local_path, remote_hash):
+        cur_file_hash = self.download_content(cur_file, local_path, 'md5')
+        if remote_hash.lower() != cur_file_hash:
             raise HashMismatch("Hash of downloaded file does "
                                "not match server.")
 
     def upload_file(self, file_path, folder=None, modified_time=None,
-                    create_folder=False, overwrite=False):
+                    create_folder=False, overwrite=False, progress=None):
         logger = logging.getLogger("multidrive")
 
         logger.debug("Uploading " + file_path)
-        file_name = os.path.basename(file_path)
-        mime_type = guess_type(file_path)[0]
-        mime_type = mime_type if mime_type else 'application/octet-stream'
+        if modified_time is None:
+            modified_time = datetime.datetime.fromtimestamp(
+                os.path.getmtime(file_path),
+                UTC()).isoformat()[:-6]
+            if '.' not in modified_time:
+                modified_time += ".000000Z"
+            else:
+                modified_time += "Z"
 
-        file_size = os.path.getsize(file_path)
+        return self.upload_fileobj(lambda: open(file_path, 'rb'),
+                                   os.path.basename(file_path),
+                                   os.path.getsize(file_path),
+                                   folder=folder,
+                                   modified_time=modified_time,
+                                   create_folder=create_folder,
+                                   overwrite=overwrite,
+                                   source_id=get_source_id(file_path),
+                                   local_path=file_path, progress=progress)
+
+    # open_file is called for every attempt and should return a new file
+    # object positioned at the start of the data.
+    #
+    # source_id identifies the local file being uploaded, so an interrupted
+    # upload can be resumed by a later run.  local_path is the path of the
+    # local file, if any, for skip_identical.  progress is the FileProgress
+    # of the upload, or None.
+    def upload_fileobj(self, open_file, file_name, file_size, folder=None,
+                       modified_time=None, create_folder=False,
+                       overwrite=False, num_attempts=5, source_id=None,
+                       local_path=None, progress=None):
+        logger = logging.getLogger("multidrive")
+
+        mime_type = guess_type(file_name)[0]
+        mime_type = mime_type if mime_type else 'application/octet-stream'
 
         parents = []
         cur_folder = 'root'
@@ -331,9 +570,7 @@ class GoogleDriveStorageService(StorageService):
             parents.append({"id": cur_folder})
 
         if modified_time is None:
-            modified_time = datetime.datetime.fromtimestamp(
-                os.path.getmtime(file_path),
-                UTC()).isoformat()[:-6]
+            modified_time = datetime.datetime.now(UTC()).isoformat()[:-6]
             if '.' not in modified_time:
                 modified_time += ".000000Z"
             else:
@@ -345,10 +582,12 @@ class GoogleDriveStorageService(StorageService):
                 modified_time = modified_time.replace("Z", ".000000Z")
         logging.debug("Modified time: "+modified_time)
 
-        NUM_ATTEMPTS = 5
+        # The cached metadata of the file is stale once it's replaced
+        self.invalidate_uploaded_file(folder, file_name)
+
         cur_attempt = 1
-        while cur_attempt <= NUM_ATTEMPTS:
-            with open(file_path, 'rb') as cur_open_file:
+        while cur_attempt <= num_attempts:
+            with open_file() as cur_open_file:
 
                 cur_hash_file = HashFile()
                 cur_hash_file.set_file(cur_open_file)
@@ -361,21 +600,31 @@ class GoogleDriveStorageService(StorageService):
                     media_body = None
 
                 existing_file = self.get_file_if_exists(file_name, cur_folder)
+                if (cur_attempt == 1 and existing_file is not None and
+                        local_path is not None and
+                        self.skip_identical is True and
+                        self.is_identical(local_path, existing_file)):
+                    print("{} is unchanged, skipping".format(file_name))
+                    return existing_file
+
+                remote_path = file_name
+                if folder is not None and len(folder.strip('/')) > 0:
+                    remote_path = folder.strip('/') + "/" + file_name
 
                 try:
                     if existing_file is not None:
                         if overwrite is False:
                             raise RuntimeError("File already exists")
-                        old_file = self.__service__.files().get(
-                            fileId=existing_file['id']).execute()
+                        # The listing has the full metadata of the file
+                        old_file = dict(existing_file)
                         old_file['modifiedDate'] = modified_time
                         old_file['title'] = file_name
                         old_file['mimeType'] = mime_type
                         old_file['parents'] = parents
-                        new_file = self.__service__.files().update(
+                        request = self.__service__.files().update(
                             fileId=existing_file['id'],
                             body=old_file,
-                            media_body=media_body).execute()
+                            media_body=media_body)
                     else:
                         body = {
                             'title': file_name,
@@ -383,12 +632,23 @@ class GoogleDriveStorageService(StorageService):
                             'parents': parents,
                             'modifiedDate': modified_time,
                         }
-                        new_file = self.__service__.files().insert(
+                        request = self.__service__.files().insert(
                             body=body,
-                            media_body=media_body).execute()
+                            media_body=media_body)
+                    if media_body is None:
+                        new_file = self.execute(request)
+                    else:
+                        new_file = self.upload_resumable(request,
+                                                         cur_hash_file,
+                                                         remote_path,
+                                                         source_id,
+                                                         local_path,
+                                                         progress)
 
                 except apiclient.errors.HttpError as error:
                     print('An error occured uploading file: %s' % error)
+                    if progress is not None:
+                        progress.finish(False)
                     return None
                 logger.info('Calculated MD5 of uploaded file:' +
                             cur_hash_file.get_md5())
@@ -403,12 +663,78 @@ class GoogleDriveStorageService(StorageService):
         if (cur_hash_file.get_md5() != new_file['md5Checksum']):
             raise HashMismatch("Hash of uploaded file does "
                                "not match server.")
+        return new_file
+
+    # Sends a resumable upload a chunk at a time, journaling the session so
+    # a later run can carry on from the last chunk sent.
+    def upload_resumable(self, request, hash_file, remote_path, source_id,
+                         local_path=None, progress=None):
+        logger = logging.getLogger("multidrive")
+
+        journaled = self.load_upload_session(remote_path, source_id)
+        if journaled is not None:
+            (session, offset) = journaled
+            logger.info("Resuming upload of {} at byte {}"
+                        .format(remote_path, offset))
+            request.resumable_uri = session['resumable_uri']
+            request.resumable_progress = offset
+            # Ask the server how much it has before sending anything, the
+            # journal may be behind.  hashlib state can't be saved, so
+            # unless the hash of the file is cached, hash_file hashes the
+            # part already sent again as it's skipped.
+            request._in_error_state = True
+            if local_path is not None:
+                hash_file.known_md5 = self.hash_cache.peek_hash(local_path,
+                                                                'md5')
+        if progress is not None:
+            progress.reset(request.resumable_progress)
+
+        new_file = None
+        try:
+            while new_file is None:
+                (status, new_file) = self.call_limited(
+                    lambda: request.next_chunk(http=self.get_http()),
+                    action="Upload Chunk")
+                if status is not None and progress is not None:
+                    progress.update(status.resumable_progress)
+                if status is not None:
+                    self.save_upload_session(remote_path, source_id,
+                                             {'resumable_uri':
+                                              request.resumable_uri},
+                                             status.resumable_progress)
+        except apiclient.errors.HttpError as error:
+            if journaled is not None and error.resp.status in (404, 410):
+                # The session expired, start again from the beginning
+                logger.warning("Upload session expired, restarting upload")
+                self.clear_upload_session(remote_path)
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                request._in_error_state = False
+                hash_file.known_md5 = None
+                return self.upload_resumable(request, hash_file,
+                                             remote_path, source_id,
+                                             progress=progress)
+            raise
+        self.clear_upload_session(remote_path)
+        if progress is not None:
+            progress.update(progress.size)
+        return new_file
+
+    def invalidate_uploaded_file(self, folder, file_name):
+        file_key = file_name
+        if folder is not None and len(folder.strip('/')) > 0:
+            file_key = folder.strip('/') + "/" + file_name
+        self.invalidate_cached("file", file_key)
 
     def get_file_if_exists(self, file_name, folder_id):
+        prefetched = self.take_prefetched_file(folder_id, file_name)
+        if prefetched is not False:
+            return prefetched
         escaped_file_name = file_name.replace("'", "\\'")
         query = ("'{}' in parents and trashed=false and "
                  "title='{}'".format(folder_id, escaped_file_name))
-        file_list = self.__service__.files().list(q=query).execute()['items']
+        file_list = self.execute(
+            self.__service__.files().list(q=query))['items']
         if len(file_list) > 1:
             raise RuntimeError('Multiple files with name "{}" exist'
                                .format(file_name))
@@ -435,13 +761,23 @@ class GoogleDriveStorageService(StorageService):
 
         parent = 'root'
 
+        cur_path = ""
         for cur_folder in folders:
+            if len(cur_path) == 0:
+                cur_path = cur_folder
+            else:
+                cur_path += "/" + cur_folder
+            cached_id = self.get_cached("folder", cur_path)
+            if cached_id is not None:
+                parent = cached_id
+                continue
+
             escaped_folder = cur_folder.replace("'", "\\'")
             query = ("'{}' in parents and trashed=false and "
                      "mimeType='application/vnd.google-apps.folder' and "
                      "title='{}'".format(parent, escaped_folder))
-            file_list = (self.__service__.files()
-                         .list(q=query).execute()['items'])
+            file_list = self.execute(self.__service__.files()
+                                     .list(q=query))['items']
             if len(file_list) > 1:
                 raise RuntimeError('Multiple folders with name "{}" exist'
                                    .format(cur_folder))
@@ -455,14 +791,21 @@ class GoogleDriveStorageService(StorageService):
                                        .format(cur_folder))
             else:
                 parent = file_list[0]['id']
+            self.set_cached("folder", cur_path, parent)
 
         if is_folder is True:
             return parent
 
+        file_key = "/".join(folders + [file_name])
+        cached_file = self.get_cached("file", file_key)
+        if cached_file is not None:
+            return cached_file
+
         escaped_file_name = file_name.replace("'", "\\'")
         query = ("'{}' in parents and trashed=false and title='{}'"
                  .format(parent, escaped_file_name))
-        file_list = self.__service__.files().list(q=query).execute()['items']
+        file_list = self.execute(
+            self.__service__.files().list(q=query))['items']
         if len(file_list) > 1:
             raise RuntimeError('Multiple files with name "{}" exist'
                                .format(file_name))
@@ -470,9 +813,12 @@ class GoogleDriveStorageService(StorageService):
             raise ItemDoesNotExistError('File "{}" does not exist'
                                         .format(file_name))
 
+        self.set_cached("file", file_key, file_list[0])
         return file_list[0]
 
     def create_folder(self, folder_path):
+        self.invalidate_cached("folder", folder_path.strip('/'),
+                               descendants=True)
         self.get_folder(folder_path, create=True)
 
     def create_folder_helper(self, folder_name, parent, modified_time=None):
@@ -490,17 +836,106 @@ class GoogleDriveStorageService(StorageService):
             body['modifiedDate'] = modified_time
 
         try:
-            file = (self.__service__.files().insert(body=body)
-                    .execute())
+            file = self.execute(self.__service__.files().insert(body=body))
             print("Folder creation complete")
             return file
         except apiclient.errors.HttpError as error:
             print('An error occured creating folder: %s' % error)
             return None
 
+    def get_folder_id(self, folder_path):
+        if len(folder_path.strip('/')) == 0:
+            return 'root'
+        return self.get_folder(folder_path)
+
+    def cache_folder(self, folder_path, item):
+        self.set_cached("folder", folder_path.strip('/'), item['id'])
+
+    # Drive accepts up to 100 requests in a batch
+    BATCH_SIZE = 100
+
+    # Sends requests in as few batch requests as possible.  Returns a list
+    # of (response, exception) in the same order as requests, where
+    # exception is the HttpError for requests that failed.
+    def execute_batch(self, requests_list):
+        results = [None] * len(requests_list)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = (response, exception)
+
+        for start in range(0, len(requests_list), self.BATCH_SIZE):
+            batch = self.__service__.new_batch_http_request(
+                callback=callback)
+            for index in range(start, min(start + self.BATCH_SIZE,
+                                          len(requests_list))):
+                batch.add(requests_list[index], request_id=str(index))
+            self.call_limited(lambda: batch.execute(http=self.get_http()),
+                              action="Batch")
+        return results
+
+    def create_folders(self, folders):
+        mime_type = 'application/vnd.google-apps.folder'
+        insert_requests = []
+        for (parent_id, name) in folders:
+            body = {'title': name, 'mimeType': mime_type,
+                    'parents': [{'id': parent_id}]}
+            insert_requests.append(self.__service__.files().insert(
+                body=body))
+
+        items = []
+        results = self.execute_batch(insert_requests)
+        for ((parent_id, name), (item, error)) in zip(folders, results):
+            if error is not None:
+                # e.g. rate limited, tried again on its own
+                item = self.create_folder_helper(name, parent_id)
+                if item is None:
+                    raise RuntimeError('Unable to create folder "{}"'
+                                       .format(name))
+            items.append(item)
+        return items
+
+    # Without a listing of the folder, up to BATCH_SIZE files are looked up
+    # with one query each, sent in a single batch request.  Files whose
+    # lookup failed are looked up again by upload.
+    def prefetch_files(self, folder_path, file_names, children=None):
+        logger = logging.getLogger("multidrive")
+        file_names = sorted(set(file_names))
+        if children is not None or len(file_names) > self.BATCH_SIZE:
+            return StorageService.prefetch_files(self, folder_path,
+                                                 file_names, children)
+        try:
+            folder_id = self.get_prefetch_key(folder_path)
+        except ItemDoesNotExistError:
+            return
+
+        list_requests = []
+        for file_name in file_names:
+            escaped_file_name = file_name.replace("'", "\\'")
+            query = ("'{}' in parents and trashed=false and "
+                     "title='{}'".format(folder_id, escaped_file_name))
+            list_requests.append(self.__service__.files().list(q=query))
+
+        results = self.execute_batch(list_requests)
+        for (file_name, (response, error)) in zip(file_names, results):
+            if error is not None or len(response['items']) > 1:
+                continue
+            file = response['items'][0] if response['items'] else None
+            self.set_prefetched_file(folder_id, file_name, file)
+        logger.debug("Prefetched {} file(s) in {}"
+                     .format(len(file_names), folder_path))
+
     def get_file_name(self, file):
         return file['title']
 
+    def get_file_size(self, file):
+        return int(file['fileSize'])
+
+    def get_file_hash(self, file):
+        return ('md5', file['md5Checksum'].lower())
+
+    def get_modified_time(self, file):
+        return file['modifiedDate']
+
     def is_folder_from_file_type(self, file):
         return file['mimeType'] == 'application/vnd.google-apps.folder'
 
@@ -513,7 +948,7 @@ class GoogleDriveStorageService(StorageService):
         return "%.2f%s%s" % (num, 'Yi', suffix)
 
     def get_quota(self):
-        about = self.__service__.about().get().execute()
+        about = self.execute(self.__service__.about().get())
 
         quota_type = about['quotaType']
         if quota_type == 'UNLIMITED':
@@ -543,3 +978,44 @@ class GoogleDriveStorageService(StorageService):
                               self.format_bytes(trashed_quota),
                               float("{0:.2f}".format(percentage))))
         return result
+
+
+# httplib2.Http for the API client.  Resumable uploads answer each chunk
+# but the last with 308 Resume Incomplete, which newer versions of httplib2
+# follow as a redirect and fail for the lack of a Location, so 308 isn't
+# treated as one, as in the API client's own build_http().
+def new_http():
+    http = httplib2.Http()
+    if hasattr(http, 'redirect_codes'):
+        http.redirect_codes = http.redirect_codes - {308}
+    return http
+
+
+# Wraps the request function of http, an authorized httplib2.Http, to count
+# the bytes sent and received with it and keep the status of the last
+# response, so calls made through the API client can be recorded.  Like
+# oauth2client's wrapper, the function keeps the credentials attribute the
+# API client looks for.
+def meter_http(http):
+    request = http.request
+
+    def metered_request(uri, method="GET", body=None, headers=None, *args,
+                        **kwargs):
+        (response, content) = request(uri, method, body, headers, *args,
+                                      **kwargs)
+        # Upload chunks are sent as slices of the stream, without a length
+        length = (headers or {}).get('Content-Length')
+        if length is not None:
+            http.bytes_sent += int(length)
+        else:
+            http.bytes_sent += get_body_size(body)
+        http.bytes_received += len(content or b"")
+        http.last_status = response.status
+        return (response, content)
+
+    metered_request.__dict__.update(request.__dict__)
+    http.bytes_sent = 0
+    http.bytes_received = 0
+    http.last_status = None
+    http.request = metered_request
+    return http
@@ -0,0 +1,122 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import threading
+
+
+# Reads a local file for upload.  Each read() is a single pread() at the
+# read position, so resuming part way through the file doesn't read the
+# part already sent, and the HTTP layer is handed data that can't change
+# under it.  Sending part of a chunk again is done with a memoryview of
+# it, without another copy.
+#
+# If hash_data is set, the MD5 and SHA1 of the whole file are computed by
+# a thread reading the file, independent of the read position, so hashing
+# overlaps sending.  The hashes are always of the complete file, including
+# when the upload starts part way through it.  close() stops the hashing,
+# so a failed upload doesn't wait for the rest of the file.
+#
+# A file that changes size while it's being uploaded, like a log that's
+# rotated, fails the upload with RuntimeError.
+class LocalFileReader(object):
+
+    HASH_BLOCK_SIZE = 4*1024*1024
+
+    def __init__(self, file_path, hash_data=True):
+        self.file_path = file_path
+        self.file = open(file_path, "rb")
+        self.fd = self.file.fileno()
+        self.size = os.fstat(self.fd).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.pos = 0
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.hashed = False
+        self.hash_error = None
+        self.stopped = threading.Event()
+        self.hasher = None
+        if hash_data is True:
+            self.hasher = threading.Thread(target=self.hash_file)
+            self.hasher.daemon = True
+            self.hasher.start()
+
+    def hash_file(self):
+        for start in range(0, self.size, self.HASH_BLOCK_SIZE):
+            if self.stopped.is_set():
+                return
+            try:
+                block = self.read_at(start, self.HASH_BLOCK_SIZE)
+            except RuntimeError as err:
+                self.hash_error = err
+                return
+            # hashlib releases the GIL for large blocks
+            self.md5.update(block)
+            self.sha1.update(block)
+        self.hashed = True
+
+    # Up to size bytes from start, raising RuntimeError if the file is no
+    # longer the size it was when it was opened
+    def read_at(self, start, size):
+        length = max(0, min(size, self.size - start))
+        data = os.pread(self.fd, length, start)
+        if (len(data) < length or
+                os.fstat(self.fd).st_size != self.size):
+            raise RuntimeError("{} changed size while it was being read"
+                               .format(self.file_path))
+        return data
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.pos
+        chunk = self.read_at(self.pos, size)
+        self.pos += len(chunk)
+        return chunk
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset):
+        self.pos = min(max(offset, 0), self.size)
+
+    def get_hash(self, hash_type):
+        if self.hasher is None:
+            raise RuntimeError("File was not hashed")
+        self.hasher.join()
+        if self.hash_error is not None:
+            raise self.hash_error
+        if self.hashed is False:
+            raise RuntimeError("File was closed before it was hashed")
+        if hash_type == 'md5':
+            return self.md5.hexdigest()
+        elif hash_type == 'sha1':
+            return self.sha1.hexdigest()
+        raise ValueError("Unknown hash type: " + hash_type)
+
+    def close(self):
+        if self.hasher is not None:
+            self.stopped.set()
+            self.hasher.join()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
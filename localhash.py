@@ -0,0 +1,126 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+CHUNK_SIZE = 1024*1024
+
+
+# Reads the file at file_path once, returning {'md5': ..., 'sha1': ...}
+def hash_file(file_path):
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            md5.update(chunk)
+            sha1.update(chunk)
+    return {'md5': md5.hexdigest(), 'sha1': sha1.hexdigest()}
+
+
+# Cache of the MD5 and SHA1 hashes of local files, so a file is only read
+# to hash it once for as long as it doesn't change.  Both hashes are
+# computed together, since each service reports one or the other.
+#
+# Files are identified by device and inode, and the hashes are used while
+# the size, modification time and change time are the same as when the
+# file was hashed.  The change time catches a deleted file's inode being
+# reused for a new file with the same size and modification time.  If a
+# path is given, hashes are also kept in a SQLite file for later runs.
+class LocalHashCache(object):
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS local_hashes "
+                            "(device INTEGER, inode INTEGER, size INTEGER, "
+                            "mtime_ns INTEGER, ctime_ns INTEGER, md5 TEXT, "
+                            "sha1 TEXT, PRIMARY KEY (device, inode))")
+            self.db.commit()
+
+    # The cached hashes of the file with the given os.stat result, or None
+    def lookup(self, stat):
+        version = (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+        with self.lock:
+            entry = self.entries.get((stat.st_dev, stat.st_ino))
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT size, mtime_ns, ctime_ns, md5, "
+                                  "sha1 FROM local_hashes WHERE device = ? "
+                                  "AND inode = ?",
+                                  (stat.st_dev, stat.st_ino)).fetchone()
+            if row is None or tuple(row[:3]) != version:
+                return None
+            hashes = {'md5': row[3], 'sha1': row[4]}
+            self.entries[(stat.st_dev, stat.st_ino)] = (version, hashes)
+            return hashes
+
+    # Records hashes computed from the file while it had the os.stat result
+    # stat, unless it has changed since
+    def record(self, file_path, stat, hashes):
+        cur_stat = os.stat(file_path)
+        version = (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+        if ((cur_stat.st_dev, cur_stat.st_ino) != (stat.st_dev, stat.st_ino)
+                or (cur_stat.st_size, cur_stat.st_mtime_ns,
+                    cur_stat.st_ctime_ns) != version):
+            return
+        with self.lock:
+            self.entries[(stat.st_dev, stat.st_ino)] = (version, hashes)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO local_hashes VALUES "
+                                "(?, ?, ?, ?, ?, ?, ?)",
+                                (stat.st_dev, stat.st_ino) + version +
+                                (hashes['md5'], hashes['sha1']))
+                self.db.commit()
+
+    # Returns {'md5': ..., 'sha1': ...} for the file at file_path, reading
+    # it if it isn't cached
+    def get_hashes(self, file_path):
+        stat = os.stat(file_path)
+        hashes = self.lookup(stat)
+        if hashes is None:
+            logging.getLogger("multidrive").debug("Hashing " + file_path)
+            hashes = hash_file(file_path)
+            self.record(file_path, stat, hashes)
+        return hashes
+
+    def get_hash(self, file_path, hash_type):
+        return self.get_hashes(file_path)[hash_type]
+
+    # The cached hash_type hash of the file, or None if it isn't cached
+    def peek_hash(self, file_path, hash_type):
+        hashes = self.lookup(os.stat(file_path))
+        if hashes is None:
+            return None
+        return hashes[hash_type]
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
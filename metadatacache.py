@@ -0,0 +1,125 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+# Caches remote path lookups (path to folder id, path to item metadata) so
+# the same folders aren't resolved over and over.  Entries expire after ttl
+# seconds, and the least recently used entries are dropped once max_entries
+# is reached.  If a path is given, entries are also kept in a SQLite file so
+# they can be reused by the next run.
+#
+# Only items that exist are cached.  Values must be JSON serializable.
+class MetadataCache(object):
+
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, ttl=300, max_entries=10000, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.db = None
+        self.pending_writes = 0
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata_cache "
+                            "(namespace TEXT, key TEXT, value TEXT, "
+                            "expires REAL, PRIMARY KEY (namespace, key))")
+            self.db.execute("DELETE FROM metadata_cache WHERE expires < ?",
+                            (time.time(),))
+            self.db.commit()
+
+    def get(self, namespace, key):
+        logger = logging.getLogger("multidrive")
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is not None:
+                (expires, value) = entry
+                if expires >= now:
+                    self.entries.move_to_end((namespace, key))
+                    return value
+                del self.entries[(namespace, key)]
+
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT value, expires FROM metadata_cache "
+                                  "WHERE namespace = ? AND key = ?",
+                                  (namespace, key)).fetchone()
+            if row is None or row[1] < now:
+                return None
+            value = json.loads(row[0])
+            self.store(namespace, key, value, row[1])
+            logger.debug("Metadata cache hit on disk: {} {}"
+                         .format(namespace, key))
+            return value
+
+    def set(self, namespace, key, value):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self.store(namespace, key, value, expires)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO metadata_cache "
+                                "VALUES (?, ?, ?, ?)",
+                                (namespace, key, json.dumps(value), expires))
+                self.written()
+
+    def store(self, namespace, key, value, expires):
+        self.entries[(namespace, key)] = (expires, value)
+        self.entries.move_to_end((namespace, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    # Removes key, and when descendants is set, every key below it in the
+    # path hierarchy.
+    def invalidate(self, namespace, key, descendants=False):
+        with self.lock:
+            self.entries.pop((namespace, key), None)
+            prefix = key.rstrip('/') + '/'
+            if descendants is True:
+                for cur_key in [cur_key for cur_key in self.entries
+                                if cur_key[0] == namespace and
+                                cur_key[1].startswith(prefix)]:
+                    del self.entries[cur_key]
+            if self.db is not None:
+                self.db.execute("DELETE FROM metadata_cache WHERE "
+                                "namespace = ? AND key = ?", (namespace, key))
+                if descendants is True:
+                    self.db.execute("DELETE FROM metadata_cache WHERE "
+                                    "namespace = ? AND substr(key, 1, ?) = ?",
+                                    (namespace, len(prefix), prefix))
+                self.written()
+
+    def written(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
@@ -20,11 +20,23 @@
 
 
 import argparse
+import asyncio
 import os
 import logging
+import sys
 from googledrivestorageservice import GoogleDriveStorageService
 from onedrivestorageservice import OneDriveStorageService
 from clouddrivestorageservice import CloudDriveStorageService
+from transferscheduler import TransferScheduler
+from metadatacache import MetadataCache
+from syncstate import SyncState
+from changefeed import ChangeFeedState
+from uploadjournal import UploadJournal
+from localhash import LocalHashCache
+from durability import DurabilityPolicy, DURABILITY_MODES
+from requestmetrics import RequestMetrics
+from progress import TransferProgress, PROGRESS_MODES
+from foldertree import create_folder_tree, get_local_folders
 import tempfile
 import shutil
 from _version import __version__
@@ -50,7 +62,7 @@ def main():
                         'values are clouddrive, onedrive and googledrive')
     parser.add_argument('-a', '--action', nargs=1, required=True,
                         help='action to perform, valid actions include '
-                        'download, upload, list, copy, and quota')
+                        'download, upload, list, copy, sync, and quota')
     parser.add_argument('-d', '--destination', nargs=1,
                         help='set secondary service for this command, Valid '
                         'values are clouddrive, onedrive and googledrive.  '
@@ -68,8 +80,100 @@ def main():
     parser.add_argument('-o', '--overwrite',
                         help='enable overwriting of files',
                         action='store_true')
+    parser.add_argument('--skipidentical',
+                        help='skip uploading files that are already on the '
+                        'remote service with the same size and hash',
+                        action='store_true')
     parser.add_argument('-b', '--debug', help="enable debug logging",
                         action='store_true')
+    parser.add_argument('-j', '--jobs', nargs=1, type=int, default=[1],
+                        help='number of files to transfer in parallel (for '
+                        'copy action)')
+    parser.add_argument('-p', '--stream',
+                        help='stream files directly between services '
+                        'without a local temporary file (for copy action)',
+                        action='store_true')
+    parser.add_argument('-n', '--connections', nargs=1, type=int,
+                        default=[4],
+                        help='number of connections each file is downloaded '
+                        'over (default 4)')
+    parser.add_argument('--durability', nargs=1, default=['file'],
+                        choices=DURABILITY_MODES,
+                        help='when downloaded files are synced to disk: '
+                        'none leaves it to the operating system, file syncs '
+                        'each one before it\'s renamed into place, batch '
+                        'syncs them in groups in the background and the '
+                        'rest at the end of the run (default file).  The '
+                        'temporary files of copies are never synced')
+    parser.add_argument('--preallocate',
+                        help='reserve the disk space for each downloaded '
+                        'file before downloading it',
+                        action='store_true')
+    parser.add_argument('--progress', nargs=1, default=['auto'],
+                        choices=PROGRESS_MODES,
+                        help='show the progress of uploads, downloads and '
+                        'copies on stderr: auto only on a terminal '
+                        '(default auto)')
+    parser.add_argument('--progressinterval', nargs=1, type=float,
+                        default=[1.0],
+                        help='number of seconds between progress updates '
+                        '(default 1)')
+    parser.add_argument('--metricsfile', nargs=1,
+                        help='append a line of JSON for each API call made '
+                        'to this file')
+    parser.add_argument('--prometheusfile', nargs=1,
+                        help='write the API call totals to this file at the '
+                        'end of the run, in the Prometheus text format')
+    parser.add_argument('--cachefile', nargs=1,
+                        help='keep remote path lookups in this file so they '
+                        'can be reused by later runs')
+    parser.add_argument('--cachettl', nargs=1, type=int, default=[300],
+                        help='number of seconds remote path lookups are '
+                        'cached for (default 300)')
+    parser.add_argument('--listjobs', nargs=1, type=int, default=[4],
+                        help='number of remote folders listed in parallel '
+                        '(default 4)')
+    parser.add_argument('--listrate', nargs=1, type=float,
+                        help='maximum number of remote folder listings per '
+                        'second for each service (default 10)')
+    parser.add_argument('--requestrate', nargs=1, type=float,
+                        help='maximum number of requests per second to each '
+                        'service.  The rate is lowered automatically while '
+                        'a service throttles requests (default 50)')
+    parser.add_argument('--poolsize', nargs=1, type=int,
+                        help='number of HTTP connections kept open to each '
+                        'service (default enough for the --jobs and '
+                        '--listjobs options, at least 10)')
+    parser.add_argument('--statefile', nargs=1,
+                        default=['multidrive_sync.db'],
+                        help='file recording the files transferred by the '
+                        'sync action (default multidrive_sync.db)')
+    parser.add_argument('--journalfile', nargs=1,
+                        default=['multidrive_uploads.db'],
+                        help='file recording upload sessions so interrupted '
+                        'uploads can be resumed (default '
+                        'multidrive_uploads.db)')
+    parser.add_argument('--hashfile', nargs=1,
+                        default=['multidrive_hashes.db'],
+                        help='file recording the hashes of local files so '
+                        'unchanged files aren\'t read again to hash them '
+                        '(for upload and sync actions, default '
+                        'multidrive_hashes.db)')
+    parser.add_argument('-i', '--incremental',
+                        help='only list the remote files added or changed '
+                        'since the last run, using the service\'s change '
+                        'feed (for list, download and copy actions)',
+                        action='store_true')
+    parser.add_argument('--asyncio',
+                        help='run the list, download and copy actions on a '
+                        'single asyncio event loop instead of a thread per '
+                        'transfer (onedrive and clouddrive only, requires '
+                        'aiohttp)',
+                        action='store_true')
+    parser.add_argument('--feedfile', nargs=1,
+                        default=['multidrive_changes.db'],
+                        help='file recording the change feed position for '
+                        'incremental runs (default multidrive_changes.db)')
 
     args = parser.parse_args()
 
@@ -77,6 +181,464 @@ def main():
     if service is None:
         raise ValueError("Please specify a valid source service.")
 
+    cache_path = None
+    if args.cachefile is not None:
+        cache_path = args.cachefile[0]
+    metadata_cache = MetadataCache(ttl=args.cachettl[0], path=cache_path)
+    upload_journal = None
+    if args.action[0].lower() in ("upload", "copy", "sync"):
+        upload_journal = UploadJournal(args.journalfile[0])
+    hash_cache = None
+    if args.action[0].lower() in ("upload", "sync") and args.local is not None:
+        hash_cache = LocalHashCache(args.hashfile[0])
+    # Copies only download to temporary files, which are deleted as soon
+    # as they're uploaded
+    durability_mode = args.durability[0]
+    if args.action[0].lower() == "copy":
+        durability_mode = 'none'
+    durability = DurabilityPolicy(durability_mode)
+    metrics_path = None
+    if args.metricsfile is not None:
+        metrics_path = args.metricsfile[0]
+    request_metrics = RequestMetrics(metrics_path)
+    progress = get_progress(args)
+    feed_state = None
+    if args.incremental is True:
+        feed_state = ChangeFeedState(args.feedfile[0],
+                                     scope=get_feed_scope(args))
+    try:
+        if args.asyncio is True:
+            run_async_action(args, metadata_cache, durability,
+                             request_metrics, progress)
+        else:
+            run_action(args, service, metadata_cache, feed_state,
+                       upload_journal, hash_cache, durability,
+                       request_metrics, progress)
+        # Only reached if the action succeeded, otherwise the next run
+        # starts from the same changes
+        if feed_state is not None:
+            feed_state.commit()
+    finally:
+        if progress is not None:
+            progress.close()
+        durability.close()
+        metadata_cache.close()
+        if feed_state is not None:
+            feed_state.close()
+        if upload_journal is not None:
+            upload_journal.close()
+        if hash_cache is not None:
+            hash_cache.close()
+        close_request_metrics(args, request_metrics)
+
+
+# TransferProgress for the action, or None if it isn't shown.  Copies
+# through a temp file download and then upload each file.
+def get_progress(args):
+    action = args.action[0].lower()
+    if action not in ("upload", "download", "copy"):
+        return None
+    mode = args.progress[0]
+    if mode == 'never' or (mode == 'auto' and not sys.stderr.isatty()):
+        return None
+    legs = 1
+    if action == "copy" and args.stream is False:
+        legs = 2
+    return TransferProgress('download' if action == "download" else 'upload',
+                            legs=legs, interval=args.progressinterval[0])
+
+
+# Adds cur_file, about to be transferred, to the files progress expects.
+# last is set if it's the last file of the job.
+def expect_file(progress, service, cur_file, last=False):
+    if progress is not None:
+        progress.expect(1, service.get_file_size(cur_file))
+        if last is True:
+            progress.all_expected()
+
+
+# Prints the summary of the API calls made by the run, on stderr so output
+# like listings isn't mixed with it, and writes the Prometheus textfile
+def close_request_metrics(args, request_metrics):
+    request_metrics.close()
+    if args.prometheusfile is not None:
+        request_metrics.write_prometheus(args.prometheusfile[0])
+    if not request_metrics.is_empty():
+        print(request_metrics.format_summary(), file=sys.stderr)
+
+
+# Incremental runs for different actions or destinations keep separate
+# change feed positions.
+def get_feed_scope(args):
+    scope = args.action[0].lower()
+    if scope == "download":
+        local_path = os.curdir
+        if args.local is not None:
+            local_path = args.local[0]
+        scope += ":" + os.path.abspath(local_path)
+    elif scope == "copy" and args.destination is not None:
+        scope += ":" + args.destination[0].lower()
+        if args.secondaryremote is not None:
+            scope += ":" + args.secondaryremote[0].strip('/')
+    return scope
+
+
+def configure_service(args, service, metadata_cache, upload_journal=None,
+                      hash_cache=None, durability=None, request_metrics=None,
+                      progress=None):
+    service.metadata_cache = metadata_cache
+    service.request_metrics = request_metrics
+    service.progress = progress
+    service.upload_journal = upload_journal
+    if hash_cache is not None:
+        service.hash_cache = hash_cache
+    if durability is not None:
+        service.durability = durability
+    service.preallocate = args.preallocate
+    service.listing_jobs = args.listjobs[0]
+    service.download_connections = args.connections[0]
+    service.skip_identical = args.skipidentical
+    if args.listrate is not None:
+        service.listing_rate = args.listrate[0]
+    if args.requestrate is not None:
+        service.max_request_rate = args.requestrate[0]
+    if args.poolsize is not None:
+        service.http_pool_size = args.poolsize[0]
+    else:
+        # Each transfer job may have a download over several connections
+        # and an upload in flight, on top of the folder listings
+        service.http_pool_size = max(10, args.jobs[0] *
+                                     (args.connections[0] + 1) +
+                                     args.listjobs[0])
+
+
+def get_secondary_service(args, metadata_cache, upload_journal=None,
+                          request_metrics=None, progress=None):
+    if args.destination is None:
+        raise ValueError("Please specify a destination for copy "
+                         "operation.")
+    service2 = get_storage_service(args.destination[0])
+    if service2 is None:
+        raise ValueError("Please specify a valid secondary source "
+                         "service.")
+    configure_service(args, service2, metadata_cache, upload_journal,
+                      request_metrics=request_metrics, progress=progress)
+    service2.authorize()
+    return service2
+
+
+def list_remote_folder(service, folder_path, feed_state):
+    if feed_state is None:
+        return service.list_folder(folder_path)
+    return service.list_folder_changes(folder_path, feed_state)
+
+
+# The asyncio services are imported here so aiohttp is only needed for the
+# --asyncio option.
+def get_async_storage_service(service_name):
+    if service_name.lower() == 'onedrive':
+        from asynconedrivestorageservice import AsyncOneDriveStorageService
+        return AsyncOneDriveStorageService()
+    elif service_name.lower() == 'clouddrive':
+        from asyncclouddrivestorageservice import \
+            AsyncCloudDriveStorageService
+        return AsyncCloudDriveStorageService()
+    return None
+
+
+def run_async_action(args, metadata_cache, durability=None,
+                     request_metrics=None, progress=None):
+    action = args.action[0].lower()
+    if action not in ("list", "download", "copy"):
+        raise ValueError("The asyncio option is only valid with the list, "
+                         "download and copy actions.")
+    if args.incremental is True:
+        raise ValueError("The incremental option can't be used with the "
+                         "asyncio option.")
+    service = get_async_storage_service(args.source[0])
+    if service is None:
+        raise ValueError("The asyncio option is only available for "
+                         "onedrive and clouddrive.")
+    configure_service(args, service.service, metadata_cache,
+                      durability=durability, request_metrics=request_metrics,
+                      progress=progress)
+    service2 = None
+    if action == "copy":
+        if args.destination is None:
+            raise ValueError("Please specify a destination for copy "
+                             "operation.")
+        service2 = get_async_storage_service(args.destination[0])
+        if service2 is None:
+            raise ValueError("The asyncio option is only available for "
+                             "onedrive and clouddrive.")
+        configure_service(args, service2.service, metadata_cache,
+                          request_metrics=request_metrics,
+                          progress=progress)
+    if args.debug is True:
+        logging.getLogger("multidrive").setLevel(logging.DEBUG)
+    asyncio.run(run_async_services(args, service, service2))
+
+
+async def run_async_services(args, service, service2):
+    try:
+        await service.authorize()
+        if service2 is not None:
+            await service2.authorize()
+        await run_async_action_loop(args, service, service2)
+    finally:
+        await service.close()
+        if service2 is not None:
+            await service2.close()
+
+
+# Runs transfer(cur_file, path) for the files in remote_files, with up to
+# jobs of them at once.  Folders are passed to create_folder(cur_file,
+# path) instead, before any of their contents.
+async def run_async_transfers(jobs, service, remote_files, transfer,
+                              create_folder):
+    logger = logging.getLogger("multidrive")
+    slots = asyncio.Semaphore(jobs)
+    tasks = set()
+    errors = []
+
+    async def run_transfer(cur_file, path):
+        try:
+            await transfer(cur_file, path)
+        except Exception as err:
+            logger.warning("Transfer of {} failed: {}"
+                           .format(service.get_file_name(cur_file), err))
+            errors.append(err)
+        finally:
+            slots.release()
+
+    try:
+        async for (cur_file, path) in remote_files:
+            if errors:
+                break
+            if service.is_folder_from_file_type(cur_file):
+                await create_folder(cur_file, path)
+                continue
+            expect_file(service.service.progress, service, cur_file)
+            await slots.acquire()
+            task = asyncio.ensure_future(run_transfer(cur_file, path))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if service.service.progress is not None:
+            service.service.progress.all_expected()
+    finally:
+        if tasks:
+            await asyncio.wait(list(tasks))
+    if errors:
+        raise errors[0]
+
+
+async def run_async_action_loop(args, service, service2):
+    action = args.action[0].lower()
+    if args.remote is None:
+        raise ValueError("Please specify a remote file or folder.")
+    remote_path = args.remote[0]
+
+    if action == "list":
+        if await service.is_folder(remote_path) is False:
+            raise ValueError("Remote path is either does not exist or is not "
+                             "a folder")
+        async for (cur_file, path) in service.list_folder(remote_path):
+            new_path = list(path)
+            new_path.append(service.get_file_name(cur_file))
+            print("/".join(new_path))
+
+    elif action == "download":
+        local_path = None
+        if args.local is not None:
+            local_path = args.local[0]
+        if await service.is_folder(remote_path) is False:
+            cur_file = await service.get_file_by_path(remote_path)
+            expect_file(service.service.progress, service, cur_file,
+                        last=True)
+            await service.download_item(cur_file, local_path,
+                                        overwrite=args.overwrite)
+            return
+
+        def get_destination(path):
+            if local_path is None:
+                if len(path) == 0:
+                    return None
+                return os.path.join(*path)
+            return os.path.join(local_path, *path)
+
+        async def download_file(cur_file, path):
+            await service.download_item(cur_file,
+                                        destination=get_destination(path),
+                                        overwrite=args.overwrite,
+                                        create_folder=True)
+        await run_async_transfers(args.jobs[0], service,
+                                  service.list_folder(remote_path),
+                                  download_file, download_file)
+
+    elif action == "copy":
+        if args.secondaryremote is None:
+            raise ValueError("Please specify a secondary remote file or "
+                             "folder to copy to.")
+        destination_root = args.secondaryremote[0]
+        if await service2.is_folder(destination_root) is False:
+            if args.createfolder is False:
+                raise ValueError("Secondary remote folder does not exist. "
+                                 "Use the createfolder option to create it")
+            await service2.create_folder(destination_root)
+
+        tmp_path = tempfile.mkdtemp()
+        try:
+            async def copy_file(cur_file, path):
+                cur_dest = "/".join([destination_root] + list(path))
+                # Each file gets its own folder so files with the same name
+                # from different source folders don't collide.
+                task_path = tempfile.mkdtemp(dir=tmp_path)
+                try:
+                    (local_temp, last_mod) = await service.download_item(
+                        cur_file, destination=task_path,
+                        overwrite=args.overwrite)
+                    await service2.upload(local_temp, destination=cur_dest,
+                                          modified_time=last_mod,
+                                          create_folder=args.createfolder,
+                                          overwrite=args.overwrite)
+                finally:
+                    shutil.rmtree(task_path)
+
+            async def copy_folder(cur_file, path):
+                cur_dest = "/".join([destination_root] + list(path) +
+                                    [service.get_file_name(cur_file)])
+                if await service2.is_folder(cur_dest) is False:
+                    await service2.create_folder(cur_dest)
+
+            if await service.is_folder(remote_path) is True:
+                await run_async_transfers(args.jobs[0], service,
+                                          service.list_folder(remote_path),
+                                          copy_file, copy_folder)
+            else:
+                cur_file = await service.get_file_by_path(remote_path)
+                expect_file(service.service.progress, service, cur_file,
+                            last=True)
+                await copy_file(cur_file, [])
+        finally:
+            shutil.rmtree(tmp_path)
+
+
+# Uploads the files in a local folder that changed since the last sync into
+# a remote folder.
+def sync_upload(args, service, sync_state):
+    base_local_path = args.local[0]
+    if not os.path.isdir(base_local_path):
+        raise ValueError("Please specify a local folder to sync.")
+    destination = ""
+    if args.remote is not None:
+        destination = args.remote[0].strip('/')
+    if len(destination) > 0 and service.is_folder(destination) is False:
+        if args.createfolder is False:
+            raise ValueError("Non-existant folder necessary but create "
+                             "folder not set.")
+        service.create_folder(destination)
+
+    sync_key = ("local:" + os.path.abspath(base_local_path) + "->" +
+                service.service_name + ":" + destination)
+    num_transferred = 0
+    num_skipped = 0
+    for (root, dirs, files) in os.walk(base_local_path):
+        dirs.sort()
+        rel_root = os.path.relpath(root, base_local_path)
+        rel_parts = []
+        if rel_root != os.curdir:
+            rel_parts = rel_root.split(os.sep)
+        cur_remote_path = "/".join([part for part in [destination] +
+                                    rel_parts if len(part) > 0])
+        changed_files = []
+        for cur_file in sorted(files):
+            local_path = os.path.join(root, cur_file)
+            rel_path = "/".join(rel_parts + [cur_file])
+            stat = os.stat(local_path)
+            if sync_state.is_unchanged(sync_key, rel_path, stat.st_size,
+                                       stat.st_mtime_ns):
+                num_skipped += 1
+                continue
+            changed_files.append((cur_file, local_path, rel_path, stat))
+        if len(changed_files) > 0 and (len(cur_remote_path) == 0 or
+                                       service.is_folder(cur_remote_path)):
+            service.prefetch_files(cur_remote_path or None,
+                                   [changed[0] for changed in changed_files])
+        for (cur_file, local_path, rel_path, stat) in changed_files:
+            new_file = service.upload(local_path,
+                                      destination=cur_remote_path or None,
+                                      create_folder=True,
+                                      overwrite=True)
+            if new_file is None:
+                raise RuntimeError("Unable to upload " + local_path)
+            sync_state.record(sync_key, rel_path, stat.st_size,
+                              stat.st_mtime_ns,
+                              service.get_file_hash(new_file)[1])
+            num_transferred += 1
+    print("Sync complete: {} file(s) transferred, {} unchanged file(s) "
+          "skipped".format(num_transferred, num_skipped))
+
+
+# Copies the files in a remote folder that changed since the last sync to
+# a folder on another service.
+def sync_copy(args, service, service2, sync_state):
+    if args.remote is None or service.is_folder(args.remote[0]) is False:
+        raise ValueError("Please specify a remote folder to sync.")
+    if args.secondaryremote is None:
+        raise ValueError("Please specify a secondary remote folder to sync "
+                         "to.")
+    source_root = args.remote[0].strip('/')
+    destination_root = args.secondaryremote[0].strip('/')
+    if service2.is_folder(destination_root) is False:
+        if args.createfolder is False:
+            raise ValueError("Secondary remote folder does not exist. Use "
+                             "the createfolder option to create it")
+        service2.create_folder(destination_root)
+
+    sync_key = (service.service_name + ":" + source_root + "->" +
+                service2.service_name + ":" + destination_root)
+    num_skipped = 0
+    num_submitted = 0
+    scheduler = TransferScheduler(service, service2, jobs=args.jobs[0],
+                                  overwrite=True, create_folder=True,
+                                  stream=args.stream)
+    try:
+        for (cur_file, path) in service.list_folder(source_root):
+            cur_dest = "/".join([destination_root] + list(path))
+            if service.is_folder_from_file_type(cur_file):
+                cur_dest += "/" + service.get_file_name(cur_file)
+                if not service2.is_folder(cur_dest):
+                    service2.create_folder(cur_dest)
+                continue
+
+            rel_path = "/".join(list(path) +
+                                [service.get_file_name(cur_file)])
+            size = service.get_file_size(cur_file)
+            mtime = service.get_modified_time(cur_file)
+            remote_hash = service.get_file_hash(cur_file)[1]
+            if sync_state.is_unchanged(sync_key, rel_path, size, mtime,
+                                       remote_hash):
+                num_skipped += 1
+                continue
+
+            def record(new_file, rel_path=rel_path, size=size, mtime=mtime,
+                       remote_hash=remote_hash):
+                sync_state.record(sync_key, rel_path, size, mtime,
+                                  remote_hash)
+            scheduler.submit(cur_file, cur_dest, on_complete=record)
+            num_submitted += 1
+        scheduler.join()
+    finally:
+        scheduler.close()
+    print("Sync complete: {} file(s) transferred, {} unchanged file(s) "
+          "skipped".format(num_submitted, num_skipped))
+
+
+def run_action(args, service, metadata_cache, feed_state=None,
+               upload_journal=None, hash_cache=None, durability=None,
+               request_metrics=None, progress=None):
+    configure_service(args, service, metadata_cache, upload_journal,
+                      hash_cache, durability, request_metrics, progress)
     service.authorize()
     if args.debug is True:
         logging.getLogger("multidrive").setLevel(logging.DEBUG)
@@ -104,22 +666,41 @@ def main():
                 if args.createfolder is False:
                     raise ValueError("Non-existant folder necessary but create folder not set.")
                 service.create_folder(base_remote_path)
+            # Creates the missing folders from one remote listing and
+            # caches them all for the uploads.  Whether each file exists is
+            # answered from the same listing.
+            (folder_ids, folder_children) = create_folder_tree(
+                service, base_remote_path,
+                get_local_folders(base_local_path),
+                create=args.createfolder)
+            if progress is not None:
+                for (root, dirs, files) in os.walk(base_local_path):
+                    progress.expect(len(files),
+                                    sum(os.path.getsize(os.path.join(root,
+                                                                     name))
+                                        for name in files))
+                progress.all_expected()
             for (root, dirs, files) in os.walk(base_local_path):
-                for cur_dir in dirs:
-                    cur_remote_path = base_remote_path+root[len(base_local_path):]+"/"+cur_dir
-                    if service.is_folder(destination) is False:
-                        if args.createfolder is False:
-                            raise ValueError("Non-existant folder necessary but create folder not set.")
-                        service.create_folder(cur_remote_path)
+                cur_remote_path = base_remote_path+root[len(base_local_path):]
+                rel_root = os.path.relpath(root, base_local_path)
+                if rel_root == os.curdir:
+                    rel_root = ""
+                service.prefetch_files(cur_remote_path, files,
+                                       folder_children.get(
+                                           rel_root.replace(os.sep, "/"),
+                                           []))
                 for cur_file in files:
                     service.upload(os.path.join(root, cur_file),
-                                   destination=base_remote_path+root[len(base_local_path):],
+                                   destination=cur_remote_path,
                                    create_folder=args.createfolder,
                                    overwrite=args.overwrite)
 
 
 
         else:
+            if progress is not None:
+                progress.expect(1, os.path.getsize(args.local[0]))
+                progress.all_expected()
             service.upload(args.local[0], destination=destination,
                            create_folder=args.createfolder,
                            overwrite=args.overwrite)
@@ -134,7 +715,17 @@ def main():
         if service.is_folder(args.remote[0]) is True:
             # TODO: Give an error earlier if the
             # destination folder doesn't exist
-            remote_files = service.list_folder(args.remote[0])
+            remote_files = list_remote_folder(service, args.remote[0],
+                                              feed_state)
+            # Files are downloaded one at a time as they're listed, so the
+            # listing is finished first to show the time left for all of
+            # them
+            if progress is not None:
+                remote_files = list(remote_files)
+                for (cur_file, path) in remote_files:
+                    if not service.is_folder_from_file_type(cur_file):
+                        expect_file(progress, service, cur_file)
+                progress.all_expected()
             for (cur_file, path) in remote_files:
                 destination = None
                 if local_path is None:
@@ -151,6 +742,10 @@ def main():
                                       overwrite=args.overwrite,
                                       create_folder=True)
         else:
+            if progress is not None:
+                expect_file(progress, service,
+                            service.get_file_by_path(args.remote[0]),
+                            last=True)
             service.download(args.remote[0],
                              local_path,
                              overwrite=args.overwrite)
@@ -160,19 +755,15 @@ def main():
         if service.is_folder(args.remote[0]) is False:
             raise ValueError("Remote path is either does not exist or is not "
                              "a folder")
-        for (cur_file, path) in service.list_folder(args.remote[0]):
+        for (cur_file, path) in list_remote_folder(service, args.remote[0],
+                                                   feed_state):
             new_path = list(path)
             new_path.append(service.get_file_name(cur_file))
             print("/".join(new_path))
     elif args.action[0].lower() == "copy":
-        if args.destination is None:
-            raise ValueError("Please specify a destination for copy "
-                             "operation.")
-        service2 = get_storage_service(args.destination[0])
-        service2.authorize()
-        if service2 is None:
-            raise ValueError("Please specify a valid secondary source "
-                             "service.")
+        service2 = get_secondary_service(args, metadata_cache,
+                                         upload_journal, request_metrics,
+                                         progress)
         if args.source[0].lower() == args.secondaryremote[0].lower():
             raise ValueError("Primary and secondary services must be "
                              "different")
@@ -191,29 +782,50 @@ def main():
         tmp_path = tempfile.mkdtemp()
         try:
             if service.is_folder(args.remote[0]) is True:
-                remote_files = service.list_folder(args.remote[0])
-                for (cur_file, path) in remote_files:
+                remote_files = list_remote_folder(service, args.remote[0],
+                                                  feed_state)
+                scheduler = TransferScheduler(service, service2,
+                                              jobs=args.jobs[0],
+                                              overwrite=args.overwrite,
+                                              create_folder=args.createfolder,
+                                              stream=args.stream)
+                try:
+                    for (cur_file, path) in remote_files:
 
-                    cur_dest = args.secondaryremote[0]
-                    if len(path) > 0:
-                        cur_dest = os.path.join(cur_dest, *path)
+                        cur_dest = args.secondaryremote[0]
+                        if len(path) > 0:
+                            cur_dest = os.path.join(cur_dest, *path)
 
-                    if service.is_folder_from_file_type(cur_file):
-                        if not service2.is_folder(cur_dest):
-                            service2.create_folder(cur_dest)
-                    else:
-                        (local_temp,
-                         last_mod) = (service.download_item(
-                                      cur_file,
-                                      destination=tmp_path,
-                                      overwrite=args.overwrite))
-
-                        service2.upload(local_temp, destination=cur_dest,
-                                        modified_time=last_mod,
-                                        create_folder=args.createfolder,
-                                        overwrite=args.overwrite)
-                        os.remove(local_temp)
+                        # Folders are listed before their contents, so they
+                        # are created here before any of their files are
+                        # handed to the scheduler.
+                        if service.is_folder_from_file_type(cur_file):
+                            if not service2.is_folder(cur_dest):
+                                service2.create_folder(cur_dest)
+                        else:
+                            expect_file(progress, service, cur_file)
+                            scheduler.submit(cur_file, cur_dest)
+                    if progress is not None:
+                        progress.all_expected()
+                    scheduler.join()
+                finally:
+                    scheduler.close()
+            elif args.stream is True:
+                cur_file = service.get_file_by_path(args.remote[0])
+                expect_file(progress, service, cur_file, last=True)
+                scheduler = TransferScheduler(service, service2,
+                                              overwrite=args.overwrite,
+                                              create_folder=args.createfolder,
+                                              stream=True)
+                try:
+                    scheduler.stream_file(cur_file, args.secondaryremote[0])
+                finally:
+                    scheduler.close()
             else:
+                if progress is not None:
+                    expect_file(progress, service,
+                                service.get_file_by_path(args.remote[0]),
+                                last=True)
                 (local_temp, last_mod) = (service.download(
                                           args.remote[0], tmp_path,
                                           overwrite=args.overwrite))
@@ -225,6 +837,21 @@ def main():
                 os.remove(local_temp)
         finally:
             shutil.rmtree(tmp_path)
+    elif args.action[0].lower() == "sync":
+        sync_state = SyncState(args.statefile[0])
+        try:
+            if args.destination is not None:
+                service2 = get_secondary_service(args, metadata_cache,
+                                                 upload_journal,
+                                                 request_metrics)
+                sync_copy(args, service, service2, sync_state)
+            else:
+                if args.local is None:
+                    raise ValueError("Please specify a local folder to "
+                                     "sync.")
+                sync_upload(args, service, sync_state)
+        finally:
+            sync_state.close()
     elif args.action[0].lower() == "quota":
         print(service.get_quota())
     else:
@@ -0,0 +1,134 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import queue
+import threading
+import uuid
+
+
+# multipart/form-data request body of some text fields followed by a file,
+# produced in large blocks as the request is sent.
+#
+# The size of the file is given up front, so the length of the whole body
+# is known (len()) and it's sent with a Content-Length instead of chunked.
+# Iterating over the body opens the file with open_file() and yields it a
+# BLOCK_SIZE block at a time, hashing it with MD5 as it goes, so the same
+# body can be sent again on a retry.  With hash_in_thread, blocks are
+# hashed by another thread while the next ones are sent.
+#
+# bytes_sent and content_sent count the bytes of the body and of the file
+# handed to the connection by the current (or last) attempt.  progress, a
+# FileProgress, is updated with the file's blocks as they're sent.
+class MultipartBody(object):
+
+    BLOCK_SIZE = 1024*1024
+    # Blocks waiting for the hashing thread
+    HASH_QUEUE_SIZE = 8
+
+    def __init__(self, fields, file_field, file_name, open_file, file_size,
+                 content_type, hash_in_thread=False, progress=None):
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        self.open_file = open_file
+        self.file_size = file_size
+        self.hash_in_thread = hash_in_thread
+        self.progress = progress
+
+        head = ""
+        for (name, value) in fields:
+            head += ("--{}\r\nContent-Disposition: form-data; name=\"{}\""
+                     "\r\n\r\n{}\r\n".format(boundary, quote(name), value))
+        head += ("--{}\r\nContent-Disposition: form-data; name=\"{}\"; "
+                 "filename=\"{}\"\r\nContent-Type: {}\r\n\r\n"
+                 .format(boundary, quote(file_field), quote(file_name),
+                         content_type))
+        self.head = head.encode('utf-8')
+        self.tail = "\r\n--{}--\r\n".format(boundary).encode('utf-8')
+
+        self.bytes_sent = 0
+        self.content_sent = 0
+        self.file_hash = None
+        self.complete = False
+
+    def __len__(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    def __iter__(self):
+        self.bytes_sent = 0
+        self.content_sent = 0
+        self.file_hash = hashlib.md5()
+        self.complete = False
+        if self.progress is not None:
+            self.progress.reset()
+
+        hash_queue = None
+        hasher = None
+        if self.hash_in_thread is True:
+            hash_queue = queue.Queue(maxsize=self.HASH_QUEUE_SIZE)
+            hasher = threading.Thread(target=hash_blocks,
+                                      args=(self.file_hash, hash_queue))
+            hasher.daemon = True
+            hasher.start()
+
+        try:
+            self.bytes_sent += len(self.head)
+            yield self.head
+            with self.open_file() as f:
+                while True:
+                    block = f.read(self.BLOCK_SIZE)
+                    if len(block) == 0:
+                        break
+                    if self.content_sent + len(block) > self.file_size:
+                        raise RuntimeError("File changed size during upload")
+                    if hash_queue is not None:
+                        hash_queue.put(block)
+                    else:
+                        self.file_hash.update(block)
+                    self.content_sent += len(block)
+                    self.bytes_sent += len(block)
+                    if self.progress is not None:
+                        self.progress.add(len(block))
+                    yield block
+            if self.content_sent != self.file_size:
+                raise RuntimeError("File changed size during upload")
+        finally:
+            if hasher is not None:
+                hash_queue.put(None)
+                hasher.join()
+        self.complete = True
+        self.bytes_sent += len(self.tail)
+        yield self.tail
+
+    def get_md5(self):
+        if self.complete is False:
+            raise RuntimeError("Did not complete hash of file.")
+        return self.file_hash.hexdigest()
+
+
+def hash_blocks(file_hash, hash_queue):
+    while True:
+        block = hash_queue.get()
+        if block is None:
+            break
+        file_hash.update(block)
+
+
+# Quotes a header parameter the way browsers do for form data
+def quote(value):
+    return (value.replace("\\", "\\\\").replace('"', "%22")
+            .replace("\r", "%0D").replace("\n", "%0A"))
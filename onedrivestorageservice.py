@@ -24,19 +24,22 @@ import urllib.parse
 from urllib.parse import urlparse, parse_qs
 import os
 from enum import Enum
-import hashlib
 import logging
 
 import time
 
-from storageservice import StorageService
+from storageservice import StorageService, ItemDoesNotExistError
+from streampipe import StreamPipe
+from localfilereader import LocalFileReader
+from uploadjournal import get_source_id
+from changefeed import apply_changes
 
 
-class ItemDoesNotExistError(RuntimeError):
+class RemoteConnectionError(RuntimeError):
     pass
 
 
-class RemoteConnectionError(RuntimeError):
+class HashMismatch(RuntimeError):
     pass
 
 
@@ -61,8 +64,19 @@ class RequestType(Enum):
 
 class OneDriveStorageService(StorageService):
 
+    service_name = "onedrive"
     onedrive_url_root = "https://api.onedrive.com/v1.0"
 
+    # Upload fragments must be a multiple of 320 KiB and less than 60 MiB
+    CHUNK_UNIT = 320*1024
+    INITIAL_CHUNK_SIZE = 32*CHUNK_UNIT
+    MIN_CHUNK_SIZE = 16*CHUNK_UNIT
+    MAX_CHUNK_SIZE = 180*CHUNK_UNIT
+    CHUNK_SECONDS = 10
+    UPLOAD_READ_SIZE = 4*CHUNK_UNIT
+    # Bytes of the file read ahead of the fragment being sent
+    upload_read_ahead = 32*1024*1024
+
     def authorize(self):
         self.__app_folder__ = False
         logger = logging.getLogger("multidrive")
@@ -98,26 +112,32 @@ class OneDriveStorageService(StorageService):
                 data['access_token'],
                 int(data['expires_in']))
 
-    def http_request(self, url, request_type, status_codes=(), headers={},
-                     stream=False, data="", params=None,
+    def http_request(self, url, request_type, status_codes=(),
+                     headers=None, stream=False, data="", params=None,
                      severe_status_codes=(),
                      use_access_token=False, action_string="OneDrive HTTP",
                      max_tries=6, timeout=120):
         logger = logging.getLogger("multidrive")
+        session = self.get_session()
+        limiter = self.get_request_limiter()
+        started = time.monotonic()
 
+        # Copy the headers, requests may be made from several threads
+        headers = {} if headers is None else dict(headers)
         if use_access_token is True:
             headers['Authorization'] = "Bearer " + self.get_access_token()
 
+        limiter.acquire()
         try:
             if request_type == RequestType.GET:
-                response = requests.get(url, headers=headers, params=params,
-                                        stream=stream, timeout=timeout)
+                response = session.get(url, headers=headers, params=params,
+                                       stream=stream, timeout=timeout)
             elif request_type == RequestType.PUT:
-                response = requests.put(url, headers=headers, data=data,
-                                        params=params, timeout=timeout)
+                response = session.put(url, headers=headers, data=data,
+                                       params=params, timeout=timeout)
             elif request_type == RequestType.POST:
-                response = requests.post(url, headers=headers, data=data,
-                                         timeout=timeout)
+                response = session.post(url, headers=headers, data=data,
+                                        timeout=timeout)
         except requests.exceptions.ConnectionError as err:
                 logger.warning("ConnectionError: {}".format(err))
                 response = None
@@ -125,6 +145,8 @@ class OneDriveStorageService(StorageService):
                 logger.warning("Timeout: {}".format(err))
                 response = None
 
+        # Attempts that got a response, and so sent the body
+        responses = 0 if response is None else 1
         tries = 0
         while response is None or (response.status_code not in status_codes
                                    and tries < max_tries):
@@ -138,18 +160,19 @@ class OneDriveStorageService(StorageService):
                 logger.warning("Error: {}".format(response.text))
                 logger.warning("Headers: {}".format(str(response.headers)))
 
-                if 'Retry-After' in response.headers:
-                    logger.warning("Server requested wait of {} seconds".
-                                   format(response.headers['Retry-After']))
-                    sleep_length = int(response.headers['Retry-After'])
+                # The limiter holds every request to the service while
+                # it's throttled, including the next attempt
+                if self.check_throttled(response.status_code,
+                                        response.headers, sleep_length):
+                    sleep_length = 0
                 elif response.status_code in severe_status_codes:
                     logger.warning("Server Error, increasing wait time")
                     sleep_length *= 20
 
-            logger.warning("Waiting {} second(s) for next attempt"
-                           .format(str(sleep_length)))
-
-            time.sleep(sleep_length)
+            if sleep_length > 0:
+                logger.warning("Waiting {} second(s) for next attempt"
+                               .format(str(sleep_length)))
+                time.sleep(sleep_length)
             # Force refresh of token once in case it's expired
             if (tries == 1):
                 self.refresh_access_token()
@@ -157,25 +180,30 @@ class OneDriveStorageService(StorageService):
             if use_access_token is True:
                 headers['Authorization'] = "Bearer " + self.get_access_token()
 
+            limiter.acquire()
             try:
                 if request_type == RequestType.GET:
-                    response = requests.get(url, headers=headers,
-                                            params=params, stream=stream,
-                                            timeout=timeout)
+                    response = session.get(url, headers=headers,
+                                           params=params, stream=stream,
+                                           timeout=timeout)
                 elif request_type == RequestType.PUT:
-                    response = requests.put(url, headers=headers, data=data,
-                                            params=params, timeout=timeout)
+                    response = session.put(url, headers=headers, data=data,
+                                           params=params, timeout=timeout)
                 elif request_type == RequestType.POST:
-                    response = requests.post(url, headers=headers, data=data,
-                                             timeout=timeout)
+                    response = session.post(url, headers=headers, data=data,
+                                            timeout=timeout)
             except requests.exceptions.ConnectionError as err:
                 logger.warning("ConnectionError: {}".format(err))
                 response = None
             except requests.exceptions.Timeout as err:
                 logger.warning("Timeout: {}".format(err))
                 response = None
+            if response is not None:
+                responses += 1
 
         if response is None:
+            self.record_response(action_string, None, False, tries, data,
+                                 responses, started)
             logger.warning("Connection failed.")
             raise RemoteConnectionError("Unable to complete request.")
 
@@ -185,9 +213,14 @@ class OneDriveStorageService(StorageService):
             logger.warning("Error: {}".format(response.text))
             logger.warning("Headers: {}".format(str(response.headers)))
             logger.warning("Retry " + str(tries))
+            self.record_response(action_string, response, False, tries, data,
+                                 responses, started, stream)
             raise RemoteConnectionError("{}: Unable to complete request."
                                         .format(action_string))
 
+        limiter.succeeded()
+        self.record_response(action_string, response, True, tries, data,
+                             responses, started, stream)
         return response
 
     def get_access_token(self):
@@ -269,6 +302,47 @@ class OneDriveStorageService(StorageService):
         logger.info("Upload {} OneDrive Storage Service".format(file_path))
 
         file_name = os.path.basename(file_path)
+        file_size = os.path.getsize(file_path)
+        with self.track_progress(file_name, file_size, 'upload') as progress:
+            return self.upload_fileobj(lambda: open(file_path, "rb"),
+                                       file_name, file_size,
+                                       destination=destination,
+                                       create_folder=create_folder,
+                                       overwrite=overwrite,
+                                       source_id=get_source_id(file_path),
+                                       local_path=file_path,
+                                       progress=progress)
+
+    def upload_stream(self, stream, file_name, file_size, destination=None,
+                      modified_time=None, create_folder=False,
+                      overwrite=False):
+        logger = logging.getLogger("multidrive")
+        logger.info("Upload stream {} OneDrive Storage Service"
+                    .format(file_name))
+
+        # A stream can only be read once, so there's no retry on a hash
+        # mismatch here.  The caller retries with a new stream.
+        with self.track_progress(file_name, file_size, 'upload') as progress:
+            return self.upload_fileobj(stream.open, file_name, file_size,
+                                       destination=destination,
+                                       create_folder=create_folder,
+                                       overwrite=overwrite, num_attempts=1,
+                                       progress=progress)
+
+    # open_file is called once per attempt and should return a new file
+    # object positioned at the start of the data.
+    #
+    # source_id identifies the local file being uploaded, so an interrupted
+    # upload can be resumed by a later run.  Uploads without one always
+    # start from the beginning.  local_path is the path of the local file,
+    # if any, for skip_identical.  progress is the FileProgress of the
+    # upload, or None.
+    def upload_fileobj(self, open_file, file_name, file_size,
+                       destination=None, create_folder=False,
+                       overwrite=False, num_attempts=5, source_id=None,
+                       local_path=None, progress=None):
+        logger = logging.getLogger("multidrive")
+
         full_remote_path = file_name
         if destination is not None:
             if self.is_folder(destination) is False:
@@ -280,7 +354,21 @@ class OneDriveStorageService(StorageService):
                 destination = destination+"/"
             full_remote_path = destination+full_remote_path
 
-        file_size = os.path.getsize(file_path)
+        # A file known to exist is reported without starting an upload
+        existing_file = self.take_prefetched_file(
+            self.get_prefetch_key(destination), file_name)
+        if local_path is not None and self.skip_identical is True:
+            if existing_file is False:
+                existing_file = self.get_item(item_path=full_remote_path)
+            if (existing_file is not None and
+                    self.is_identical(local_path, existing_file)):
+                print("{} is unchanged, skipping".format(file_name))
+                return existing_file
+        if existing_file not in (None, False) and overwrite is False:
+            raise RuntimeError("File already exists")
+
+        # The cached metadata of the file is stale once it's replaced
+        self.invalidate_cached("item", full_remote_path)
 
         payload = {}
         payload["@name.conflictBehavior"] = "fail"
@@ -310,52 +398,94 @@ class OneDriveStorageService(StorageService):
             if response.status_code in (requests.codes.conflict,):
                 raise RuntimeError("File already exists")
             logger.info("Upload complete")
-            return
+            return json.loads(response.text)
 
-        NUM_ATTEMPTS = 5
         cur_attempt = 1
-        while cur_attempt <= NUM_ATTEMPTS:
-            headers = {'Content-Type': "application/json"}
-
-            url = (self.onedrive_url_root+"/drive/root:/" +
-                   urllib.parse.quote(full_remote_path) +
-                   ":/upload.createSession")
+        while cur_attempt <= num_attempts:
+            chunk_size = self.INITIAL_CHUNK_SIZE
+            chunk_start = 0
+            response = None
+            local_hash = None
+
+            url = None
+            journaled = self.load_upload_session(full_remote_path, source_id)
+            if journaled is not None:
+                upload_status = self.get_resumable_status(
+                    journaled[0]['uploadUrl'])
+                if (upload_status is not None and
+                        'nextExpectedRanges' in upload_status):
+                    url = journaled[0]['uploadUrl']
+                    chunk_start = int(upload_status['nextExpectedRanges']
+                                      [0].split("-")[0])
+                    logger.info("Resuming upload of {} at byte {}"
+                                .format(full_remote_path, chunk_start))
+            if progress is not None:
+                progress.reset(chunk_start)
+
+            if url is None:
+                headers = {'Content-Type': "application/json"}
 
-            if self.__app_folder__:
-                url = (self.onedrive_url_root+"/drive/special/approot:/" +
+                url = (self.onedrive_url_root+"/drive/root:/" +
                        urllib.parse.quote(full_remote_path) +
                        ":/upload.createSession")
 
-            response = self.http_request(url=url,
-                                         request_type=RequestType.POST,
-                                         status_codes=(requests.codes.ok,),
-                                         headers=headers,
-                                         data=json.dumps(payload),
-                                         use_access_token=True,
-                                         action_string="Upload",
-                                         timeout=120)
-
-            data = json.loads(response.text)
-
-            url = data['uploadUrl']
-
-            CHUNK_SIZE = 10*1024*1024
-            chunk_start = 0
-            chunk_end = CHUNK_SIZE - 1
-            if chunk_end+1 >= file_size:
-                chunk_end = file_size - 1
-            response = None
+                if self.__app_folder__:
+                    url = (self.onedrive_url_root +
+                           "/drive/special/approot:/" +
+                           urllib.parse.quote(full_remote_path) +
+                           ":/upload.createSession")
+
+                response = self.http_request(url=url,
+                                             request_type=RequestType.POST,
+                                             status_codes=(requests.codes.ok,),
+                                             headers=headers,
+                                             data=json.dumps(payload),
+                                             use_access_token=True,
+                                             action_string="Upload",
+                                             timeout=120)
+
+                data = json.loads(response.text)
+
+                url = data['uploadUrl']
+                response = None
+                self.save_upload_session(full_remote_path, source_id,
+                                         {'uploadUrl': url})
 
             # TODO: Deal with insufficient Storage error (507)
             # TODO: Deal with other 400/500 series errors
 
-            cur_file_hash = hashlib.sha1()
-            with open(file_path, "rb") as f:
+            # Local files are read from where the upload starts and hashed
+            # by a thread over the whole file, so resuming doesn't wait for
+            # the part already sent to be read, and isn't hashed at all if
+            # its hash is cached.
+            # Other data is read and hashed ahead by a pipe's thread while
+            # the previous fragment is being sent.  Fragments have to be
+            # sent in order, and hashlib state can't be saved, so when
+            # resuming a pipe the part already sent is read and hashed
+            # again, but not sent.
+            known_hash = None
+            if local_path is not None:
+                if chunk_start > 0:
+                    known_hash = self.hash_cache.peek_hash(local_path, 'sha1')
+                local_stat = os.stat(local_path)
+                reader = LocalFileReader(local_path,
+                                         hash_data=known_hash is None)
+                reader.seek(chunk_start)
+            else:
+                reader = StreamPipe(self.read_chunks(open_file), file_size,
+                                    buffer_size=self.upload_read_ahead,
+                                    chunk_size=self.UPLOAD_READ_SIZE,
+                                    rewind_size=0)
+                while reader.tell() < chunk_start:
+                    reader.read(min(self.UPLOAD_READ_SIZE,
+                                    chunk_start - reader.tell()))
+            with reader:
                 retry_chunk = False
                 while chunk_start < file_size:
                     if retry_chunk is False:
-                        chunk_data = f.read(CHUNK_SIZE)
-                        cur_file_hash.update(chunk_data)
+                        # Views, so sending part of it again doesn't copy it
+                        chunk_data = memoryview(reader.read(chunk_size))
+                        chunk_end = chunk_start + len(chunk_data) - 1
                     retry_chunk = False
                     headers = {}
                     headers['Content-Length'] = str(file_size)
@@ -370,6 +500,7 @@ class OneDriveStorageService(StorageService):
                                     requests.codes.range_not_satisfiable)
                     # TODO: Further testing on some errors
                     # err_codes = (requests.codes.server_error,)
+                    send_start = time.monotonic()
                     response = self.http_request(url=url,
                                                  request_type=RequestType.PUT,
                                                  headers=headers,
@@ -414,16 +545,35 @@ class OneDriveStorageService(StorageService):
                                 continue
                             break
 
-                    print("{} of {} bytes sent, {}% complete"
-                          .format(str(chunk_end+1),
-                                  str(file_size),
-                                  "%.2f" % (float(chunk_end+1)
-                                            / float(file_size)*100)),
-                          end='\r')
+                    if progress is not None:
+                        progress.update(chunk_end + 1)
+                    else:
+                        print("{} of {} bytes sent, {}% complete"
+                              .format(str(chunk_end+1),
+                                      str(file_size),
+                                      "%.2f" % (float(chunk_end+1)
+                                                / float(file_size)*100)),
+                              end='\r')
+                    chunk_size = self.get_next_chunk_size(
+                        chunk_size, len(chunk_data),
+                        time.monotonic() - send_start)
                     chunk_start = chunk_end+1
-                    chunk_end += CHUNK_SIZE
-                    if chunk_end+1 >= file_size:
-                        chunk_end = file_size - 1
+                    if chunk_start < file_size:
+                        self.save_upload_session(full_remote_path, source_id,
+                                                 {'uploadUrl': url},
+                                                 chunk_start)
+
+                if chunk_start >= file_size and known_hash is not None:
+                    local_hash = known_hash
+                elif chunk_start >= file_size:
+                    local_hash = reader.get_hash('sha1')
+                    if local_path is not None:
+                        # Both hashes come from the same read
+                        self.hash_cache.record(local_path, local_stat,
+                                               {'md5': reader.get_hash('md5'),
+                                                'sha1': local_hash})
+            # Either complete or abandoned, a new session is needed next
+            self.clear_upload_session(full_remote_path)
 
             logger.info(response.status_code)
             logger.info(response.text)
@@ -434,22 +584,59 @@ class OneDriveStorageService(StorageService):
             else:
                 server_hash = "None"
 
-            logger.info("SHA1 local:"+cur_file_hash.hexdigest())
+            logger.info("SHA1 local:"+str(local_hash))
             logger.info("SHA1 remote:"+server_hash)
-            if (cur_file_hash.hexdigest() == server_hash.lower()):
+            if (local_hash == server_hash.lower()):
                 print("\nUpload of file {} complete".
                       format(os.path.basename(file_name)))
-                return
+                return data
             cur_attempt += 1
             logger.warning("Hash of uploaded file does "
                            "not match server.  Attempting again")
             # If it doesn't match, we need to replace the existing file now
             payload["@name.conflictBehavior"] = "replace"
 
-        if (cur_file_hash.hexdigest() != server_hash.lower()):
-                raise RuntimeError("Hash of uploaded file does "
+        if (local_hash != server_hash.lower()):
+                raise HashMismatch("Hash of uploaded file does "
                                    "not match server.")
 
+    # Reads the file object returned by open_file in UPLOAD_READ_SIZE
+    # chunks, closing it at the end
+    def read_chunks(self, open_file):
+        with open_file() as f:
+            while True:
+                chunk = f.read(self.UPLOAD_READ_SIZE)
+                if len(chunk) == 0:
+                    break
+                yield chunk
+
+    # Picks the size of the next upload fragment so each takes about
+    # CHUNK_SECONDS to send at the throughput measured for the last one.
+    # Larger fragments mean fewer round trips on fast connections, smaller
+    # ones mean less to resend after a failure on slow ones.
+    def get_next_chunk_size(self, chunk_size, sent_bytes, elapsed):
+        if sent_bytes < chunk_size or elapsed <= 0:
+            return chunk_size
+        target = sent_bytes / elapsed * self.CHUNK_SECONDS
+        target = min(max(target, chunk_size / 2), chunk_size * 2)
+        target = int(target) // self.CHUNK_UNIT * self.CHUNK_UNIT
+        return min(max(target, self.MIN_CHUNK_SIZE), self.MAX_CHUNK_SIZE)
+
+    # Status of a journaled upload session, or None if it has expired
+    def get_resumable_status(self, url):
+        status_codes = (requests.codes.ok,
+                        requests.codes.not_found,
+                        requests.codes.gone)
+        response = self.http_request(url=url,
+                                     request_type=RequestType.GET,
+                                     status_codes=status_codes,
+                                     use_access_token=True,
+                                     action_string="Get upload status",
+                                     max_tries=4)
+        if response.status_code != requests.codes.ok:
+            return None
+        return json.loads(response.text)
+
     def get_upload_status(self, url):
         status_codes = (requests.codes.ok,)
         r = (self. http_request(url=url,
@@ -461,50 +648,28 @@ class OneDriveStorageService(StorageService):
         data = json.loads(r.text)
         return data
 
-    def download_helper(self, url, local_path):
-        logger = logging.getLogger("multidrive")
-
-        NUM_ATTEMPTS = 5
-        cur_attempt = 1
-        while True:
-            cur_attempt += 1
-            with open(local_path, "wb") as f:
-
-                logger.info("URL to save file is: "+url)
-
-                status_codes = (requests.codes.ok,)
-                severe_status_codes = (requests.codes.bandwidth_limit_exceeded,
-                                       requests.codes.service_unavailable)
-                try:
-                    r = (self.
-                         http_request(url=url,
-                                      request_type=RequestType.GET,
-                                      status_codes=status_codes,
-                                      stream=True,
-                                      severe_status_codes=severe_status_codes,
-                                      use_access_token=True,
-                                      action_string="Download file",
-                                      max_tries=10,
-                                      timeout=120))
-
-                    size = 0
-                    cur_file_hash = hashlib.sha1()
-                    for chunk in r.iter_content(chunk_size=4*1024*1024):
-                        if chunk:  # filter out keep-alive new chunks
-                            cur_file_hash.update(chunk)
-                            f.write(chunk)
-                            f.flush()
-                            size = size + 1
-                            if size % 200 == 0:
-                                logger.info(str(size*4) + "MB written")
-                    os.fsync(f.fileno())
-                except (ConnectionResetError,
-                        requests.exceptions.ConnectionError) as err:
-                    if cur_attempt < NUM_ATTEMPTS:
-                        logger.warning("Connection Error: %s" % err)
-                        continue
-                    raise err
-                return cur_file_hash.hexdigest()
+    def get_content_response(self, url, byte_range=None):
+        status_codes = (requests.codes.ok,)
+        headers = None
+        if byte_range is not None:
+            status_codes = (requests.codes.ok, requests.codes.partial_content)
+            headers = {'Range': "bytes={}-{}".format(*byte_range)}
+        severe_status_codes = (requests.codes.bandwidth_limit_exceeded,
+                               requests.codes.service_unavailable)
+        return self.http_request(url=url,
+                                 request_type=RequestType.GET,
+                                 status_codes=status_codes,
+                                 headers=headers,
+                                 stream=True,
+                                 severe_status_codes=severe_status_codes,
+                                 use_access_token=True,
+                                 action_string="Download file",
+                                 max_tries=10,
+                                 timeout=120)
+
+    def open_content(self, cur_file, byte_range=None):
+        url = self.onedrive_url_root+"/drive/items/"+cur_file['id']+"/content"
+        return self.get_content_response(url, byte_range)
 
     def download_item(self, cur_file, destination=None, overwrite=False,
                       create_folder=False):
@@ -524,13 +689,14 @@ class OneDriveStorageService(StorageService):
         if overwrite is False and os.path.isfile(local_path):
             raise RuntimeError("Local file {} exists.  Enable overwrite "
                                "option to continue.".format(local_path))
-        url = self.onedrive_url_root+"/drive/items/"+cur_file['id']+"/content"
+        logger.info("Saving {} to {}".format(cur_file['id'], local_path))
 
         NUM_ATTEMPTS = 5
         cur_attempt = 1
         while cur_attempt <= NUM_ATTEMPTS:
 
-            cur_file_hash = self.download_helper(url, local_path)
+            cur_file_hash = self.download_content(cur_file, local_path,
+                                                  'sha1')
 
             # API documentation states that hashes may not be available until
             # after Item is downloaded
@@ -545,7 +711,7 @@ class OneDriveStorageService(StorageService):
                            "not match server.  Attempting again")
 
         if (cur_file_hash != remote_hash.lower()):
-            raise RuntimeError("Hash of downloaded file does "
+            raise HashMismatch("Hash of downloaded file does "
                                "not match server.")
 
         lastModifiedDateTimeString = cur_file['lastModifiedDateTime']
@@ -561,10 +727,17 @@ class OneDriveStorageService(StorageService):
     def download(self, file_path, destination=None, overwrite=False):
         print("Download {} OneDrive Storage Service".format(file_path))
 
+        cur_file = self.get_file_by_path(file_path)
+        return self.download_item(cur_file, destination, overwrite)
+
+    def get_file_by_path(self, file_path):
         cur_file = self.get_item(item_path=file_path)
+        if cur_file is None:
+            raise ItemDoesNotExistError("File {} does not exist"
+                                        .format(file_path))
         if 'folder' in cur_file:
             raise RuntimeError("Remote destination is a folder")
-        return self.download_item(cur_file, destination, overwrite)
+        return cur_file
 
     def is_folder(self, folder_path):
         result = self.get_item(item_path=folder_path)
@@ -582,6 +755,10 @@ class OneDriveStorageService(StorageService):
             if item_path.endswith('/'):
                 item_path = item_path[:-1]
 
+            cached_item = self.get_cached("item", item_path)
+            if cached_item is not None:
+                return cached_item
+
             url = (self.onedrive_url_root+"/drive/root:/" +
                    urllib.parse.quote(item_path))
             if self.__app_folder__:
@@ -603,16 +780,20 @@ class OneDriveStorageService(StorageService):
                                      max_tries=8)
 
         if response.status_code == requests.codes.not_found:
-            logger.info("Item not found: " + item_path)
+            logger.info("Item not found: " + str(item_path))
             return None
 
-        return json.loads(response.text)
+        item = json.loads(response.text)
+        if item_path is not None:
+            self.set_cached("item", item_path, item)
+        return item
 
     def create_folder(self, folder_path):
         logger = logging.getLogger("multidrive")
 
         if folder_path.endswith('/'):
             folder_path = folder_path[:-1]
+        self.invalidate_cached("item", folder_path, descendants=True)
 
         split_path = folder_path.split('/')
         cur_path = ""
@@ -666,8 +847,121 @@ class OneDriveStorageService(StorageService):
             if response.status_code == requests.codes.not_found:
                 logger.info("Item not found: " + prev_path)
                 return False
+            if response.status_code in (requests.codes.ok,
+                                        requests.codes.created):
+                self.set_cached("item", cur_path, json.loads(response.text))
         return True
 
+    def get_folder_id(self, folder_path):
+        folder = self.get_item(item_path=folder_path)
+        if folder is None or "folder" not in folder:
+            raise RuntimeError("Invalid folder: "+folder_path)
+        return folder['id']
+
+    def cache_folder(self, folder_path, item):
+        self.set_cached("item", folder_path, item)
+
+    # Folders are listed by path
+    def get_prefetch_key(self, folder_path):
+        if folder_path is None:
+            return ""
+        return folder_path.strip('/')
+
+    # OneDrive accepts up to 20 requests in a JSON batch
+    BATCH_SIZE = 20
+    # Cleared if the service doesn't accept batches
+    batch_requests = True
+
+    def create_folders(self, folders):
+        items = []
+        for start in range(0, len(folders), self.BATCH_SIZE):
+            batch = folders[start:start + self.BATCH_SIZE]
+            if self.batch_requests is True and len(batch) > 1:
+                items.extend(self.create_folder_batch(batch))
+            else:
+                items.extend([self.create_child_folder(parent_id, name)
+                              for (parent_id, name) in batch])
+        return items
+
+    def create_folder_batch(self, folders):
+        logger = logging.getLogger("multidrive")
+
+        batch_requests = []
+        for (index, (parent_id, name)) in enumerate(folders):
+            batch_requests.append({
+                'id': str(index),
+                'method': "POST",
+                'url': "/drive/items/" + parent_id + "/children",
+                'headers': {'Content-Type': "application/json"},
+                'body': {'name': name, 'folder': {},
+                         '@name.conflictBehavior': "fail"}})
+        response = self.http_request(url=self.onedrive_url_root+"/$batch",
+                                     request_type=RequestType.POST,
+                                     status_codes=(requests.codes.ok,
+                                                   requests.codes.bad_request,
+                                                   requests.codes.not_found,
+                                                   requests.codes.
+                                                   not_implemented),
+                                     headers={'Content-Type':
+                                              "application/json"},
+                                     data=json.dumps({'requests':
+                                                      batch_requests}),
+                                     use_access_token=True,
+                                     action_string="Create Folders",
+                                     max_tries=6)
+        if response.status_code != requests.codes.ok:
+            logger.info("Batch requests not available, creating folders "
+                        "one at a time")
+            self.batch_requests = False
+            return [self.create_child_folder(parent_id, name)
+                    for (parent_id, name) in folders]
+
+        results = {}
+        for result in json.loads(response.text)['responses']:
+            results[result['id']] = result
+        items = []
+        for (index, (parent_id, name)) in enumerate(folders):
+            result = results.get(str(index))
+            if result is not None and result['status'] in (requests.codes.ok,
+                                                           requests.codes.
+                                                           created):
+                items.append(result['body'])
+            else:
+                # e.g. throttled, or it already exists
+                items.append(self.create_child_folder(parent_id, name))
+        return items
+
+    def create_child_folder(self, parent_id, name):
+        headers = {'Content-Type': "application/json"}
+        payload = {'name': name, 'folder': {},
+                   '@name.conflictBehavior': "fail"}
+        url = self.onedrive_url_root+"/drive/items/"+parent_id+"/children"
+        response = self.http_request(url=url,
+                                     request_type=RequestType.POST,
+                                     status_codes=(requests.codes.ok,
+                                                   requests.codes.created,
+                                                   requests.codes.conflict),
+                                     headers=headers,
+                                     data=json.dumps(payload),
+                                     use_access_token=True,
+                                     action_string="Create Folder",
+                                     max_tries=6)
+        if response.status_code != requests.codes.conflict:
+            return json.loads(response.text)
+
+        url = (self.onedrive_url_root+"/drive/items/"+parent_id+":/" +
+               urllib.parse.quote(name))
+        response = self.http_request(url=url,
+                                     request_type=RequestType.GET,
+                                     status_codes=(requests.codes.ok,),
+                                     use_access_token=True,
+                                     action_string="Get Item",
+                                     max_tries=8)
+        item = json.loads(response.text)
+        if "folder" not in item:
+            raise RuntimeError("{} exists, but is not a folder".format(name))
+        return item
+
     def list_folder(self, folder_path):
         base_folder = None
         if folder_path is None:
@@ -677,14 +971,27 @@ class OneDriveStorageService(StorageService):
         if "folder" not in base_folder:
             raise RuntimeError("Invalid folder: "+folder_path)
 
-        folder_list = self.get_folder_listing(base_folder, [], folder_path)
+        folder_list = self.get_folder_listing(folder_path)
         return folder_list
 
-    def get_folder_listing(self, cur_folder, path_list, current_path):
+    def get_folder_listing(self, current_path):
+        lister = self.get_folder_lister(self.get_folder_children,
+                                        self.get_child_folder)
+        return lister.list(current_path)
+
+    def get_child_folder(self, current_item, current_path):
+        if "folder" not in current_item:
+            return None
+        if current_path.endswith('/'):
+            current_path = current_path[:-1]
+        if self.__app_folder__ and len(current_path) == 0:
+            return current_item['name']
+        return current_path+'/'+current_item['name']
+
+    def get_folder_children(self, current_path):
         logger = logging.getLogger("multidrive")
 
         print("Getting listing for {}".format(current_path))
-        result_list = []
         if current_path.endswith('/'):
             current_path = current_path[:-1]
         url = (self.onedrive_url_root+"/drive/root:/" +
@@ -696,39 +1003,127 @@ class OneDriveStorageService(StorageService):
         status_codes = (requests.codes.ok,
                         requests.codes.not_found)
 
-        response = self.http_request(url=url,
-                                     request_type=RequestType.GET,
-                                     status_codes=status_codes,
-                                     use_access_token=True,
-                                     action_string="Get Folder Listing",
-                                     max_tries=8)
+        children = []
+        while url is not None:
+            response = self.http_request(url=url,
+                                         request_type=RequestType.GET,
+                                         status_codes=status_codes,
+                                         use_access_token=True,
+                                         action_string="Get Folder Listing",
+                                         max_tries=8)
 
-        if response.status_code == requests.codes.not_found:
-            logger.info("Item not found: " + current_path)
-            raise RuntimeError("Item not found. Possible bad path: " +
-                               current_path)
+            if response.status_code == requests.codes.not_found:
+                logger.info("Item not found: " + current_path)
+                raise RuntimeError("Item not found. Possible bad path: " +
+                                   current_path)
 
-        data = json.loads(response.text)
+            data = json.loads(response.text)
+            children.extend(data['value'])
+            # Large folders are returned a page at a time
+            url = data.get('@odata.nextLink')
+        return children
+
+    def list_folder_changes(self, folder_path, feed_state):
+        if folder_path is None:
+            folder_path = ""
+        if folder_path.endswith('/'):
+            folder_path = folder_path[:-1]
+        base_folder = self.get_item(item_path=folder_path)
+
+        if base_folder is None or "folder" not in base_folder:
+            raise RuntimeError("Invalid folder: "+folder_path)
 
-        for current_item in data['value']:
-            result_list.append((current_item, path_list))
-            if "folder" in current_item:
-                new_list = list(path_list)
-                new_list.append(current_item['name'])
-                if self.__app_folder__ and len(current_path) == 0:
-                    result_list.extend(
-                        self.get_folder_listing(current_item, new_list,
-                                                current_item['name']))
-                else:
-                    result_list.extend(
-                        self.get_folder_listing(current_item, new_list,
-                                                current_path+'/' +
-                                                current_item['name']))
-        return result_list
+        return self.get_folder_changes(base_folder['id'], folder_path,
+                                       feed_state)
+
+    def get_folder_changes(self, base_id, folder_path, feed_state):
+        logger = logging.getLogger("multidrive")
+
+        feed_key = self.get_feed_key(folder_path)
+        token = feed_state.get_cursor(feed_key)
+        folders = {}
+        if token is not None:
+            folders = feed_state.load_folders(feed_key)
+
+        if folder_path == "":
+            delta_url = self.onedrive_url_root+"/drive/root/view.delta"
+            if self.__app_folder__:
+                delta_url = (self.onedrive_url_root +
+                             "/drive/special/approot/view.delta")
+        else:
+            delta_url = (self.onedrive_url_root+"/drive/root:/" +
+                         urllib.parse.quote(folder_path)+":/view.delta")
+            if self.__app_folder__:
+                delta_url = (self.onedrive_url_root +
+                             "/drive/special/approot:/" +
+                             urllib.parse.quote(folder_path)+":/view.delta")
+
+        # Without a token, the delta feed enumerates the whole folder tree
+        url = delta_url
+        params = None
+        if token is not None:
+            params = {'token': token}
+        changes = []
+        while True:
+            print("Getting changes for {}".format(folder_path))
+            response = self.http_request(url=url,
+                                         request_type=RequestType.GET,
+                                         status_codes=(requests.codes.ok,
+                                                       requests.codes.gone),
+                                         params=params,
+                                         use_access_token=True,
+                                         action_string="Get Folder Changes",
+                                         max_tries=8)
+
+            if response.status_code == requests.codes.gone:
+                if params is None:
+                    raise RemoteConnectionError("Get Folder Changes: "
+                                                "Unable to complete request.")
+                logger.warning("Change token expired, listing all items")
+                url = delta_url
+                params = None
+                folders = {}
+                changes = []
+                continue
+
+            data = json.loads(response.text)
+            for item in data['value']:
+                parent_ids = []
+                if 'id' in item.get('parentReference', {}):
+                    parent_ids.append(item['parentReference']['id'])
+                changes.append((item['id'], parent_ids, item.get('name'),
+                                "folder" in item, "deleted" in item, item))
+
+            if '@odata.nextLink' in data:
+                url = data['@odata.nextLink']
+                params = None
+                continue
+            token = data.get('@delta.token')
+            if token is None:
+                token = parse_qs(urlparse(data['@odata.deltaLink']).
+                                 query)['token'][0]
+            break
+
+        for result in apply_changes(folders, base_id, changes):
+            yield result
+        feed_state.save(feed_key, token, folders)
 
     def get_file_name(self, file):
         return file['name']
 
+    def get_file_size(self, file):
+        return int(file['size'])
+
+    def get_file_hash(self, file):
+        # API documentation states that hashes may not be available until
+        # after Item is downloaded
+        if 'sha1Hash' not in file['file'].get('hashes', {}):
+            file = self.get_item(item_id=file['id'])
+        return ('sha1', file['file']['hashes']['sha1Hash'].lower())
+
+    def get_modified_time(self, file):
+        return file['lastModifiedDateTime']
+
     def is_folder_from_file_type(self, file):
         return "folder" in file
 
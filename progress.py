@@ -0,0 +1,319 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import shutil
+import sys
+import threading
+import time
+
+PROGRESS_MODES = ('auto', 'always', 'never')
+
+
+# Progress of a bulk upload, download or copy, across all the files being
+# transferred at once.
+#
+# The services report each file they send or receive with start_file() and
+# update the FileProgress it returns as data goes through, which only adds
+# to a few counters.  The status line is worked out and drawn by a separate
+# thread every interval seconds: the files and bytes done out of those
+# expected, the current and average throughput, the estimated time left
+# and the slowest files in flight.  On a terminal the line is redrawn in
+# place, otherwise a new line is written each time.
+#
+# The files of the job are added with expect() as they're found.  With
+# legs=2 (copies through a temp file) each file is downloaded and then
+# uploaded, and both count towards the bytes done.  A file is done once
+# its transfer in file_direction ('upload' or 'download') finishes.  Until
+# all_expected() is called, the time left only covers the files found so
+# far and is shown with a "+".
+class TransferProgress(object):
+
+    # Seconds of history the current throughput is measured over
+    RATE_WINDOW = 5.0
+    # Files in flight for less than this many seconds aren't slow yet
+    SLOW_AFTER = 2.0
+    NAME_LENGTH = 24
+
+    def __init__(self, file_direction, legs=1, interval=1.0, output=None,
+                 num_slowest=3):
+        self.file_direction = file_direction
+        self.legs = legs
+        self.interval = interval
+        self.output = sys.stderr if output is None else output
+        self.num_slowest = num_slowest
+        self.redraw = self.output.isatty()
+
+        self.lock = threading.Lock()
+        self.expected_files = 0
+        self.expected_bytes = 0
+        self.expected_all = False
+        self.files_done = 0
+        self.files_failed = 0
+        # Bytes of the transfers that finished, and bytes sent or received
+        # by all transfers including any sent again
+        self.finished_bytes = 0
+        self.moved_bytes = 0
+        self.in_flight = set()
+
+        self.started = time.monotonic()
+        self.samples = collections.deque()
+        self.stopped = threading.Event()
+        self.renderer = None
+        # Drawing the line and the writes of StatusLineWriter
+        self.output_lock = threading.RLock()
+        self.line_shown = False
+        self.mid_line = False
+
+    # The status is drawn from when the first files are expected, after
+    # any prompts to authorize the services
+    def expect(self, num_files, num_bytes):
+        with self.lock:
+            self.expected_files += num_files
+            self.expected_bytes += num_bytes * self.legs
+        if self.renderer is None and not self.stopped.is_set():
+            self.start()
+
+    def all_expected(self):
+        with self.lock:
+            self.expected_all = True
+
+    # direction is 'upload' or 'download'
+    def start_file(self, name, size, direction):
+        cur_file = FileProgress(self, name, size, direction)
+        with self.lock:
+            self.in_flight.add(cur_file)
+        return cur_file
+
+    # Files already finished are ignored
+    def finish_file(self, cur_file, ok):
+        with self.lock:
+            if cur_file not in self.in_flight:
+                return
+            self.in_flight.remove(cur_file)
+            if ok is True:
+                self.finished_bytes += cur_file.size
+            if cur_file.direction != self.file_direction:
+                return
+            if ok is True:
+                self.files_done += 1
+            else:
+                self.files_failed += 1
+
+    def start(self):
+        self.started = time.monotonic()
+        with self.lock:
+            self.samples.append((self.started, self.moved_bytes))
+        if self.redraw is True:
+            # Anything else written to the terminal clears the line first
+            if sys.stdout.isatty():
+                sys.stdout = StatusLineWriter(sys.stdout, self)
+            sys.stderr = StatusLineWriter(sys.stderr, self)
+        self.renderer = threading.Thread(target=self.run)
+        self.renderer.daemon = True
+        self.renderer.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.draw(self.format_status(time.monotonic()))
+
+    def draw(self, line):
+        with self.output_lock:
+            if self.redraw is False:
+                self.output.write(line + "\n")
+            elif self.mid_line is False:
+                width = shutil.get_terminal_size().columns - 1
+                self.output.write("\r" + line[:width] + "\x1b[K")
+                self.line_shown = True
+            self.output.flush()
+
+    # Called with output_lock held before other output
+    def clear(self):
+        if self.line_shown is True:
+            self.output.write("\r\x1b[K")
+            self.output.flush()
+            self.line_shown = False
+
+    # Stops drawing the status and writes the totals of the job
+    def close(self):
+        if self.renderer is None:
+            return
+        self.stopped.set()
+        self.renderer.join()
+        self.renderer = None
+        if getattr(sys.stdout, 'progress', None) is self:
+            sys.stdout = sys.stdout.stream
+        if getattr(sys.stderr, 'progress', None) is self:
+            sys.stderr = sys.stderr.stream
+        with self.output_lock:
+            self.clear()
+            self.output.write(self.format_totals(time.monotonic()) + "\n")
+            self.output.flush()
+
+    def format_status(self, now):
+        with self.lock:
+            done = self.finished_bytes + sum(min(cur_file.done,
+                                                 cur_file.size)
+                                             for cur_file in self.in_flight)
+            moved = self.moved_bytes
+            # Slowest first, by their average rate so far
+            slowest = sorted(((cur_file.moved / (now - cur_file.started),
+                               cur_file)
+                              for cur_file in self.in_flight
+                              if now - cur_file.started >= self.SLOW_AFTER),
+                             key=lambda item: item[0])
+            slowest = [(rate, cur_file.name, cur_file.get_fraction())
+                       for (rate, cur_file) in slowest[:self.num_slowest]]
+            files = "{}/{} files".format(self.files_done,
+                                         self.expected_files)
+            if self.files_failed > 0:
+                files += ", {} failed".format(self.files_failed)
+            expected_bytes = self.expected_bytes
+            expected_all = self.expected_all
+
+        # The history is only used by the drawing thread
+        self.samples.append((now, moved))
+        while (len(self.samples) > 2 and
+               now - self.samples[1][0] >= self.RATE_WINDOW):
+            self.samples.popleft()
+        current = 0.0
+        if len(self.samples) > 1 and now > self.samples[0][0]:
+            current = ((moved - self.samples[0][1]) /
+                       (now - self.samples[0][0]))
+        average = moved / max(now - self.started, 0.001)
+
+        rate = current if current > 0 else average
+        time_left = "-"
+        if done >= expected_bytes and expected_all is True:
+            time_left = "0s"
+        elif rate > 0:
+            time_left = format_duration(max(0, expected_bytes - done) /
+                                        rate)
+            if expected_all is False:
+                time_left += "+"
+        line = ("{}, {}/{}, {}/s now, {}/s avg, ETA {}"
+                .format(files, format_size(done),
+                        format_size(expected_bytes), format_size(current),
+                        format_size(average), time_left))
+        if len(slowest) > 0:
+            line += " | slowest: " + ", ".join(
+                "{} {:.0f}% {}/s".format(shorten(name, self.NAME_LENGTH),
+                                         fraction * 100, format_size(rate))
+                for (rate, name, fraction) in slowest)
+        return line
+
+    def format_totals(self, now):
+        elapsed = max(now - self.started, 0.001)
+        with self.lock:
+            line = ("{} file(s) done, {} transferred in {} ({}/s)"
+                    .format(self.files_done, format_size(self.moved_bytes),
+                            format_duration(elapsed),
+                            format_size(self.moved_bytes / elapsed)))
+            if self.files_failed > 0:
+                line += ", {} failed".format(self.files_failed)
+        return line
+
+
+# Progress of one file being sent or received.  done is how much of the
+# file has been transferred and moved how much was sent or received for it
+# in this run, which is more than done after retries.
+class FileProgress(object):
+
+    def __init__(self, job, name, size, direction):
+        self.job = job
+        self.name = name
+        self.size = size
+        self.direction = direction
+        self.done = 0
+        self.moved = 0
+        self.started = time.monotonic()
+
+    # num_bytes more of the file were sent or received
+    def add(self, num_bytes):
+        with self.job.lock:
+            self.done += num_bytes
+            self.moved += num_bytes
+            self.job.moved_bytes += num_bytes
+
+    # The first done bytes of the file have been sent or received, for
+    # transfers that report their position rather than each block
+    def update(self, done):
+        with self.job.lock:
+            if done > self.done:
+                self.moved += done - self.done
+                self.job.moved_bytes += done - self.done
+            self.done = done
+
+    # The transfer starts again at done bytes, after a failed attempt or
+    # when resuming an earlier run, without counting them as transferred
+    def reset(self, done=0):
+        with self.job.lock:
+            self.done = done
+
+    def finish(self, ok=True):
+        self.job.finish_file(self, ok)
+
+    def get_fraction(self):
+        if self.size == 0:
+            return 1.0
+        return min(1.0, float(self.done) / self.size)
+
+
+# Stands in for sys.stdout or sys.stderr while the status line is drawn on
+# the terminal, so other output clears the line rather than running into
+# it.  The line isn't drawn while a partial line is waiting for the rest.
+class StatusLineWriter(object):
+
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+
+    def write(self, text):
+        with self.progress.output_lock:
+            self.progress.clear()
+            result = self.stream.write(text)
+            if len(text) > 0:
+                self.progress.mid_line = not text.endswith("\n")
+                if self.progress.mid_line is False:
+                    self.stream.flush()
+            return result
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def format_size(num_bytes):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if num_bytes < 1024:
+            return "{:.1f}{}".format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return "{:.1f}TiB".format(num_bytes)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
+
+
+def shorten(name, length):
+    if len(name) <= length:
+        return name
+    return name[:length - 3] + "..."
@@ -0,0 +1,157 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import email.utils
+import logging
+import threading
+import time
+
+
+# Token bucket allowing rate requests per second on average, with bursts of
+# up to burst requests.  A rate of None or 0 disables limiting.
+class RateLimiter(object):
+
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+        self.last_update = time.monotonic()
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            if burst is None:
+                burst = max(1.0, rate or 1.0)
+            self.burst = float(burst)
+
+    # Takes a token and returns 0 if one is available, otherwise returns
+    # the number of seconds until there will be one.
+    def try_acquire(self):
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens +
+                              (now - self.last_update) * self.rate)
+            self.last_update = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    # Same as acquire, for coroutines on an event loop
+    async def acquire_async(self):
+        wait = self.try_acquire()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire()
+
+
+# RateLimiter shared by all the requests to a service, whose rate adapts to
+# how the service responds.  A throttled response halves the rate and, if
+# the service said how long to wait (Retry-After), holds every request for
+# that long, rather than each request backing off on its own.  Successful
+# requests raise the rate again by about increase_step requests per second
+# every second, up to max_rate, so the rate settles just under what the
+# service accepts.
+class AdaptiveRateLimiter(RateLimiter):
+
+    def __init__(self, rate, max_rate=None, min_rate=0.5, increase_step=1.0):
+        RateLimiter.__init__(self, rate)
+        self.max_rate = max(rate, max_rate or rate)
+        self.min_rate = min(rate, min_rate)
+        self.increase_step = increase_step
+        self.blocked_until = 0
+        self.last_decrease = 0
+
+    def try_acquire(self):
+        with self.lock:
+            blocked = self.blocked_until - time.monotonic()
+        if blocked > 0:
+            return blocked
+        return RateLimiter.try_acquire(self)
+
+    def throttled(self, retry_after=None):
+        logger = logging.getLogger("multidrive")
+        with self.lock:
+            now = time.monotonic()
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until,
+                                         now + retry_after)
+            # Requests in flight together tend to be throttled together,
+            # so the rate is only lowered once for them
+            if now - self.last_decrease >= 1:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.burst = max(1.0, self.rate)
+                self.tokens = 0
+                self.last_decrease = now
+                logger.warning("Throttled, lowering request rate to {:.2f} "
+                               "per second".format(self.rate))
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate,
+                                self.rate + self.increase_step / self.rate)
+                self.burst = max(1.0, self.rate)
+
+
+# Seconds to wait from a Retry-After header, given as either seconds or an
+# HTTP date, or None if there isn't one
+def get_retry_after(headers):
+    value = headers.get('Retry-After', headers.get('retry-after'))
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_time.timestamp() - time.time())
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+# Returns the limiter shared by everything in the process talking to the
+# named service, creating it with the given rate on first use.
+def get_rate_limiter(service_name, rate=None):
+    with rate_limiters_lock:
+        if service_name not in rate_limiters:
+            rate_limiters[service_name] = RateLimiter(rate)
+        return rate_limiters[service_name]
+
+
+# Same as get_rate_limiter for AdaptiveRateLimiters
+def get_adaptive_rate_limiter(service_name, rate, max_rate=None):
+    with rate_limiters_lock:
+        if service_name not in rate_limiters:
+            rate_limiters[service_name] = AdaptiveRateLimiter(
+                rate, max_rate=max_rate)
+        return rate_limiters[service_name]
@@ -0,0 +1,256 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+# Records the API calls made to the services.  Each call is recorded once,
+# after its last attempt, with its action (the action_string of the
+# request), the HTTP status of the last response, whether it succeeded,
+# the number of retries, the bytes of request and response bodies sent and
+# received over the attempts that got a response, the time to the first
+# byte of the last response and the latency of the whole call, retries
+# included.
+#
+# Calls are totalled by service and action for the summary and the
+# Prometheus textfile.  With jsonl_path, each call is also appended to
+# that file as a line of JSON.
+class RequestMetrics(object):
+
+    def __init__(self, jsonl_path=None):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.started = time.monotonic()
+        self.jsonl_file = None
+        if jsonl_path is not None:
+            self.jsonl_file = open(jsonl_path, 'a')
+
+    # first_byte is None where it isn't known, status is None if no
+    # response was received
+    def record(self, service_name, action, status, ok, retries, bytes_sent,
+               bytes_received, first_byte, latency):
+        with self.lock:
+            totals = self.totals.get((service_name, action))
+            if totals is None:
+                totals = RequestTotals()
+                self.totals[(service_name, action)] = totals
+            totals.add(status, ok, retries, bytes_sent, bytes_received,
+                       first_byte, latency)
+            if self.jsonl_file is not None:
+                self.jsonl_file.write(json.dumps(
+                    {'time': time.time(), 'service': service_name,
+                     'action': action, 'status': status, 'ok': ok,
+                     'retries': retries, 'bytes_sent': bytes_sent,
+                     'bytes_received': bytes_received,
+                     'first_byte': first_byte, 'latency': latency}) + "\n")
+
+    def is_empty(self):
+        with self.lock:
+            return len(self.totals) == 0
+
+    # Table of the calls to each service by action, slowest actions first.
+    # Total is the time spent in calls, which overlap when requests are
+    # made at once, so it can be more than the length of the run.
+    def format_summary(self):
+        with self.lock:
+            items = sorted(self.totals.items(),
+                           key=lambda item: -item[1].latency_sum)
+            elapsed = time.monotonic() - self.started
+        lines = ["API calls in {:.1f} second(s):".format(elapsed),
+                 "{:<36} {:>6} {:>5} {:>6} {:>9} {:>9} {:>7} {:>7} {:>7} "
+                 "{:>8}".format("Service/Action", "Calls", "Fail", "Retry",
+                                "Sent MiB", "Recv MiB", "TTFB ms", "Avg ms",
+                                "p95 ms", "Total s")]
+        for ((service_name, action), totals) in items:
+            name = "{}/{}".format(service_name, action)
+            if len(name) > 36:
+                name = name[:33] + "..."
+            first_byte = "-"
+            if totals.first_byte_count > 0:
+                first_byte = "{:.0f}".format(totals.first_byte_sum * 1000 /
+                                             totals.first_byte_count)
+            lines.append(
+                "{:<36} {:>6} {:>5} {:>6} {:>9.2f} {:>9.2f} {:>7} {:>7.0f} "
+                "{:>7} {:>8.1f}".format(
+                    name, totals.calls, totals.failures, totals.retries,
+                    totals.bytes_sent / float(1 << 20),
+                    totals.bytes_received / float(1 << 20), first_byte,
+                    totals.latency_sum * 1000 / totals.calls,
+                    format_bound(totals.get_percentile(0.95)),
+                    totals.latency_sum))
+        return "\n".join(lines)
+
+    # Writes the totals in the Prometheus text format to path, for the node
+    # exporter's textfile collector.  The file is replaced in one step so
+    # the collector never reads half of it.
+    def write_prometheus(self, path):
+        with self.lock:
+            items = sorted(self.totals.items())
+            lines = []
+            add_metric_help(lines, "multidrive_requests_total", "counter",
+                            "API calls by status of the last response.")
+            for ((service_name, action), totals) in items:
+                labels = get_labels(service_name, action)
+                for (status, count) in sorted(totals.statuses.items()):
+                    lines.append("multidrive_requests_total"
+                                 "{{{},status=\"{}\"}} {}"
+                                 .format(labels, status, count))
+            counters = (("multidrive_request_failures_total",
+                         "API calls that failed after every retry.",
+                         'failures'),
+                        ("multidrive_request_retries_total",
+                         "Retries of API calls.", 'retries'),
+                        ("multidrive_request_sent_bytes_total",
+                         "Bytes of request bodies sent.", 'bytes_sent'),
+                        ("multidrive_request_received_bytes_total",
+                         "Bytes of response bodies received.",
+                         'bytes_received'))
+            for (name, description, attribute) in counters:
+                add_metric_help(lines, name, "counter", description)
+                for ((service_name, action), totals) in items:
+                    lines.append("{}{{{}}} {}".format(
+                        name, get_labels(service_name, action),
+                        getattr(totals, attribute)))
+
+            name = "multidrive_request_duration_seconds"
+            add_metric_help(lines, name, "histogram",
+                            "Latency of API calls, retries included.")
+            for ((service_name, action), totals) in items:
+                labels = get_labels(service_name, action)
+                count = 0
+                for (bound, bucket) in zip(LATENCY_BUCKETS, totals.buckets):
+                    count += bucket
+                    lines.append("{}_bucket{{{},le=\"{}\"}} {}"
+                                 .format(name, labels, bound, count))
+                lines.append("{}_bucket{{{},le=\"+Inf\"}} {}"
+                             .format(name, labels, totals.calls))
+                lines.append("{}_sum{{{}}} {}".format(name, labels,
+                                                      totals.latency_sum))
+                lines.append("{}_count{{{}}} {}"
+                             .format(name, labels, totals.calls))
+
+            name = "multidrive_request_first_byte_seconds"
+            add_metric_help(lines, name, "summary",
+                            "Time to the first byte of the response.")
+            for ((service_name, action), totals) in items:
+                if totals.first_byte_count == 0:
+                    continue
+                labels = get_labels(service_name, action)
+                lines.append("{}_sum{{{}}} {}".format(name, labels,
+                                                      totals.first_byte_sum))
+                lines.append("{}_count{{{}}} {}"
+                             .format(name, labels, totals.first_byte_count))
+
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    def close(self):
+        with self.lock:
+            if self.jsonl_file is not None:
+                self.jsonl_file.close()
+                self.jsonl_file = None
+
+
+# Totals of the calls for one service and action
+class RequestTotals(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.statuses = {}
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.first_byte_sum = 0.0
+        self.first_byte_count = 0
+        self.latency_sum = 0.0
+        # Calls in each of LATENCY_BUCKETS, the rest are slower
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, status, ok, retries, bytes_sent, bytes_received,
+            first_byte, latency):
+        self.calls += 1
+        if ok is False:
+            self.failures += 1
+        status = "none" if status is None else str(status)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.retries += retries
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        if first_byte is not None:
+            self.first_byte_sum += first_byte
+            self.first_byte_count += 1
+        self.latency_sum += latency
+        for (index, bound) in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[index] += 1
+                break
+
+    # Upper bound of the bucket holding the given fraction of the calls,
+    # or None if it's over the largest bucket
+    def get_percentile(self, fraction):
+        count = 0
+        for (bound, bucket) in zip(LATENCY_BUCKETS, self.buckets):
+            count += bucket
+            if count >= fraction * self.calls:
+                return bound
+        return None
+
+
+# Number of bytes of a request body, or 0 for bodies that are read as
+# they're sent, like generators and files
+def get_body_size(data):
+    if data is None:
+        return 0
+    if isinstance(data, str):
+        return len(data.encode('utf-8'))
+    if isinstance(data, dict):
+        return len(urlencode(data))
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+
+def format_bound(bound):
+    if bound is None:
+        return ">{:.0f}".format(LATENCY_BUCKETS[-1] * 1000)
+    return "<{:.0f}".format(bound * 1000)
+
+
+def add_metric_help(lines, name, metric_type, description):
+    lines.append("# HELP {} {}".format(name, description))
+    lines.append("# TYPE {} {}".format(name, metric_type))
+
+
+def get_labels(service_name, action):
+    return "service=\"{}\",action=\"{}\"".format(escape_label(service_name),
+                                                 escape_label(action))
+
+
+def escape_label(value):
+    return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
@@ -0,0 +1,430 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+import requests
+
+from durability import DurabilityPolicy, preallocate
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+# os.pwrite and os.pread aren't available on Windows
+fd_lock = threading.Lock()
+
+
+def write_at(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        while len(data) > 0:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+        return
+    with fd_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while len(data) > 0:
+            data = data[os.write(fd, data):]
+
+
+def read_at(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    with fd_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+# Writes chunks to fd as they arrive, then calls on_written(fd, start, pos,
+# chunk) for each
+class DirectWriter(object):
+
+    def __init__(self, fd, on_written):
+        self.fd = fd
+        self.on_written = on_written
+
+    def write(self, start, pos, chunk):
+        write_at(self.fd, chunk, pos)
+        self.on_written(self.fd, start, pos, chunk)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Hands chunks to a thread that writes them to fd, so the connections go
+# back to receiving while the disk catches up.  At most QUEUE_SIZE chunks
+# are waiting at once.  An error writing is raised by the next write() or
+# flush(), and the chunks queued after it are dropped.
+class BackgroundWriter(object):
+
+    QUEUE_SIZE = 16
+
+    def __init__(self, fd, on_written):
+        self.fd = fd
+        self.on_written = on_written
+        self.error = None
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            if self.error is not None:
+                continue
+            (start, pos, chunk) = item
+            try:
+                write_at(self.fd, chunk, pos)
+                self.on_written(self.fd, start, pos, chunk)
+            except BaseException as err:
+                self.error = err
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, start, pos, chunk):
+        self.check()
+        self.queue.put((start, pos, chunk))
+
+    # Waits for the chunks queued so far to be written
+    def flush(self):
+        written = threading.Event()
+        self.queue.put(written)
+        written.wait()
+        self.check()
+
+    # Writes what's queued and stops the thread
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+def merge_ranges(ranges):
+    merged = []
+    for (start, end) in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        elif end > start:
+            merged.append((start, end))
+    return merged
+
+
+# Downloads a file as byte ranges fetched over several connections at once,
+# written in place into a file of the final size.
+#
+# open_range(byte_range) returns a streaming response for the inclusive
+# (start, end) byte range, or for the whole file if byte_range is None.
+# A segment that fails is retried from the last byte written, without
+# touching the others.  The file is hashed as the finished segments form
+# a contiguous prefix, so download() can return the hash of the whole file
+# without reading it all back at the end.
+#
+# Data is written to local_path + ".part", and the ranges written so far
+# are recorded next to it in local_path + ".part.json".  If a download of
+# the same source_id is interrupted, even by the process stopping, the
+# next one only fetches the missing ranges.  The part already on disk is
+# read back to rebuild the hash.
+#
+# The finished file is synced to disk according to durability, a
+# DurabilityPolicy.  With preallocate, the disk space for the whole file is
+# reserved before downloading.  With background_writer, chunks are written
+# by a separate thread (see BackgroundWriter).  progress is a FileProgress
+# updated as chunks are written, or None.
+class SegmentedDownload(object):
+
+    SEGMENT_SIZE = 16*1024*1024
+    CHUNK_SIZE = 1024*1024
+    NUM_ATTEMPTS = 5
+    # The ranges written are saved after this many bytes
+    SAVE_INTERVAL = 64*1024*1024
+
+    def __init__(self, open_range, size, hash_type, connections=4,
+                 source_id=None, durability=None, preallocate=False,
+                 background_writer=False, progress=None):
+        self.open_range = open_range
+        self.size = size
+        self.hash_type = hash_type
+        self.connections = max(1, connections)
+        self.source_id = source_id
+        if durability is None:
+            durability = DurabilityPolicy()
+        self.durability = durability
+        self.preallocate = preallocate
+        self.background_writer = background_writer
+        self.progress = progress
+
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.written = 0
+
+    def download(self, local_path):
+        logger = logging.getLogger("multidrive")
+
+        part_path = local_path + ".part"
+        self.state_path = part_path + ".json"
+        self.file_hash = hashlib.new(self.hash_type)
+        self.hashed_end = 0
+        self.finished = []
+        self.in_progress = {}
+        self.unsaved = 0
+        self.done = self.load_state(part_path)
+
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if len(self.done) == 0:
+            flags |= os.O_TRUNC
+        else:
+            logger.info("Resuming download of {}, {} of {} bytes already "
+                        "downloaded".format(local_path,
+                                            sum(end - start for (start, end)
+                                                in self.done), self.size))
+        fd = os.open(part_path, flags, 0o666)
+        if self.background_writer is True:
+            self.writer = BackgroundWriter(fd, self.add_written)
+        else:
+            self.writer = DirectWriter(fd, self.add_written)
+        try:
+            if self.preallocate is True:
+                preallocate(fd, self.size)
+            else:
+                os.ftruncate(fd, self.size)
+            segments = self.get_segments()
+            response = None
+            if len(segments) > 0 and segments[0] != (0, self.size):
+                # The first range is requested here, so any prompt from
+                # the service happens once and a server ignoring ranges is
+                # noticed before other connections are opened.
+                response = self.open_range((segments[0][0],
+                                            segments[0][1] - 1))
+                if response.status_code != requests.codes.partial_content:
+                    logger.info("Ranges not supported, downloading as a "
+                                "single stream")
+                    response.close()
+                    response = None
+                    self.done = []
+                    segments = [(0, self.size)]
+
+            if self.progress is not None:
+                self.progress.reset(sum(end - start
+                                        for (start, end) in self.done))
+            for (start, end) in self.done:
+                self.segment_done(start, end, fd)
+            if len(segments) == 1:
+                self.fetch_segment(fd, segments[0][0], segments[0][1],
+                                   response)
+            elif len(segments) > 1:
+                self.fetch_segments(fd, segments, response)
+            self.writer.close()
+            self.durability.file_written(fd)
+        except BaseException:
+            # Keep what was downloaded for the next attempt
+            self.writer.close()
+            with self.lock:
+                self.save_state(fd)
+            raise
+        finally:
+            self.writer.close()
+            os.close(fd)
+
+        if self.hashed_end != self.size:
+            raise DownloadError("Downloaded {} of {} bytes"
+                                .format(self.hashed_end, self.size))
+        os.replace(part_path, local_path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        self.durability.file_complete(local_path)
+        return self.file_hash.hexdigest()
+
+    # Ranges still to be downloaded, split into SEGMENT_SIZE pieces if
+    # they're fetched in parallel
+    def get_segments(self):
+        segments = []
+        pos = 0
+        for (start, end) in self.done + [(self.size, self.size)]:
+            if start > pos:
+                segments.append((pos, start))
+            pos = max(pos, end)
+        if self.connections == 1:
+            return segments
+        return [(start, min(start + self.SEGMENT_SIZE, end))
+                for (seg_start, end) in segments
+                for start in range(seg_start, end, self.SEGMENT_SIZE)]
+
+    def load_state(self, part_path):
+        logger = logging.getLogger("multidrive")
+        if self.source_id is None or not os.path.exists(self.state_path):
+            return []
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except ValueError:
+            state = None
+        if (state is None or state['source_id'] != self.source_id or
+                state['size'] != self.size or
+                not os.path.exists(part_path)):
+            logger.info("Discarding partial download " + part_path)
+            os.remove(self.state_path)
+            return []
+        return merge_ranges([tuple(cur_range)
+                             for cur_range in state['ranges']])
+
+    # Called with the lock held.  The data is flushed to disk first so the
+    # recorded ranges are never ahead of it.
+    def save_state(self, fd):
+        if self.source_id is None:
+            return
+        ranges = merge_ranges(self.done +
+                              [(start, pos) for (start, pos)
+                               in self.in_progress.items()])
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as state_file:
+            json.dump({'source_id': self.source_id, 'size': self.size,
+                       'ranges': ranges}, state_file)
+        os.replace(tmp_path, self.state_path)
+        self.unsaved = 0
+
+    def fetch_segments(self, fd, segments, first_response):
+        pool = ThreadPoolExecutor(max_workers=self.connections)
+        try:
+            futures = [pool.submit(self.fetch_segment, fd, segments[0][0],
+                                   segments[0][1], first_response)]
+            for (start, end) in segments[1:]:
+                futures.append(pool.submit(self.fetch_segment, fd, start,
+                                           end))
+            (done, not_done) = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    # Queued segments are skipped rather than fetched
+                    self.stopped = True
+                    raise future.exception()
+        finally:
+            self.stopped = True
+            pool.shutdown(wait=True)
+
+    def fetch_segment(self, fd, start, end, response=None):
+        logger = logging.getLogger("multidrive")
+
+        pos = start
+        cur_attempt = 1
+        while pos < end and not self.stopped:
+            try:
+                if response is None:
+                    if pos == 0 and end == self.size:
+                        response = self.open_range(None)
+                    else:
+                        response = self.open_range((pos, end - 1))
+                        if (response.status_code !=
+                                requests.codes.partial_content):
+                            raise DownloadError("Server did not return the "
+                                                "requested range")
+                for chunk in response.iter_content(
+                        chunk_size=self.CHUNK_SIZE):
+                    if not chunk:  # filter out keep-alive new chunks
+                        continue
+                    chunk = chunk[:end - pos]
+                    self.writer.write(start, pos, chunk)
+                    pos += len(chunk)
+                    if pos >= end or self.stopped:
+                        break
+                response.close()
+                response = None
+                if pos < end and not self.stopped:
+                    raise DownloadError("Connection closed at byte {} of "
+                                        "{}-{}".format(pos, start, end - 1))
+            except (DownloadError, ConnectionResetError,
+                    requests.exceptions.RequestException) as err:
+                if response is not None:
+                    response.close()
+                    response = None
+                if cur_attempt >= self.NUM_ATTEMPTS:
+                    raise
+                logger.warning("Download of bytes {}-{} failed: {}"
+                               .format(pos, end - 1, err))
+                time.sleep(float(1 << cur_attempt) / 2)
+                cur_attempt += 1
+        if pos >= end:
+            # The segment is read back from the file if it isn't hashed yet
+            self.writer.flush()
+            self.segment_done(start, end, fd)
+
+    def add_written(self, fd, start, pos, chunk):
+        with self.lock:
+            self.in_progress[start] = pos + len(chunk)
+            # Hashed straight away if it's next, rather than read back
+            if pos == self.hashed_end:
+                self.file_hash.update(chunk)
+                self.hashed_end += len(chunk)
+
+            if self.progress is not None:
+                self.progress.add(len(chunk))
+            previous = self.written
+            self.written += len(chunk)
+            if (previous // (100*1024*1024) !=
+                    self.written // (100*1024*1024)):
+                logging.getLogger("multidrive").info(
+                    str(self.written // (1024*1024)) + "MB written")
+            self.unsaved += len(chunk)
+            if self.unsaved >= self.SAVE_INTERVAL:
+                self.save_state(fd)
+
+    # Hashes the finished ranges that continue the hashed prefix, reading
+    # them back from the file.
+    def segment_done(self, start, end, fd):
+        with self.lock:
+            self.in_progress.pop(start, None)
+            self.done = merge_ranges(self.done + [(start, end)])
+            self.finished.append((start, end))
+            progressed = True
+            while progressed:
+                progressed = False
+                for (cur_start, cur_end) in list(self.finished):
+                    if cur_start > self.hashed_end:
+                        continue
+                    self.finished.remove((cur_start, cur_end))
+                    progressed = True
+                    while self.hashed_end < cur_end:
+                        data = read_at(fd, min(self.CHUNK_SIZE,
+                                               cur_end - self.hashed_end),
+                                       self.hashed_end)
+                        if len(data) == 0:
+                            raise DownloadError("Unable to read back "
+                                                "download")
+                        self.file_hash.update(data)
+                        self.hashed_end += len(data)
@@ -16,11 +16,216 @@
 # along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
 
 from abc import ABCMeta, abstractmethod
+import contextlib
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+from durability import DurabilityPolicy
+from folderlister import FolderLister
+from localhash import LocalHashCache
+from ratelimiter import get_rate_limiter, get_adaptive_rate_limiter, \
+    get_retry_after
+from requestmetrics import get_body_size
+from segmenteddownload import SegmentedDownload
+
+
+session_lock = threading.Lock()
+
+
+# Raised by the services when the file or folder looked up doesn't exist
+class ItemDoesNotExistError(RuntimeError):
+    pass
 
 
 class StorageService(object):
     __metaclass__ = ABCMeta
 
+    service_name = None
+    # Shared MetadataCache for path lookups, or None to disable caching
+    metadata_cache = None
+
+    def get_cached(self, kind, key):
+        if self.metadata_cache is None:
+            return None
+        return self.metadata_cache.get(self.service_name+"/"+kind, key)
+
+    def set_cached(self, kind, key, value):
+        if self.metadata_cache is not None:
+            self.metadata_cache.set(self.service_name+"/"+kind, key, value)
+
+    def invalidate_cached(self, kind, key, descendants=False):
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(self.service_name+"/"+kind, key,
+                                           descendants=descendants)
+
+    # Shared UploadJournal for resuming interrupted uploads, or None
+    upload_journal = None
+
+    def load_upload_session(self, remote_path, source_id):
+        if self.upload_journal is None or source_id is None:
+            return None
+        return self.upload_journal.get(self.service_name+":"+remote_path,
+                                       source_id)
+
+    def save_upload_session(self, remote_path, source_id, session,
+                            offset=0):
+        if self.upload_journal is not None and source_id is not None:
+            self.upload_journal.set(self.service_name+":"+remote_path,
+                                    source_id, session, offset)
+
+    def clear_upload_session(self, remote_path):
+        if self.upload_journal is not None:
+            self.upload_journal.remove(self.service_name+":"+remote_path)
+
+    # Number of folders listed at once by list_folder, and the number of
+    # folder listings per second allowed for the service (None for no limit)
+    listing_jobs = 4
+    listing_rate = 10
+
+    def get_folder_lister(self, get_children, get_child_folder):
+        rate_limiter = get_rate_limiter(self.service_name + "/listing",
+                                        self.listing_rate)
+        return FolderLister(get_children, get_child_folder,
+                            self.get_file_name, jobs=self.listing_jobs,
+                            rate_limiter=rate_limiter)
+
+    # Requests per second to the service allowed at first, and the most
+    # the rate is raised to while the service doesn't throttle requests.
+    # Shared by all the requests to the service in the process.
+    request_rate = 10
+    max_request_rate = 50
+
+    def get_request_limiter(self):
+        return get_adaptive_rate_limiter(self.service_name + "/requests",
+                                         min(self.request_rate,
+                                             self.max_request_rate),
+                                         self.max_request_rate)
+
+    # Slows down every request to the service if a response shows it's
+    # being throttled, for the time the service asked for or backoff
+    # seconds otherwise.  Returns whether it was throttled.
+    def check_throttled(self, status_code, headers, backoff):
+        retry_after = get_retry_after(headers)
+        if (status_code != requests.codes.too_many_requests and
+                retry_after is None):
+            return False
+        if retry_after is None:
+            retry_after = backoff
+        logging.getLogger("multidrive").warning(
+            "{} throttled requests, waiting {} second(s)"
+            .format(self.service_name, retry_after))
+        self.get_request_limiter().throttled(retry_after)
+        return True
+
+    # Shared RequestMetrics recording each API call to the service, or None
+    request_metrics = None
+
+    # Records a call to the service that started at started (monotonic
+    # time), see RequestMetrics.record
+    def record_request(self, action, status, ok, retries, bytes_sent,
+                       bytes_received, first_byte, started):
+        if self.request_metrics is not None:
+            self.request_metrics.record(self.service_name, action, status,
+                                        ok, retries, bytes_sent,
+                                        bytes_received, first_byte,
+                                        time.monotonic() - started)
+
+    # Records a call made with requests, where response is the last
+    # response or None and data the body sent by each attempt.  The body is
+    # counted once for each of the responses, as attempts that failed to
+    # connect didn't send it.  The body of a streamed response is read
+    # after the call, so its Content-Length is counted instead.
+    def record_response(self, action, response, ok, retries, data,
+                        responses, started, stream=False):
+        if self.request_metrics is None:
+            return
+        status = None
+        bytes_received = 0
+        first_byte = None
+        if response is not None:
+            status = response.status_code
+            # Time from sending the request to parsing the headers
+            first_byte = response.elapsed.total_seconds()
+            if stream is True:
+                bytes_received = int(response.headers.get('Content-Length',
+                                                          0))
+            else:
+                bytes_received = len(response.content)
+        self.record_request(action, status, ok, retries,
+                            get_body_size(data) * responses,
+                            bytes_received, first_byte, started)
+
+    # Number of connections kept open to each host of the service.  Should
+    # be at least the number of requests made at once, i.e. the transfer
+    # and listing concurrency, or connections are closed after use.
+    http_pool_size = 10
+    session = None
+
+    # Shared keep-alive connection pool for the service's HTTP requests, so
+    # each chunk and metadata lookup doesn't need a new TCP and TLS
+    # handshake.
+    def get_session(self):
+        with session_lock:
+            if self.session is None:
+                adapter = HTTPAdapter(pool_connections=10,
+                                      pool_maxsize=self.http_pool_size)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.session = session
+            return self.session
+
+    # Shared TransferProgress the files sent and received are reported to,
+    # or None
+    progress = None
+
+    # Context for sending or receiving the size bytes of file_name, giving
+    # the FileProgress to update (None without progress reporting), which
+    # is finished when the context exits
+    @contextlib.contextmanager
+    def track_progress(self, file_name, size, direction):
+        if self.progress is None:
+            yield None
+            return
+        cur_file = self.progress.start_file(file_name, size, direction)
+        try:
+            yield cur_file
+        except BaseException:
+            cur_file.finish(False)
+            raise
+        cur_file.finish(True)
+
+    # Number of connections each file is downloaded over
+    download_connections = 4
+    # When downloaded files are synced to disk, shared between services
+    durability = DurabilityPolicy()
+    # Reserve disk space for each download before it starts
+    preallocate = False
+    # Write downloads from a separate thread, see BackgroundWriter
+    background_writes = True
+
+    # Downloads cur_file to local_path and returns its hash_type hash.  An
+    # interrupted download of the same version of the file to the same
+    # place is resumed.
+    def download_content(self, cur_file, local_path, hash_type):
+        size = self.get_file_size(cur_file)
+        source_id = "{}:{}:{}".format(self.service_name,
+                                      self.get_modified_time(cur_file), size)
+        with self.track_progress(self.get_file_name(cur_file), size,
+                                 'download') as progress:
+            download = SegmentedDownload(
+                lambda byte_range: self.open_content(cur_file, byte_range),
+                size, hash_type, connections=self.download_connections,
+                source_id=source_id, durability=self.durability,
+                preallocate=self.preallocate,
+                background_writer=self.background_writes,
+                progress=progress)
+            return download.download(local_path)
+
     @abstractmethod
     def authorize(self):
         pass
@@ -30,6 +235,12 @@ class StorageService(object):
                modified_time=None, create_folder=False, overwrite=False):
         pass
 
+    @abstractmethod
+    def upload_stream(self, stream, file_name, file_size, destination=None,
+                      modified_time=None, create_folder=False,
+                      overwrite=False):
+        pass
+
     @abstractmethod
     def download(self, file_path, destination=None, overwrite=False):
         pass
@@ -39,6 +250,16 @@ class StorageService(object):
                       overwrite=False, create_folder=False):
         pass
 
+    @abstractmethod
+    def get_file_by_path(self, file_path):
+        pass
+
+    # Streaming response for the content of cur_file, or for the inclusive
+    # (start, end) byte_range of it.
+    @abstractmethod
+    def open_content(self, cur_file, byte_range=None):
+        pass
+
     @abstractmethod
     def create_folder(self, folder_path):
         pass
@@ -47,14 +268,124 @@ class StorageService(object):
     def is_folder(self, folder_path):
         pass
 
+    # Id of the existing folder at folder_path ("" for the root)
+    @abstractmethod
+    def get_folder_id(self, folder_path):
+        pass
+
+    # Creates the folders given as (parent id, name) and returns their
+    # items in the same order
+    @abstractmethod
+    def create_folders(self, folders):
+        pass
+
+    # Adds the folder item at folder_path to the metadata cache
+    @abstractmethod
+    def cache_folder(self, folder_path, item):
+        pass
+
+    # LocalHashCache of the hashes of local files, shared by the services.
+    # Kept in memory for the run unless replaced by one kept in a file.
+    hash_cache = LocalHashCache()
+
+    # Uploads of local files that are already on the service, with the same
+    # size and hash, are skipped when set
+    skip_identical = False
+
+    # Whether the local file at file_path has the same content as the
+    # remote file.  Sizes are compared first, so the local file is only
+    # hashed if they match.
+    def is_identical(self, file_path, file):
+        try:
+            if self.is_folder_from_file_type(file):
+                return False
+            if self.get_file_size(file) != os.path.getsize(file_path):
+                return False
+            (hash_type, remote_hash) = self.get_file_hash(file)
+        except KeyError:
+            # e.g. Google Docs, which have no size or hash
+            return False
+        return (self.hash_cache.get_hash(file_path, hash_type) ==
+                remote_hash.lower())
+
+    # (folder key, file name) to the file, or None if it doesn't exist,
+    # looked up by prefetch_files.  Each entry is only used once, since
+    # uploading the file changes it.
+    prefetched_files = None
+
+    # Looks up the files in file_names that are about to be uploaded to the
+    # existing folder folder_path, so each upload doesn't need its own
+    # request to find out if the file exists.  The folder is listed once
+    # and its files are found by name, unless children, the items in the
+    # folder from an earlier listing, is given.
+    def prefetch_files(self, folder_path, file_names, children=None):
+        folder_key = self.get_prefetch_key(folder_path)
+        if children is None:
+            children = self.get_folder_children(folder_key)
+        children_by_name = {}
+        for child in children:
+            children_by_name.setdefault(self.get_file_name(child),
+                                        []).append(child)
+        for file_name in file_names:
+            matches = children_by_name.get(file_name, [])
+            # Duplicate names are left for upload to report
+            if len(matches) <= 1:
+                self.set_prefetched_file(folder_key, file_name,
+                                         matches[0] if matches else None)
+
+    # Key of folder_path for prefetched files, which is also the handle
+    # get_folder_children lists it with
+    def get_prefetch_key(self, folder_path):
+        return self.get_folder_id(folder_path or "")
+
+    def set_prefetched_file(self, folder_key, file_name, file):
+        if self.prefetched_files is None:
+            self.prefetched_files = {}
+        self.prefetched_files[(folder_key, file_name)] = file
+
+    # The prefetched file, None if it was found not to exist, or False if
+    # it wasn't prefetched
+    def take_prefetched_file(self, folder_key, file_name):
+        if self.prefetched_files is None:
+            return False
+        return self.prefetched_files.pop((folder_key, file_name), False)
+
+    # Generator of (item, path_list) for everything below folder_path, where
+    # path_list is the list of folder names from folder_path to the item.
     @abstractmethod
     def list_folder(self, folder_path):
         pass
 
+    # Like list_folder, but uses the service's change feed so that after the
+    # first run only the items added or changed since the last committed
+    # run are yielded.  feed_state is a ChangeFeedState keeping the feed
+    # cursor between runs.
+    def list_folder_changes(self, folder_path, feed_state):
+        raise RuntimeError("Incremental listing is not supported for " +
+                           self.service_name)
+
+    def get_feed_key(self, folder_path):
+        return self.service_name + ":" + folder_path
+
     @abstractmethod
     def get_file_name(self, file):
         pass
 
+    def get_file_id(self, file):
+        return file['id']
+
+    @abstractmethod
+    def get_file_size(self, file):
+        pass
+
+    @abstractmethod
+    def get_file_hash(self, file):
+        pass
+
+    @abstractmethod
+    def get_modified_time(self, file):
+        pass
+
     @abstractmethod
     def is_folder_from_file_type(self, file):
         pass
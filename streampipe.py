@@ -0,0 +1,187 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import os
+import queue
+import threading
+
+
+class StreamError(RuntimeError):
+    pass
+
+
+# Read only file object fed from an iterator of chunks (usually the
+# iter_content of a download response).  A producer thread pulls chunks into
+# a bounded queue and hashes them on the way, so the consumer (an upload)
+# never waits on hashing and memory use stays bounded.
+#
+# The stream can't be rewound to the start, but seeking back up to
+# rewind_size bytes is supported since resumable uploads may need to resend
+# the tail of the last chunk.  Seeking to the end reports the size without
+# moving the read position, which is how upload libraries find the length
+# of a file object.
+class StreamPipe(object):
+
+    def __init__(self, chunks, size, buffer_size=8*1024*1024,
+                 chunk_size=1024*1024, rewind_size=1024*1024):
+        self.size = size
+        self.rewind_size = rewind_size
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.received = 0
+
+        self.queue = queue.Queue(maxsize=max(1, buffer_size // chunk_size))
+        self.history = collections.deque()
+        self.fetched_end = 0
+        self.pos = 0
+        self.virtual_pos = None
+        self.eof = False
+        self.opened = False
+        self.closed = False
+
+        self.producer = threading.Thread(target=self.produce, args=(chunks,))
+        self.producer.daemon = True
+        self.producer.start()
+
+    def produce(self, chunks):
+        try:
+            for chunk in chunks:
+                if self.closed:
+                    return
+                if not chunk:  # filter out keep-alive new chunks
+                    continue
+                self.md5.update(chunk)
+                self.sha1.update(chunk)
+                self.received += len(chunk)
+                self.put(chunk)
+            if self.received != self.size:
+                raise StreamError("Stream ended after {} of {} bytes"
+                                  .format(self.received, self.size))
+            self.put(None)
+        except Exception as err:
+            self.put(err)
+
+    def put(self, item):
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch(self):
+        item = self.queue.get()
+        if item is None:
+            self.eof = True
+            return False
+        if isinstance(item, Exception):
+            self.eof = True
+            raise item
+        self.history.append((self.fetched_end, item))
+        self.fetched_end += len(item)
+        return True
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed stream")
+        self.virtual_pos = None
+        if size is None or size < 0:
+            size = self.size - self.pos
+        end = min(self.pos + size, self.size)
+        while self.fetched_end < end and not self.eof:
+            self.fetch()
+
+        parts = []
+        for (start, chunk) in self.history:
+            chunk_end = start + len(chunk)
+            if chunk_end <= self.pos or start >= end:
+                continue
+            parts.append(chunk[max(self.pos - start, 0):
+                               min(end, chunk_end) - start])
+        data = b"".join(parts)
+        self.pos += len(data)
+
+        # Keep just enough history to honour rewind_size
+        while (len(self.history) > 0 and
+               self.history[0][0] + len(self.history[0][1]) <=
+               self.pos - self.rewind_size):
+            self.history.popleft()
+        return data
+
+    def tell(self):
+        if self.virtual_pos is not None:
+            return self.virtual_pos
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            self.virtual_pos = self.size + offset
+            return self.virtual_pos
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        self.virtual_pos = None
+        earliest = self.pos
+        if len(self.history) > 0:
+            earliest = min(self.pos, self.history[0][0])
+        if offset < earliest or offset > self.fetched_end:
+            raise StreamError("Can not seek to {} in stream, available range "
+                              "is {}-{}".format(offset, earliest,
+                                                self.fetched_end))
+        self.pos = offset
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    # Used by uploaders that open their input once per attempt.  A stream
+    # can only be sent once.
+    def open(self):
+        if self.opened:
+            raise StreamError("Stream can not be sent more than once")
+        self.opened = True
+        return self
+
+    def close(self):
+        self.closed = True
+        # Unblock the producer if it's waiting on a full queue
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Chunks are hashed before they are queued, so once every byte has been
+    # fetched the hashes are complete.
+    def get_hash(self, hash_type):
+        if self.fetched_end < self.size or self.received != self.size:
+            raise StreamError("Stream was not completely read")
+        if hash_type == 'md5':
+            return self.md5.hexdigest()
+        elif hash_type == 'sha1':
+            return self.sha1.hexdigest()
+        raise ValueError("Unknown hash type: " + hash_type)
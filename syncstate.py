@@ -0,0 +1,78 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+
+
+# Local index of the files transferred by the sync action.  Each sync pairs
+# a source and a destination, identified by sync_key.  For every file
+# below the source the size, modified time and hash seen at the last
+# transfer are kept, so the next run only transfers files that changed.
+#
+# When the source is local, remote_hash is the hash reported by the
+# destination service after the upload.  When the source is remote, it's
+# the hash reported by the source service.
+class SyncState(object):
+
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pending_writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sync_files "
+                        "(sync_key TEXT, path TEXT, size INTEGER, "
+                        "mtime TEXT, remote_hash TEXT, "
+                        "PRIMARY KEY (sync_key, path))")
+        self.db.commit()
+
+    def get(self, sync_key, path):
+        with self.lock:
+            return self.db.execute("SELECT size, mtime, remote_hash "
+                                   "FROM sync_files WHERE sync_key = ? AND "
+                                   "path = ?", (sync_key, path)).fetchone()
+
+    # remote_hash is only compared when given, since a local file's remote
+    # hash isn't known until it has been uploaded.
+    def is_unchanged(self, sync_key, path, size, mtime, remote_hash=None):
+        row = self.get(sync_key, path)
+        if row is None:
+            return False
+        (old_size, old_mtime, old_hash) = row
+        if old_size != size or old_mtime != str(mtime):
+            return False
+        if remote_hash is not None and old_hash != remote_hash:
+            return False
+        return True
+
+    def record(self, sync_key, path, size, mtime, remote_hash):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sync_files "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (sync_key, path, size, str(mtime), remote_hash))
+            self.pending_writes += 1
+            if self.pending_writes >= self.COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending_writes = 0
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
@@ -0,0 +1,234 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from storageservice import ItemDoesNotExistError
+from streampipe import StreamPipe
+
+
+class TransferError(RuntimeError):
+    pass
+
+
+# Copies files between two storage services.  Downloads and uploads run in
+# separate worker pools so the next files are downloaded while earlier ones
+# are still uploading.  At most 2*jobs files are held in the temp folder.
+#
+# In stream mode nothing is written to disk.  Each job pipes the download
+# response of the source straight into an upload to the destination through
+# a bounded memory buffer.
+class TransferScheduler(object):
+
+    NUM_ATTEMPTS = 5
+    STREAM_CHUNK_SIZE = 1024*1024
+
+    def __init__(self, source, destination, jobs=1, overwrite=False,
+                 create_folder=False, stream=False,
+                 stream_buffer_size=8*1024*1024):
+        if jobs < 1:
+            raise ValueError("Number of jobs must be at least 1")
+        self.source = source
+        self.destination = destination
+        self.jobs = jobs
+        self.overwrite = overwrite
+        self.create_folder = create_folder
+        self.stream = stream
+        self.stream_buffer_size = stream_buffer_size
+
+        self.tmp_path = tempfile.mkdtemp()
+        self.download_pool = ThreadPoolExecutor(max_workers=jobs)
+        self.upload_pool = ThreadPoolExecutor(max_workers=jobs)
+        self.slots = threading.BoundedSemaphore(2*jobs)
+
+        self.lock = threading.Condition()
+        self.pending = 0
+        self.errors = []
+
+    # Blocks while the maximum number of files is already in flight.
+    # on_complete is called with the uploaded item once the file has been
+    # copied.
+    def submit(self, cur_file, cur_dest, on_complete=None):
+        self.check_errors()
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+        try:
+            if self.stream:
+                self.download_pool.submit(self.stream_task, cur_file,
+                                          cur_dest, on_complete)
+            else:
+                self.download_pool.submit(self.download_task, cur_file,
+                                          cur_dest, on_complete)
+        except Exception:
+            self.finish_task(None)
+            raise
+
+    def download_task(self, cur_file, cur_dest, on_complete):
+        logger = logging.getLogger("multidrive")
+        if self.errors:
+            self.finish_task(None)
+            return
+        task_path = None
+        try:
+            # Each file gets its own folder so files with the same name
+            # from different source folders don't collide.
+            task_path = tempfile.mkdtemp(dir=self.tmp_path)
+            (local_temp,
+             last_mod) = self.source.download_item(cur_file,
+                                                   destination=task_path,
+                                                   overwrite=self.overwrite)
+            self.upload_pool.submit(self.upload_task, local_temp, last_mod,
+                                    cur_dest, task_path, on_complete)
+        except Exception as err:
+            logger.warning("Download of {} failed: {}"
+                           .format(self.source.get_file_name(cur_file), err))
+            self.add_error(err)
+            self.finish_task(task_path)
+
+    def upload_task(self, local_temp, last_mod, cur_dest, task_path,
+                    on_complete):
+        logger = logging.getLogger("multidrive")
+        try:
+            if not self.errors:
+                new_file = self.destination.upload(
+                    local_temp, destination=cur_dest,
+                    modified_time=last_mod,
+                    create_folder=self.create_folder,
+                    overwrite=self.overwrite)
+                if on_complete is not None:
+                    on_complete(new_file)
+        except Exception as err:
+            logger.warning("Upload of {} failed: {}".format(local_temp, err))
+            self.add_error(err)
+        finally:
+            self.finish_task(task_path)
+
+    def stream_task(self, cur_file, cur_dest, on_complete):
+        logger = logging.getLogger("multidrive")
+        if self.errors:
+            self.finish_task(None)
+            return
+        try:
+            new_file = self.stream_file(cur_file, cur_dest)
+            if on_complete is not None:
+                on_complete(new_file)
+        except Exception as err:
+            logger.warning("Copy of {} failed: {}"
+                           .format(self.source.get_file_name(cur_file), err))
+            self.add_error(err)
+        finally:
+            self.finish_task(None)
+
+    def stream_file(self, cur_file, cur_dest):
+        logger = logging.getLogger("multidrive")
+        file_name = self.source.get_file_name(cur_file)
+        file_size = self.source.get_file_size(cur_file)
+        last_mod = self.source.get_modified_time(cur_file)
+
+        # Without overwrite an existing file is never replaced, so there's
+        # nothing to stream.  A file found after a failed attempt was left
+        # by that attempt, and is replaced by the next one.
+        overwrite = self.overwrite
+        if overwrite is False and self.destination_exists(cur_dest,
+                                                          file_name):
+            raise RuntimeError("File {} already exists".format(file_name))
+        cur_attempt = 1
+        while True:
+            response = self.source.open_content(cur_file)
+            stream = StreamPipe(response.iter_content(
+                                chunk_size=self.STREAM_CHUNK_SIZE),
+                                file_size,
+                                buffer_size=self.stream_buffer_size,
+                                chunk_size=self.STREAM_CHUNK_SIZE)
+            try:
+                new_file = self.destination.upload_stream(
+                    stream, file_name, file_size,
+                    destination=cur_dest,
+                    modified_time=last_mod,
+                    create_folder=self.create_folder,
+                    overwrite=overwrite)
+                # The destination checked its copy against what was sent.
+                # This checks what was sent against the source.
+                (hash_type, remote_hash) = self.source.get_file_hash(cur_file)
+                if stream.get_hash(hash_type) == remote_hash:
+                    return new_file
+                logger.warning("Hash of streamed file does not match "
+                               "source.  Attempting again")
+                # The bad copy has to be replaced on the next attempt
+                overwrite = True
+            except Exception as err:
+                if cur_attempt >= self.NUM_ATTEMPTS:
+                    raise
+                logger.warning("Streaming {} failed: {}.  Attempting again"
+                               .format(file_name, err))
+                if overwrite is False and self.destination_exists(cur_dest,
+                                                                  file_name):
+                    overwrite = True
+            finally:
+                stream.close()
+                response.close()
+
+            cur_attempt += 1
+            if cur_attempt > self.NUM_ATTEMPTS:
+                raise RuntimeError("Hash of streamed file does not match "
+                                   "source.")
+
+    def destination_exists(self, cur_dest, file_name):
+        file_path = file_name
+        if cur_dest is not None and len(cur_dest.strip('/')) > 0:
+            file_path = cur_dest.strip('/') + "/" + file_name
+        try:
+            self.destination.get_file_by_path(file_path)
+        except ItemDoesNotExistError:
+            return False
+        return True
+
+    def add_error(self, err):
+        with self.lock:
+            self.errors.append(err)
+
+    def finish_task(self, task_path):
+        if task_path is not None:
+            shutil.rmtree(task_path, ignore_errors=True)
+        self.slots.release()
+        with self.lock:
+            self.pending -= 1
+            self.lock.notify_all()
+
+    def check_errors(self):
+        with self.lock:
+            if self.errors:
+                raise TransferError("{} transfer(s) failed. First error: {}"
+                                    .format(len(self.errors),
+                                            self.errors[0])) \
+                    from self.errors[0]
+
+    def join(self):
+        with self.lock:
+            while self.pending > 0:
+                self.lock.wait()
+        self.check_errors()
+
+    def close(self):
+        self.download_pool.shutdown(wait=True)
+        self.upload_pool.shutdown(wait=True)
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
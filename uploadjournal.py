@@ -0,0 +1,84 @@
+# Copyright (C) 2015 Darryl Tam <contact@darryltam.com>
+
+# This file is part of MultiDrive.
+
+# MultiDrive is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MultiDrive is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with MultiDrive.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# Local journal of resumable upload sessions, so an upload interrupted by
+# the process stopping can be resumed by the next run instead of starting
+# again from the first byte.
+#
+# Sessions are keyed by the remote path (upload_key), and remember which
+# local file they were for (source_id).  A session is only resumed for
+# the same, unmodified file.  session is whatever the service needs to
+# resume (e.g. the upload URL), and offset the number of bytes known to
+# have been sent.
+class UploadJournal(object):
+
+    # Sessions older than this have expired on every service
+    MAX_AGE = 7*24*60*60
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS upload_sessions "
+                        "(upload_key TEXT PRIMARY KEY, source_id TEXT, "
+                        "session TEXT, offset INTEGER, updated REAL)")
+        self.db.execute("DELETE FROM upload_sessions WHERE updated < ?",
+                        (time.time() - self.MAX_AGE,))
+        self.db.commit()
+
+    def get(self, upload_key, source_id):
+        with self.lock:
+            row = self.db.execute("SELECT source_id, session, offset FROM "
+                                  "upload_sessions WHERE upload_key = ?",
+                                  (upload_key,)).fetchone()
+        if row is None or row[0] != source_id:
+            return None
+        return (json.loads(row[1]), row[2])
+
+    def set(self, upload_key, source_id, session, offset=0):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO upload_sessions VALUES "
+                            "(?, ?, ?, ?, ?)",
+                            (upload_key, source_id, json.dumps(session),
+                             offset, time.time()))
+            self.db.commit()
+
+    def remove(self, upload_key):
+        with self.lock:
+            self.db.execute("DELETE FROM upload_sessions WHERE "
+                            "upload_key = ?", (upload_key,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+# Identifies a local file and its contents well enough to tell if a
+# journaled session was for the same data.
+def get_source_id(file_path):
+    stat = os.stat(file_path)
+    return "{}:{}:{}".format(os.path.abspath(file_path), stat.st_size,
+                             stat.st_mtime_ns)